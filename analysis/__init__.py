@@ -1,3 +1,4 @@
 from .catalogs import *
 from .objects import ObjectCatalog
-from .source_id import splitCoaddId
+from .source_id import splitCoaddId, makeCoaddId, IdIndex, alignIds
+from .aggregate import aggregate, BinnedStatistics
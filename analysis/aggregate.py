@@ -0,0 +1,242 @@
+"""Binned statistics over many patches, without loading a whole catalog.
+
+aggregate() reads one patch at a time (or one per worker process),
+evaluates field expressions over it, and adds the results to a
+BinnedStatistics; per-patch partial results are merged as they arrive, so
+memory use is bounded by a single patch plus the accumulators::
+
+    stats = aggregate(butler, "i.meas.cmodel.mag", numpy.linspace(18, 26, 33),
+                      value="i.meas.mag.psf - i.meas.cmodel.mag", valueRange=(-1, 1),
+                      where="detect.is-primary", tract=8766, patches=patches, workers=8)
+    stats.count, stats.mean(), stats.quantile(0.5)
+"""
+
+import copy
+import multiprocessing
+import numpy
+
+from .objects import (PatchReader, ColumnAttributeProxy, evaluateExpression, _expressionPatterns,
+                      _makeFilters, _makeDataIds)
+from .instrument import NULL_INSTRUMENT, Recorder, BufferSink
+
+
+class BinnedStatistics(object):
+    """Per-bin counts, moments, extrema and value histograms over 1-d or 2-d bins.
+
+    ``edges`` is a sequence of bin edge arrays, one per binning dimension;
+    bins are half-open ([low, high)), and points outside them are ignored.
+    If a value is accumulated as well, the count, sum, sum of squares,
+    minimum and maximum of the (finite) values are kept per bin, and if
+    ``valueRange`` is not None, also a histogram of them with ``valueBins``
+    bins (plus one each for values below and above the range) from which
+    quantiles are interpolated.
+
+    All of these are exactly mergeable: merging the results of several
+    subsets gives the same result as accumulating their union.
+    """
+
+    def __init__(self, edges, valueRange=None, valueBins=1000):
+        self.edges = tuple(numpy.asarray(e, dtype=float) for e in edges)
+        self.shape = tuple(len(e) - 1 for e in self.edges)
+        self.valueRange = tuple(float(v) for v in valueRange) if valueRange is not None else None
+        self.valueBins = valueBins
+        self.count = numpy.zeros(self.shape, dtype=numpy.int64)
+        self.sum = numpy.zeros(self.shape, dtype=float)
+        self.sumSq = numpy.zeros(self.shape, dtype=float)
+        self.min = numpy.full(self.shape, numpy.inf)
+        self.max = numpy.full(self.shape, -numpy.inf)
+        if valueRange is not None:
+            self.histogram = numpy.zeros(self.shape + (valueBins + 2,), dtype=numpy.int64)
+        else:
+            self.histogram = None
+
+    @property
+    def centers(self):
+        """Bin centers, one array per dimension."""
+        return tuple(0.5*(e[1:] + e[:-1]) for e in self.edges)
+
+    def _binIndex(self, coords):
+        size = numpy.prod(self.shape)
+        index = numpy.zeros(len(coords[0]), dtype=numpy.int64)
+        valid = numpy.ones(len(coords[0]), dtype=bool)
+        for x, e, n in zip(coords, self.edges, self.shape):
+            i = numpy.searchsorted(e, x, side="right") - 1
+            valid &= (i >= 0) & (i < n)
+            index = index*n + i
+        index[~valid] = size
+        return index
+
+    def add(self, coords, values=None):
+        """Accumulate points with the given coordinates (one array per dimension) and, optionally, values."""
+        coords = [numpy.asarray(x, dtype=float) for x in coords]
+        if len(coords) != len(self.shape):
+            raise ValueError("Expected {} coordinate arrays, got {}".format(len(self.shape), len(coords)))
+        size = numpy.prod(self.shape)
+        index = self._binIndex(coords)
+        if values is not None:
+            values = numpy.asarray(values, dtype=float)
+            index[~numpy.isfinite(values)] = size
+        keep = index < size
+        index = index[keep]
+        self.count += numpy.bincount(index, minlength=size).reshape(self.shape)
+        if values is None:
+            return
+        values = values[keep]
+        self.sum += numpy.bincount(index, weights=values, minlength=size).reshape(self.shape)
+        self.sumSq += numpy.bincount(index, weights=values*values, minlength=size).reshape(self.shape)
+        numpy.minimum.at(self.min.reshape(-1), index, values)
+        numpy.maximum.at(self.max.reshape(-1), index, values)
+        if self.histogram is not None:
+            lo, hi = self.valueRange
+            slot = numpy.floor((values - lo)*(self.valueBins/(hi - lo))).astype(numpy.int64) + 1
+            slot = numpy.clip(slot, 0, self.valueBins + 1)
+            nSlots = self.valueBins + 2
+            self.histogram += numpy.bincount(index*nSlots + slot, minlength=size*nSlots).reshape(
+                self.histogram.shape)
+
+    def merge(self, other):
+        """Add the accumulated statistics of another BinnedStatistics with the same binning."""
+        if (self.shape != other.shape or not all(numpy.array_equal(a, b) for a, b in zip(self.edges, other.edges))
+                or self.valueRange != other.valueRange or self.valueBins != other.valueBins):
+            raise ValueError("Cannot merge BinnedStatistics with different binning")
+        self.count += other.count
+        self.sum += other.sum
+        self.sumSq += other.sumSq
+        numpy.minimum(self.min, other.min, out=self.min)
+        numpy.maximum(self.max, other.max, out=self.max)
+        if self.histogram is not None:
+            self.histogram += other.histogram
+        return self
+
+    def mean(self):
+        """Return the mean value in each bin (NaN for empty bins)."""
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return self.sum/self.count
+
+    def std(self):
+        """Return the standard deviation of the values in each bin (NaN for empty bins)."""
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum/self.count
+            return numpy.sqrt(numpy.maximum(self.sumSq/self.count - mean*mean, 0.0))
+
+    def quantile(self, q):
+        """Return the ``q`` quantile (0 <= q <= 1) of the values in each bin (NaN for empty bins).
+
+        Quantiles are interpolated linearly within the value histogram, so
+        they are accurate to about one value bin, and are always within the
+        bin's exact minimum and maximum.
+        """
+        if self.histogram is None:
+            raise ValueError("Quantiles need a valueRange")
+        nSlots = self.valueBins + 2
+        hist = self.histogram.reshape(-1, nSlots)
+        cum = numpy.cumsum(hist, axis=1)
+        target = q*cum[:, -1]
+        slot = numpy.minimum((cum < target[:, numpy.newaxis]).sum(axis=1), nSlots - 1)
+        rows = numpy.arange(len(hist))
+        below = numpy.where(slot > 0, cum[rows, slot - 1], 0)
+        inSlot = hist[rows, slot]
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            frac = numpy.where(inSlot > 0, (target - below)/inSlot, 0.0)
+            lo, hi = self.valueRange
+            result = lo + (slot - 1 + frac)*((hi - lo)/self.valueBins)
+            result = numpy.clip(result, self.min.reshape(-1), self.max.reshape(-1))
+        result[cum[:, -1] == 0] = numpy.nan
+        return result.reshape(self.shape)
+
+    def median(self):
+        return self.quantile(0.5)
+
+
+def _accumulate(stats, fields, value, columns):
+    proxy = ColumnAttributeProxy._build(columns)
+    coords = [evaluateExpression(field, proxy) for field in fields]
+    values = evaluateExpression(value, proxy) if value is not None else None
+    stats.add(coords, values)
+
+
+_worker = None
+
+def _initWorker(reader, sink, template, fields, value):
+    global _worker
+    _worker = (reader, sink, template, fields, value)
+
+def _aggregatePatchInWorker(dataId):
+    """Return the BinnedStatistics for one patch, and the instrumentation events recorded."""
+    reader, sink, template, fields, value = _worker
+    stats = BinnedStatistics(template.edges, template.valueRange, template.valueBins)
+    columns = reader(dataId)
+    with reader.instrument.stage("aggregate", dataId) as stage:
+        _accumulate(stats, fields, value, columns)
+        stage.add(rows=len(columns[("id",)]))
+    if sink is None:
+        return stats, []
+    return stats, sink.flush()
+
+
+def aggregate(butler, fields, edges, value=None, valueRange=None, valueBins=1000, where=None,
+              dataIds=(), tracts=(), tract=None, patches=(), patch=None, filters=None, filter=None,
+              forced=True, meas=True, cache=None, include=None, workers=1, prefetch=0, instrument=None):
+    """Accumulate binned statistics over many patches, one patch at a time.
+
+    ``fields`` is a field expression (see objects.evaluateExpression) or a
+    sequence of one or two, to bin on; ``edges`` gives the bin edges for
+    each.  If ``value`` is not None, it is an expression for the quantity
+    whose per-bin mean, standard deviation, extrema and (if ``valueRange``
+    is given) quantiles are wanted.  ``where`` selects rows as in
+    ObjectCatalog.read.
+
+    If all of the expressions (and ``where``, if given) are strings and
+    ``include`` is None, only the columns they refer to are extracted.  With ``workers > 1``, patches are
+    processed in a pool of that many processes (callable expressions must
+    then be picklable), and the per-patch results merged in the order of
+    ``dataIds``.  The remaining arguments are as for ObjectCatalog.read.
+
+    Returns a BinnedStatistics.
+    """
+    if isinstance(fields, basestring) or callable(fields):
+        fields = (fields,)
+        edges = (edges,)
+    fields = tuple(fields)
+    filters = _makeFilters(filters, filter)
+    dataIds = _makeDataIds(dataIds, tracts, tract, patches, patch)
+    if instrument is None:
+        instrument = NULL_INSTRUMENT
+    expressions = fields + ((value,) if value is not None else ())
+    if include is None and not callable(where) and all(isinstance(e, basestring) for e in expressions):
+        # PatchReader adds the columns a string ``where`` refers to
+        include = sum((_expressionPatterns(e) for e in expressions), ())
+    reader = PatchReader(butler, filters, forced=forced, meas=meas, footprints=False, cache=cache,
+                         include=include, instrument=instrument, where=where)
+    stats = BinnedStatistics(edges, valueRange, valueBins)
+    instrument.progress(0, len(dataIds), 0)
+
+    if workers > 1:
+        # Workers buffer their events and send them back with each patch's statistics.
+        sink = BufferSink() if instrument.enabled else None
+        workerReader = copy.copy(reader)
+        workerReader.instrument = Recorder([sink]) if sink is not None else NULL_INSTRUMENT
+        pool = multiprocessing.Pool(workers, initializer=_initWorker,
+                                    initargs=(workerReader, sink, stats, fields, value))
+        try:
+            for n, (partial, events) in enumerate(pool.imap(_aggregatePatchInWorker, dataIds)):
+                instrument.replay(events)
+                stats.merge(partial)
+                instrument.progress(n + 1, len(dataIds), int(stats.count.sum()))
+        finally:
+            pool.terminate()
+            pool.join()
+        return stats
+
+    reader.startPrefetch(dataIds, prefetch)
+    try:
+        for n, dataId in enumerate(dataIds):
+            columns = reader(dataId)
+            with instrument.stage("aggregate", dataId) as stage:
+                _accumulate(stats, fields, value, columns)
+                stage.add(rows=len(columns[("id",)]))
+            del columns
+            instrument.progress(n + 1, len(dataIds), int(stats.count.sum()))
+    finally:
+        reader.stopPrefetch()
+    return stats
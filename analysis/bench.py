@@ -0,0 +1,456 @@
+"""Benchmarks for the catalog loaders and column proxies, run against a synthetic butler.
+
+FakeButler writes real afw FITS catalogs (with realistic, wide schemas) and
+small coadd Exposures to a scratch directory, and serves them through the
+subset of the butler interface the loaders use, so the full read paths can be
+timed without an HSC rerun.  Run with
+
+    python -m analysis.bench --patches 4 --rows 5000
+
+and compare the rows/s, wall times and peak RSS (and its increase) it reports for each stage.
+"""
+
+import os
+import sys
+import glob
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import threading
+import contextlib
+
+import numpy
+import lsst.afw.geom
+import lsst.afw.image
+import lsst.afw.table
+import lsst.afw.detection
+
+from .source_id import makeCoaddId, splitCoaddId
+from .objects import ObjectCatalog, PatchReader
+from .catalogs import CatalogLoader
+
+BANDS = ("g", "r", "i", "z", "y")
+
+FLAG_NAMES = ("flags.pixel.edge", "flags.pixel.interpolated.any", "flags.pixel.interpolated.center",
+              "flags.pixel.saturated.any", "flags.pixel.saturated.center", "flags.pixel.cr.any",
+              "flags.pixel.cr.center", "flags.pixel.bad", "flags.pixel.suspect.any", "flags.badcentroid",
+              "calib.psf.candidate", "calib.psf.used", "deblend.skipped", "deblend.too-many-peaks")
+
+FLUX_NAMES = ("flux.psf", "flux.kron", "flux.gaussian", "flux.naive", "flux.sinc",
+              "cmodel.flux", "cmodel.exp.flux", "cmodel.dev.flux", "cmodel.initial.flux")
+
+# Rows are given copies of this many randomly-flagged template records.
+FLAG_TEMPLATES = 64
+
+ELLIPSE_NAMES = ("shape.sdss", "shape.hsm.moments", "cmodel.ellipse", "cmodel.initial.ellipse",
+                 "cmodel.exp.ellipse", "cmodel.dev.ellipse", "cmodel.region.initial.ellipse",
+                 "cmodel.region.final.ellipse")
+
+
+def makeRefSchema():
+    schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+    for name in ("detect.is-patch-inner", "detect.is-tract-inner", "detect.is-primary"):
+        schema.addField(name, type="Flag", doc="")
+    for b in BANDS:
+        schema.addField("merge.footprint.%s" % b, type="Flag", doc="")
+        schema.addField("merge.peak.%s" % b, type="Flag", doc="")
+    return schema
+
+
+def makeMeasSchema(nFields=2000, nApertures=10):
+    """Return a meas/forced-like schema with about nFields fields.
+
+    It includes Point and Moments fields, aperture fluxes as 2-d array fields,
+    Flag fields, and enough plain double fields to reach the requested width.
+    """
+    schema = lsst.afw.table.SourceTable.makeMinimalSchema()
+    schema.addField("centroid.sdss", type="PointD", doc="")
+    schema.addField("centroid.sdss.flags", type="Flag", doc="")
+    for name in ELLIPSE_NAMES:
+        schema.addField(name, type="MomentsD", doc="")
+    for name in FLUX_NAMES:
+        schema.addField(name, type="D", doc="")
+        schema.addField(name + ".err", type="D", doc="")
+        schema.addField(name + ".flags", type="Flag", doc="")
+    schema.addField("flux.kron.radius", type="F", doc="")
+    schema.addField("flux.kron.radiusForRadius", type="F", doc="")
+    schema.addField("flux.aperture", type="ArrayD", size=nApertures, doc="")
+    schema.addField("flux.aperture.err", type="ArrayD", size=nApertures, doc="")
+    schema.addField("flux.aperture.nInterpolatedPixel", type="ArrayI", size=nApertures, doc="")
+    schema.addField("deblend.nchild", type="I", doc="")
+    for name in FLAG_NAMES:
+        schema.addField(name, type="Flag", doc="")
+    for n in xrange(max(nFields - len(schema.getNames()), 0)//2):
+        schema.addField("ext.plugin%d.value" % n, type="D", doc="")
+        schema.addField("ext.plugin%d.flags" % n, type="Flag", doc="")
+    return schema
+
+
+def _fillFlags(catalog, rng):
+    """Set every Flag column of a catalog to a random mix of values, overwriting all other fields.
+
+    afw can't set a Flag column from an array, and setting each flag of each
+    record is far too slow for wide schemas, so each record is assigned one
+    of FLAG_TEMPLATES template records, whose flags are set independently
+    with a per-flag probability.
+    """
+    keys = [item.key for item in catalog.schema if item.field.getTypeString() == "Flag"]
+    if not keys:
+        return
+    rates = rng.uniform(0.0, 0.5, size=len(keys))
+    templates = []
+    for t in xrange(FLAG_TEMPLATES):
+        record = catalog.getTable().makeRecord()
+        for key, value in zip(keys, rng.uniform(size=len(keys)) < rates):
+            record.set(key, bool(value))
+        templates.append(record)
+    for record, t in zip(catalog, rng.randint(0, FLAG_TEMPLATES, size=len(catalog))):
+        record.assign(templates[t])
+
+
+def _fillColumns(catalog, rng, x0=0, y0=0, size=4000):
+    """Fill every column but id and parent of a freshly-allocated (contiguous) catalog with random values."""
+    n = len(catalog)
+    schema = catalog.schema
+    _fillFlags(catalog, rng)
+    for item in schema:
+        name = item.field.getName()
+        t = item.field.getTypeString()
+        if name in ("id", "parent") or t in ("Flag", "String") or t.startswith("Cov"):
+            continue
+        if t == "Coord":
+            catalog[schema.find(name + ".ra").key][:] = rng.uniform(0.0, 2.0*numpy.pi, size=n)
+            catalog[schema.find(name + ".dec").key][:] = rng.uniform(-0.5, 0.5, size=n)
+        elif t.startswith("Point"):
+            catalog[item.key.getX()][:] = rng.uniform(x0, x0 + size, size=n)
+            catalog[item.key.getY()][:] = rng.uniform(y0, y0 + size, size=n)
+        elif t.startswith("Moments"):
+            xx = rng.uniform(1.0, 10.0, size=n)
+            yy = rng.uniform(1.0, 10.0, size=n)
+            catalog[item.key.getIxx()][:] = xx
+            catalog[item.key.getIyy()][:] = yy
+            catalog[item.key.getIxy()][:] = rng.uniform(-0.5, 0.5, size=n)*numpy.sqrt(xx*yy)
+        elif t.startswith("Array"):
+            column = catalog[item.key]
+            if t == "ArrayI":
+                column[:] = rng.randint(0, 5, size=column.shape)
+            else:
+                column[:] = rng.lognormal(5.0, 1.0, size=column.shape)
+        elif t in ("I", "L"):
+            catalog[item.key][:] = rng.randint(0, 5, size=n)
+        else:
+            catalog[item.key][:] = rng.lognormal(5.0, 1.0, size=n)
+
+
+def makeCatalog(schema, ids, rng, footprints=False, x0=0, y0=0, size=4000):
+    table = lsst.afw.table.SourceTable.make(schema)
+    if "centroid.sdss" in schema.getNames():
+        table.defineCentroid("centroid.sdss")
+        table.defineShape("shape.sdss")
+    catalog = lsst.afw.table.SourceCatalog(table)
+    catalog.reserve(len(ids))
+    for i in xrange(len(ids)):
+        catalog.addNew()
+    _fillColumns(catalog, rng, x0=x0, y0=y0, size=size)
+    catalog[schema.find("id").key][:] = ids
+    if footprints:
+        # as in real deepCoadd_meas catalogs, some records (deblended children) get
+        # HeavyFootprints, and the rest plain ones
+        xKey = schema.find("centroid.sdss.x").key
+        yKey = schema.find("centroid.sdss.y").key
+        heavy = rng.uniform(size=len(catalog)) < 0.5
+        for record, isHeavy in zip(catalog, heavy):
+            x = int(record.get(xKey))
+            y = int(record.get(yKey))
+            fp = lsst.afw.detection.Footprint(lsst.afw.geom.Box2I(lsst.afw.geom.Point2I(x - 3, y - 3),
+                                                                    lsst.afw.geom.Extent2I(7, 7)))
+            fp.addPeak(x, y, 100.0)
+            if isHeavy:
+                fp = lsst.afw.detection.HeavyFootprintF(fp)
+                fp.getImageArray()[:] = rng.normal(size=fp.getArea())
+                fp.getMaskArray()[:] = rng.randint(0, 4, size=fp.getArea())
+                fp.getVarianceArray()[:] = rng.uniform(0.5, 1.5, size=fp.getArea())
+            record.setFootprint(fp)
+    return catalog
+
+
+class FakeButler(object):
+    """A stand-in for a data butler over a synthetic coadd rerun.
+
+    Ref, meas and forced catalogs (of ``rows`` objects each, sorted by ID)
+    and small calexps carrying a Calib are written for each tract, patch and
+    band under ``root``; get() serves them, along with the "_schema" and
+    "_filename" datasets the loaders use.  Meas catalogs carry square
+    Footprints, about half of them heavy, so footprint loading can be timed
+    (and tested) too.
+    """
+
+    def __init__(self, root, tract=0, patches=("1,1",), filters=BANDS, rows=5000, fields=2000,
+                 apertures=10, imageSize=200, seed=1):
+        self.root = root
+        self.tract = tract
+        self.patches = tuple(patches)
+        self.filters = tuple(filters)
+        rng = numpy.random.RandomState(seed)
+        self.schemas = {
+            "deepCoadd_ref": makeRefSchema(),
+            "deepCoadd_meas": makeMeasSchema(fields, apertures),
+            "deepCoadd_forced_src": makeMeasSchema(fields, apertures),
+        }
+        for datasetType, schema in self.schemas.iteritems():
+            lsst.afw.table.SourceCatalog(schema).writeFits(self._path(datasetType + "_schema"))
+        for patch in self.patches:
+            px, py = (int(v) for v in patch.split(","))
+            ids = makeCoaddId(tract, px, py, numpy.arange(1, rows + 1))
+            dataId = dict(tract=tract, patch=patch)
+            makeCatalog(self.schemas["deepCoadd_ref"], ids, rng).writeFits(self._path("deepCoadd_ref", dataId))
+            for b in self.filters:
+                filterName = "HSC-" + b.upper()
+                makeCatalog(self.schemas["deepCoadd_meas"], ids, rng, footprints=True).writeFits(
+                    self._path("deepCoadd_meas", dataId, filterName))
+                makeCatalog(self.schemas["deepCoadd_forced_src"], ids, rng).writeFits(
+                    self._path("deepCoadd_forced_src", dataId, filterName))
+                exposure = lsst.afw.image.ExposureF(imageSize, imageSize)
+                exposure.getCalib().setFluxMag0(10.0**(0.4*27.0), 1E8)
+                exposure.writeFits(self._path("deepCoadd_calexp", dataId, filterName))
+
+    def _path(self, datasetType, dataId=None, filter=None):
+        if datasetType == "deepCoadd":
+            datasetType = "deepCoadd_calexp"
+        parts = [self.root, datasetType]
+        if dataId is not None:
+            parts.extend((str(dataId["tract"]), dataId["patch"]))
+        if filter is not None:
+            parts.append(filter)
+        directory = os.path.join(*parts)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return os.path.join(directory, "data.fits")
+
+    def get(self, datasetType, dataId=None, immediate=True, flags=0, **kwds):
+        dataId = dict(dataId or {}, **kwds)
+        filterName = dataId.pop("filter", None)
+        if datasetType.endswith("_schema"):
+            return lsst.afw.table.SourceCatalog.readFits(self._path(datasetType))
+        if datasetType.endswith("_filename"):
+            return [self._path(datasetType[:-len("_filename")], dataId, filterName)]
+        filename = self._path(datasetType, dataId, filterName)
+        if datasetType in ("deepCoadd_calexp", "deepCoadd"):
+            return lsst.afw.image.ExposureF(filename)
+        return lsst.afw.table.SourceCatalog.readFits(filename, 0, flags)
+
+
+PAGE_MB = os.sysconf("SC_PAGE_SIZE")/1024.0**2
+
+
+def _residentPages(pid):
+    try:
+        with open("/proc/{}/statm".format(pid)) as f:
+            return int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return 0   # e.g. a worker that just exited
+
+
+def currentRss():
+    """Return the resident set size of this process plus its child processes, in MB (Linux only)."""
+    pids = ["self"]
+    for path in glob.glob("/proc/self/task/*/children"):
+        try:
+            with open(path) as f:
+                pids.extend(f.read().split())
+        except (IOError, OSError):
+            pass
+    return sum(_residentPages(pid) for pid in pids)*PAGE_MB
+
+
+class RssSampler(object):
+    """Track the peak of currentRss() over a block, by sampling it from a background thread.
+
+    ru_maxrss can't be used for this: it is the peak over the life of the
+    process, so it would charge every stage with the largest earlier one.
+    """
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.start = None
+        self.peak = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, currentRss())
+
+    def __enter__(self):
+        self.start = self.peak = currentRss()
+        self._thread = threading.Thread(target=self._run, name="RssSampler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, currentRss())
+
+
+class Benchmark(object):
+    """Wall time, throughput, and peak RSS and its increase for a sequence of named stages."""
+
+    def __init__(self):
+        self.results = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block; set "rows" in the yielded dict to report throughput."""
+        info = {"rows": None}
+        with RssSampler() as rss:
+            start = time.time()
+            yield info
+            seconds = time.time() - start
+        rows = info["rows"]
+        self.results.append({
+            "stage": name,
+            "seconds": seconds,
+            "rows": rows,
+            "rowsPerSecond": rows/seconds if rows and seconds > 0 else None,
+            "peakRssMB": rss.peak,
+            "rssIncreaseMB": rss.peak - rss.start,
+        })
+
+    def report(self, stream=sys.stdout):
+        stream.write("{:<45} {:>10} {:>10} {:>12} {:>10} {:>10}\n".format("stage", "seconds", "rows", "rows/s",
+                                                                          "peak MB", "+MB"))
+        for r in self.results:
+            stream.write("{:<45} {:>10.3f} {:>10} {:>12} {:>10.1f} {:>10.1f}\n".format(
+                r["stage"], r["seconds"], r["rows"] if r["rows"] is not None else "",
+                "%.0f" % r["rowsPerSecond"] if r["rowsPerSecond"] is not None else "", r["peakRssMB"],
+                r["rssIncreaseMB"]))
+
+
+def _showToNull(view):
+    from . import catview
+    send = catview.sendRegions
+    def write(frame, regions, chunkSize=1 << 20):
+        with open(os.devnull, "w") as f:
+            f.write("".join(regions))
+    catview.sendRegions = write
+    try:
+        view.show()
+    finally:
+        catview.sendRegions = send
+
+
+def run(butler, bench, workers=1, repeat=1, scratch=None, prefetch=2):
+    """Run all benchmark stages against a (fake) butler."""
+    from .catview import CatalogView
+    kwds = dict(tract=butler.tract, patches=butler.patches, filters=butler.filters, images=False,
+                progress=False)
+    for n in xrange(repeat):
+        with bench.stage("ObjectCatalog.read") as info:
+            objs = ObjectCatalog.read(butler, footprints=False, **kwds)
+            info["rows"] = len(objs)
+        with bench.stage("ObjectCatalog.read(include=cmodel)") as info:
+            info["rows"] = len(ObjectCatalog.read(butler, footprints=False, include="*.cmodel.*", **kwds))
+        with bench.stage("ObjectCatalog.read(where=primary)") as info:
+            info["rows"] = len(ObjectCatalog.read(butler, footprints=False, where="detect.is-primary", **kwds))
+        with bench.stage("ObjectCatalog.read(compact)") as info:
+            info["rows"] = len(ObjectCatalog.read(butler, footprints=False, compact=True, **kwds))
+        with bench.stage("ObjectCatalog.read(compactFootprints)") as info:
+            info["rows"] = len(ObjectCatalog.read(butler, footprints=True, compactFootprints=True, **kwds))
+        if workers > 1:
+            with bench.stage("ObjectCatalog.read(workers=%d)" % workers) as info:
+                info["rows"] = len(ObjectCatalog.read(butler, footprints=False, workers=workers, **kwds))
+        if prefetch:
+            with bench.stage("ObjectCatalog.read(prefetch=%d)" % prefetch) as info:
+                info["rows"] = len(ObjectCatalog.read(butler, footprints=False, prefetch=prefetch, **kwds))
+        with bench.stage("ObjectCatalog.read_many(2 reruns)") as info:
+            both = ObjectCatalog.read_many([butler, butler], tract=butler.tract, patches=butler.patches,
+                                           filters=butler.filters)
+            for b in butler.filters:
+                getattr(both.diff(), b).meas.cmodel.flux.value
+            info["rows"] = len(both)
+        del both
+        if scratch is not None:
+            cache = os.path.join(scratch, "cache")
+            shutil.rmtree(cache, ignore_errors=True)
+            with bench.stage("ObjectCatalog.read(cache, cold)") as info:
+                info["rows"] = len(ObjectCatalog.read(butler, footprints=False, cache=cache, **kwds))
+            with bench.stage("ObjectCatalog.read(cache, warm)") as info:
+                info["rows"] = len(ObjectCatalog.read(butler, footprints=False, cache=cache, **kwds))
+
+        with bench.stage("CatalogLoader.__init__"):
+            loader = CatalogLoader(butler, filters=butler.filters)
+        with bench.stage("CatalogLoader.read") as info:
+            catalog = loader.read(tract=butler.tract, patches=butler.patches)
+            info["rows"] = len(catalog)
+        del catalog
+        if prefetch:
+            with bench.stage("CatalogLoader.read(prefetch=%d)" % prefetch) as info:
+                info["rows"] = len(loader.read(tract=butler.tract, patches=butler.patches, prefetch=prefetch))
+
+        dataId = dict(tract=butler.tract, patch=butler.patches[0])
+        columns = PatchReader(butler, butler.filters, footprints=False)(dataId)
+        with bench.stage("ColumnAttributeProxy._build") as info:
+            ObjectCatalog._build(columns)
+            info["rows"] = len(columns[("id",)])
+        mask = objs.id.value % 2 == 0
+        with bench.stage("ColumnAttributeProxy.__getitem__") as info:
+            view = objs[mask]
+            for b in butler.filters:
+                getattr(view, b).meas.cmodel.flux.value
+            info["rows"] = len(objs)
+        with bench.stage("ColumnAttributeProxy.materialize") as info:
+            view.materialize()
+            info["rows"] = len(view)
+        del view
+
+        with bench.stage("splitCoaddId") as info:
+            splitCoaddId(objs.id.value, hasFilter=False)
+            info["rows"] = len(objs)
+
+        measCat = butler.get("deepCoadd_meas", dataId, filter="HSC-" + butler.filters[0].upper(),
+                             flags=lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS)
+        with bench.stage("CatalogView.show (formatting only)") as info:
+            _showToNull(CatalogView(measCat, ellipse="shape.sdss"))
+            info["rows"] = len(measCat)
+        del objs
+    return bench
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", default=None, help="directory for the synthetic rerun (default: a temporary one)")
+    parser.add_argument("--patches", type=int, default=2, help="number of patches")
+    parser.add_argument("--rows", type=int, default=5000, help="objects per patch")
+    parser.add_argument("--filters", default="".join(BANDS), help="bands, e.g. 'gri'")
+    parser.add_argument("--fields", type=int, default=2000, help="approximate fields per meas/forced schema")
+    parser.add_argument("--apertures", type=int, default=10, help="aperture flux array size")
+    parser.add_argument("--workers", type=int, default=1, help="also time reads with this many processes")
+    parser.add_argument("--prefetch", type=int, default=2, help="also time reads with this many reads in flight")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to run each stage")
+    parser.add_argument("--json", default=None, help="also write the results to this file as JSON")
+    args = parser.parse_args(argv)
+
+    root = args.root if args.root is not None else tempfile.mkdtemp(prefix="analysis-bench-")
+    try:
+        bench = Benchmark()
+        patches = ["%d,%d" % (n % 9, n // 9) for n in xrange(args.patches)]
+        with bench.stage("FakeButler setup") as info:
+            butler = FakeButler(os.path.join(root, "rerun"), patches=patches, filters=tuple(args.filters),
+                                rows=args.rows, fields=args.fields, apertures=args.apertures)
+            info["rows"] = args.rows*args.patches
+        run(butler, bench, workers=args.workers, repeat=args.repeat, scratch=root, prefetch=args.prefetch)
+        bench.report()
+        if args.json is not None:
+            with open(args.json, "w") as f:
+                json.dump(bench.results, f, indent=2)
+    finally:
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
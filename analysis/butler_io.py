@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import logging
+
+from .cache import fileStamps
+from .photometry import MagnitudeEngine
+
+log = logging.getLogger(__name__)
+
+FITS_BLOCK = 2880
+FITS_CARD = 80
+
+
+def _readFitsHeader(f):
+    """Read the header at the current position of a FITS file into a dict.
+
+    Integer values are converted; other values are left as (stripped)
+    strings.
+    """
+    header = {}
+    while True:
+        block = f.read(FITS_BLOCK)
+        if len(block) < FITS_BLOCK:
+            raise IOError("Truncated FITS header")
+        for i in xrange(0, FITS_BLOCK, FITS_CARD):
+            card = block[i:i+FITS_CARD]
+            key = card[:8].strip()
+            if key == "END":
+                return header
+            if key == "HIERARCH" and "=" in card:
+                # long keywords (e.g. FLUXMAG0ERR) are written with the ESO HIERARCH convention
+                key, value = card[9:].split("=", 1)
+                key = key.strip()
+                value = value.split("/", 1)[0].strip()
+            elif card[8:10] == "= ":
+                value = card[10:].split("/", 1)[0].strip()
+            else:
+                continue
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            header[key] = value
+
+
+def _fitsDataSize(header):
+    naxis = header.get("NAXIS", 0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for n in xrange(1, naxis + 1):
+        size *= header["NAXIS%d" % n]
+    size = abs(header["BITPIX"])//8 * header.get("GCOUNT", 1) * (header.get("PCOUNT", 0) + size)
+    return ((size + FITS_BLOCK - 1)//FITS_BLOCK)*FITS_BLOCK
+
+
+def readFitsHeader(filename, hdu=0):
+    """Return the header of the given (0-indexed) HDU of a FITS file as a dict,
+    without reading any data."""
+    with open(filename, "rb") as f:
+        for n in xrange(hdu):
+            f.seek(_fitsDataSize(_readFitsHeader(f)), 1)
+        return _readFitsHeader(f)
+
+
+def countRows(butler, datasetType, dataId, **kwds):
+    """Return the number of rows in a FITS catalog dataset by reading only its headers.
+
+    afw writes catalogs as a binary table in the first extension HDU.
+    """
+    filename = butler.get(datasetType + "_filename", dataId, **kwds)[0]
+    return readFitsHeader(filename, hdu=1)["NAXIS2"]
+
+
+def warmFile(filename, chunkSize=1 << 22):
+    """Read a whole file and discard its contents, leaving it in the OS page cache.
+
+    Python file reads release the GIL, so this overlaps with work in other
+    threads even when the library that reads the file properly afterwards
+    (e.g. cfitsio via the butler) does not.
+    """
+    with open(filename, "rb") as f:
+        while f.read(chunkSize):
+            pass
+
+
+def _parseFloat(value):
+    if isinstance(value, basestring):
+        value = value.replace("D", "E")
+    return float(value)
+
+
+def readZeroPoint(filename):
+    """Return (fluxMag0, fluxMag0Err) from the FITS headers of an afw Exposure, or None if absent.
+
+    afw writes the Calib into the primary header, but we also look in the
+    first extension in case the primary HDU holds the image.
+    """
+    for hdu in (0, 1):
+        header = readFitsHeader(filename, hdu=hdu)
+        if "FLUXMAG0" in header:
+            return _parseFloat(header["FLUXMAG0"]), _parseFloat(header.get("FLUXMAG0ERR", 0.0))
+    return None
+
+
+# Zero points by (filename, mtime), shared by all CalibProviders in a process.
+_zeroPoints = {}
+
+
+class CalibProvider(object):
+    """Photometric zero points for coadds, read from FITS headers without any pixels.
+
+    Results are memoized per file (so per tract, patch and band, and rerun)
+    for the life of the process, and if ``directory`` is not None, also saved
+    there as small JSON files so later sessions don't even read the headers.
+    Entries are keyed by filename and modification time, so they can't go
+    stale.
+    """
+
+    def __init__(self, butler, datasetType="deepCoadd_calexp", directory=None):
+        self.butler = butler
+        self.datasetType = datasetType
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, stamp):
+        return os.path.join(self.directory, hashlib.sha1(repr(stamp)).hexdigest() + ".json")
+
+    def getZeroPoint(self, dataId, b):
+        """Return (fluxMag0, fluxMag0Err) for one band of a patch."""
+        filterName = "HSC-" + b.upper()
+        stamp = tuple(fileStamps(self.butler, self.datasetType, dataId, filter=filterName)[0])
+        result = _zeroPoints.get(stamp)
+        if result is not None:
+            return result
+        if self.directory is not None:
+            try:
+                with open(self._path(stamp), "r") as f:
+                    result = tuple(json.load(f))
+            except (IOError, OSError, ValueError):
+                pass
+        if result is None:
+            result = readZeroPoint(stamp[0])
+            if result is None:
+                log.warning("No FLUXMAG0 in {}; reading the full exposure".format(stamp[0]))
+                exposure = self.butler.get(self.datasetType, dataId, immediate=True, filter=filterName)
+                result = tuple(exposure.getCalib().getFluxMag0())
+                del exposure
+            if self.directory is not None:
+                path = self._path(stamp)
+                tmp = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmp, "w") as f:
+                    json.dump(result, f)
+                os.rename(tmp, path)
+        _zeroPoints[stamp] = result
+        return result
+
+    def getEngine(self, dataId, b):
+        """Return a MagnitudeEngine for one band of a patch."""
+        return MagnitudeEngine(*self.getZeroPoint(dataId, b))
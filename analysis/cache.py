@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+import hashlib
+import cPickle
+import tempfile
+import numpy
+
+
+def fileStamps(butler, datasetType, dataId, **kwds):
+    """Return a list of (filename, mtime) pairs for the files backing a dataset.
+
+    Because the filenames include the rerun root, these identify both the
+    rerun and the exact version of the inputs.
+    """
+    filenames = butler.get(datasetType + "_filename", dataId, **kwds)
+    return [(os.path.abspath(f), os.path.getmtime(f)) for f in filenames]
+
+
+class ColumnCache(object):
+    """An on-disk store of extracted column arrays.
+
+    Each entry is a directory of .npy files (one per column) plus a JSON index
+    of their tuple keys, so entries can be opened as read-only memory maps
+    without copying.  Entries are located by a hash of an arbitrary
+    (repr-able) description, which callers should make specific enough that
+    stale entries are never matched: see fileStamps.
+
+    Object-dtype columns cannot be memory-mapped and must not be saved.
+    """
+
+    # Bump this whenever the content of cached columns changes.
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, description):
+        digest = hashlib.sha1(repr((self.VERSION, description))).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def __contains__(self, description):
+        return os.path.exists(os.path.join(self._path(description), "index.json"))
+
+    def load(self, description):
+        """Return a dict of memory-mapped columns, or None if there is no entry."""
+        path = self._path(description)
+        try:
+            with open(os.path.join(path, "index.json"), "r") as f:
+                index = json.load(f)
+        except (IOError, OSError):
+            return None
+        return {tuple(str(k) for k in key): numpy.load(os.path.join(path, "%d.npy" % n), mmap_mode="r")
+                for n, key in enumerate(index)}
+
+    def save(self, description, columns):
+        """Save a dict of columns, replacing any existing entry atomically."""
+        path = self._path(description)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            index = []
+            for n, (key, array) in enumerate(columns.iteritems()):
+                if array.dtype == object:
+                    raise TypeError("Cannot cache object column {}".format(".".join(key)))
+                numpy.save(os.path.join(tmp, "%d.npy" % n), numpy.ascontiguousarray(array))
+                index.append(list(key))
+            # write the index last; load() treats its presence as completeness
+            with open(os.path.join(tmp, "index.json"), "w") as f:
+                json.dump(index, f)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+                # another process saved the same entry first
+                shutil.rmtree(tmp, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+
+
+def schemaDigest(schema):
+    """Return a hex digest identifying the names and types of the fields in an afw Schema."""
+    return hashlib.sha1(repr([(item.field.getName(), item.field.getTypeString())
+                              for item in schema])).hexdigest()
+
+
+# PlanCache entries already loaded or computed in this process, by digest.
+_plans = {}
+
+
+class PlanCache(object):
+    """A memo of (picklable) results computed from schemas alone.
+
+    Entries are kept for the life of the process, and if ``directory`` is not
+    None, pickled there so later sessions can skip the computation too.  As
+    with ColumnCache, entries are located by a hash of a description, which
+    should include a schemaDigest of every schema involved.
+    """
+
+    # Bump this whenever the structure of cached plans changes.
+    VERSION = 1
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, description, compute):
+        """Return the entry for description, calling compute() to create it if necessary."""
+        digest = hashlib.sha1(repr((self.VERSION, description))).hexdigest()
+        result = _plans.get(digest)
+        if result is not None:
+            return result
+        path = os.path.join(self.directory, digest + ".pickle") if self.directory is not None else None
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    result = cPickle.load(f)
+            except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+                pass
+        if result is None:
+            result = compute()
+            if path is not None:
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, "wb") as f:
+                    cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tmp, path)
+        _plans[digest] = result
+        return result
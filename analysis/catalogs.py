@@ -1,6 +1,22 @@
+import os
 import numpy
 import lsst.afw.table
 
+from .photometry import MagnitudeEngine
+from .butler_io import warmFile, CalibProvider
+from .cache import PlanCache, schemaDigest
+from .instrument import NULL_INSTRUMENT
+from .pipeline import ReadAhead
+from .source_id import IdIndex
+
+
+def makeIdIndex(catalog):
+    """Return an IdIndex for vectorized lookups of object IDs in an afw catalog."""
+    if catalog.isContiguous():
+        return IdIndex(catalog.get("id"))
+    # column access needs a contiguous catalog, which subsets and concatenations aren't
+    return IdIndex(numpy.array([record.getId() for record in catalog], dtype=numpy.int64))
+
 
 class MagConverter(object):
 
@@ -16,12 +32,63 @@ class MagConverter(object):
         self.magErrKey = schema.addField(mag + ".err", type=float, doc="magnitude err for %s" % flux)
 
     def __call__(self, catalog, calib):
-        oldThrow = calib.getThrowOnNegativeFlux()
-        calib.setThrowOnNegativeFlux(False)
-        mag, magErr = calib.getMagnitude(catalog[self.fluxKey], catalog[self.fluxErrKey])
-        catalog[self.magKey][:] = mag
-        catalog[self.magErrKey][:] = magErr
-        calib.setThrowOnNegativeFlux(oldThrow)
+        """Fill the magnitude fields in place; ``calib`` may be a Calib or a MagnitudeEngine."""
+        if not isinstance(calib, MagnitudeEngine):
+            calib = MagnitudeEngine.fromCalib(calib)
+        calib(catalog[self.fluxKey], catalog[self.fluxErrKey],
+              mag=catalog[self.magKey], magErr=catalog[self.magErrKey])
+
+
+class ColumnTransfer(object):
+    """Copy a set of mapped fields between two catalogs with the same rows.
+
+    Numeric scalar, array, point and moments fields are copied
+    column-by-column with NumPy.  afw provides no writable column view for
+    other fields (flags, strings, covariances, coords and angles), so those
+    are gathered into a single SchemaMapper that is applied record-by-record;
+    this is still much cheaper than assigning every field that way.  Either
+    way, the result is the same as assign() with a SchemaMapper.
+    """
+
+    # Field types whose columns can be assigned as NumPy arrays.
+    COLUMN_TYPES = ("B", "U", "I", "L", "F", "D")
+
+    def __init__(self, inSchema):
+        self.inSchema = inSchema
+        self.pairs = []
+        self.slow = []
+        self.mapper = None
+
+    def add(self, item, outKey, outName):
+        """Register a mapping from a SchemaItem of the input schema to an output field."""
+        t = item.field.getTypeString()
+        if t.startswith("Point"):
+            self.pairs.append((item.key.getX(), outKey.getX()))
+            self.pairs.append((item.key.getY(), outKey.getY()))
+        elif t.startswith("Moments"):
+            self.pairs.append((item.key.getIxx(), outKey.getIxx()))
+            self.pairs.append((item.key.getIyy(), outKey.getIyy()))
+            self.pairs.append((item.key.getIxy(), outKey.getIxy()))
+        elif t in self.COLUMN_TYPES or (t.startswith("Array") and t[len("Array"):] in self.COLUMN_TYPES):
+            self.pairs.append((item.key, outKey))
+        else:
+            self.slow.append((item.key, outName))
+
+    def finish(self, outSchema):
+        """Build the record-by-record mapper once the output schema is complete."""
+        if self.slow:
+            self.mapper = lsst.afw.table.SchemaMapper(self.inSchema, outSchema)
+            for inKey, outName in self.slow:
+                self.mapper.addMapping(inKey, outName, True)
+
+    def __call__(self, inCat, outCat):
+        if len(inCat) != len(outCat):
+            raise ValueError("Catalogs have different lengths (%d != %d)" % (len(inCat), len(outCat)))
+        for inKey, outKey in self.pairs:
+            outCat[outKey][:] = inCat[inKey]
+        if self.mapper is not None:
+            for inRecord, outRecord in zip(inCat, outCat):
+                outRecord.assign(inRecord, self.mapper)
 
 
 class CatalogLoader(object):
@@ -36,62 +103,103 @@ class CatalogLoader(object):
     MAG_FIELDS = ("flux.gaussian", "flux.psf", "flux.kron",
                   "cmodel.flux", "cmodel.exp.flux", "cmodel.dev.flux")
 
-    def __init__(self, butler, filters=("g", "r", "i", "z", "y"), forced=True, meas=True):
+    def __init__(self, butler, filters=("g", "r", "i", "z", "y"), forced=True, meas=True, cache=None):
         self.butler = butler
         self.filters = tuple(filters)
+        # Zero points are read from the deepCoadd headers, and the field mapping plan is computed
+        # once per set of schemas; both are memoized, and saved under 'cache' if given.
+        self.calibs = CalibProvider(butler, datasetType="deepCoadd",
+                                    directory=os.path.join(cache, "calib") if cache is not None else None)
+        plans = PlanCache(os.path.join(cache, "plans") if cache is not None else None)
         refSchema = butler.get("deepCoadd_ref_schema", immediate=True).schema
+        measSchema = butler.get("deepCoadd_meas_schema", immediate=True).schema if meas else None
+        forcedSchema = butler.get("deepCoadd_forced_src_schema", immediate=True).schema if forced else None
+        description = ("CatalogLoader", self.filters, self.REF_PREFIXES, self.SHARED_PREFIXES, self.MAG_FIELDS,
+                       [schemaDigest(s) if s is not None else None for s in (refSchema, measSchema, forcedSchema)])
+        plan = plans.get(description, lambda: self._makePlan(refSchema, measSchema, forcedSchema))
+
         self.refMapper = lsst.afw.table.SchemaMapper(refSchema)
         self.refMapper.addMinimalSchema(lsst.afw.table.SourceTable.makeMinimalSchema(), True)
-        sharedFieldsAlreadyMapped = set(lsst.afw.table.SourceTable.makeMinimalSchema().getNames())
-        for item in refSchema:
-            prefix = item.field.getName().split(".")[0]
-            if prefix in self.REF_PREFIXES:
-                self.refMapper.addMapping(item.key)
-                sharedFieldsAlreadyMapped.add(item.field.getName())
+        for name in plan["ref"]:
+            self.refMapper.addMapping(refSchema.find(name).key)
         self.outSchema = self.refMapper.getOutputSchema()
         self.tractKey = self.outSchema.addField("tract", type=int, doc="Coadd tract")
         self.patchXKey = self.outSchema.addField("patch.x", type=int, doc="Coadd patch X")
         self.patchYKey = self.outSchema.addField("patch.y", type=int, doc="Coadd patch Y")
         self.measMappers = dict()
+        self.measTransfers = dict()
         self.measMags = dict()
-        if meas:
-            measSchema = butler.get("deepCoadd_meas_schema", immediate=True).schema
-            for b in self.filters:
-                self.measMappers[b] = lsst.afw.table.SchemaMapper(measSchema, self.outSchema)
-                for item in measSchema:
-                    if item.field.getName() in sharedFieldsAlreadyMapped:
-                        continue
-                    prefix = item.field.getName().split(".")[0]
-                    if prefix in self.SHARED_PREFIXES:
-                        self.measMappers[b].addMapping(item.key, "%s.%s" % (b, item.field.getName()))
-                        sharedFieldsAlreadyMapped.add("%s.%s" % (b, item.field.getName()))
-                    else:
-                        self.measMappers[b].addMapping(item.key, "meas.%s.%s" % (b, item.field.getName()))
-                self.measMags[b] = [MagConverter(flux, self.measMappers[b].editOutputSchema(), prefix="meas.%s" % b)
-                                    for flux in self.MAG_FIELDS
-                                    if flux in measSchema.getNames()]
-                self.outSchema = self.measMappers[b].getOutputSchema()
         self.forcedMappers = dict()
+        self.forcedTransfers = dict()
         self.forcedMags = dict()
-        if forced:
-            forcedSchema = butler.get("deepCoadd_forced_src_schema", immediate=True).schema
+        for kind, inSchema, mappers, transfers, mags in (
+                ("meas", measSchema, self.measMappers, self.measTransfers, self.measMags),
+                ("forced", forcedSchema, self.forcedMappers, self.forcedTransfers, self.forcedMags)):
+            if inSchema is None:
+                continue
+            for b in self.filters:
+                mappers[b] = lsst.afw.table.SchemaMapper(inSchema, self.outSchema)
+                transfers[b] = ColumnTransfer(inSchema)
+                for inName, outName in plan[kind][b]:
+                    item = inSchema.find(inName)
+                    outKey = mappers[b].addMapping(item.key, outName)
+                    transfers[b].add(item, outKey, outName)
+                mags[b] = [MagConverter(flux, mappers[b].editOutputSchema(), prefix="%s.%s" % (kind, b))
+                           for flux in plan[kind + "Mags"]]
+                self.outSchema = mappers[b].getOutputSchema()
+        for transfer in self.measTransfers.values() + self.forcedTransfers.values():
+            transfer.finish(self.outSchema)
+
+    def _makePlan(self, refSchema, measSchema, forcedSchema):
+        """Work out which input fields are mapped to which output fields.
+
+        This depends only on the schemas and filters, so the result (a dict of
+        field names) can be cached and the SchemaMappers rebuilt from it.
+        """
+        plan = {"ref": []}
+        mapped = set(lsst.afw.table.SourceTable.makeMinimalSchema().getNames())
+        for item in refSchema:
+            name = item.field.getName()
+            if name.split(".")[0] in self.REF_PREFIXES:
+                plan["ref"].append(name)
+                mapped.add(name)
+        for kind, inSchema in (("meas", measSchema), ("forced", forcedSchema)):
+            if inSchema is None:
+                continue
+            names = [item.field.getName() for item in inSchema]
+            plan[kind] = {}
             for b in self.filters:
-                self.forcedMappers[b] = lsst.afw.table.SchemaMapper(forcedSchema, self.outSchema)
-                for item in forcedSchema:
-                    if item.field.getName() in sharedFieldsAlreadyMapped:
+                pairs = []
+                for name in names:
+                    if name in mapped:
                         continue
-                    prefix = item.field.getName().split(".")[0]
-                    if prefix in self.SHARED_PREFIXES:
-                        self.forcedMappers[b].addMapping(item.key, "%s.%s" % (b, item.field.getName()))
+                    if name.split(".")[0] in self.SHARED_PREFIXES:
+                        outName = "%s.%s" % (b, name)
+                        if outName in mapped:
+                            continue    # already taken from the meas catalog
+                        mapped.add(outName)
                     else:
-                        self.forcedMappers[b].addMapping(item.key, "forced.%s.%s" % (b, item.field.getName()))
-                self.forcedMags[b] = [MagConverter(flux, self.forcedMappers[b].editOutputSchema(), prefix="forced.%s" % b)
-                                      for flux in self.MAG_FIELDS
-                                      if flux in forcedSchema.getNames()]
-                self.outSchema = self.forcedMappers[b].getOutputSchema()
+                        outName = "%s.%s.%s" % (kind, b, name)
+                    pairs.append((name, outName))
+                plan[kind][b] = pairs
+            inNames = set(names)
+            plan[kind + "Mags"] = [flux for flux in self.MAG_FIELDS if flux in inNames]
+        return plan
 
     def read(self, dataIds=(), tracts=(), tract=None, patches=(), patch=None, filters=None, filter=None,
-             extend=None, copy=True, progress=False):
+             extend=None, copy=True, progress=False, instrument=None, prefetch=0):
+        """Read and merge the catalogs for the given patches into a single SourceCatalog.
+
+        If ``instrument`` is not None, it should be an analysis.instrument
+        Recorder; reads, field transfers and magnitude conversions are timed
+        per patch and band, and progress is reported after each patch.
+
+        If ``prefetch`` is nonzero, that many butler reads are kept in flight
+        in background threads ahead of the catalog being transferred (see
+        analysis.pipeline.ReadAhead).
+        """
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
         dataIDs = list(dataIds)
         if filters is None:
             if filter is None:
@@ -121,44 +229,91 @@ class CatalogLoader(object):
                 display(progressBar)
             except RuntimeError:
                 progressBar = None
-        for n, dataID in enumerate(dataIDs):
-            subCat = lsst.afw.table.SourceCatalog(catalog.table)
-            refCat = self.butler.get("deepCoadd_ref", immediate=True,
-                                     flags=lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS, **dataID)
-            subCat.extend(refCat, mapper=self.refMapper)
-            subCat[self.tractKey][:] = dataID["tract"]
-            patchX, patchY = (int(p) for p in dataID["patch"].split(","))
-            subCat[self.patchXKey][:] = patchX
-            subCat[self.patchXKey][:] = patchY
-            calibs = dict()
-            for b in self.filters:
-                coadd = self.butler.get("deepCoadd", immediate=True, filter="HSC-%s" % b.upper(), **dataID)
-                calibs[b] = coadd.getCalib()
-            for b, mapper in self.measMappers.iteritems():
-                measCat = self.butler.get("deepCoadd_meas", immediate=True,
-                                          flags=lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS,
-                                          filter="HSC-%s" % b.upper(), **dataID)
-                for inRecord, outRecord in zip(measCat, subCat):
-                    outRecord.assign(inRecord, mapper)
-            for b, mapper in self.forcedMappers.iteritems():
-                forcedCat = self.butler.get("deepCoadd_forced_src", immediate=True,
-                                          flags=lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS,
-                                          filter="HSC-%s" % b.upper(), **dataID)
-                for inRecord, outRecord in zip(forcedCat, subCat):
-                    outRecord.assign(inRecord, mapper)
-            for b, magc in self.measMags.iteritems():
-                for m in magc:
-                    m(subCat, calibs[b])
-            for b, magc in self.forcedMags.iteritems():
-                for m in magc:
-                    m(subCat, calibs[b])
-            catalog.extend(subCat, False)
-            if progress:
-                if progressBar is not None:
-                    progressBar.value = n + 1
-                else:
-                    print "Loaded %s (%d of %d)" % (dataID, n + 1, len(dataIDs))
-        catalog.sort()
-        if copy:
-            catalog = catalog.copy(deep=True)
+        instrument.progress(0, len(dataIDs), 0)
+        readAhead = None
+        if prefetch:
+            readAhead = ReadAhead(lambda key: self._prefetch(instrument, key),
+                                  [key for dataID in dataIDs for key in self._plannedReads(dataID)],
+                                  depth=prefetch)
+        try:
+            for n, dataID in enumerate(dataIDs):
+                refCat = self._read(instrument, "deepCoadd_ref", dataID, readAhead=readAhead)
+                # Extending with a mapper allocates all of the new records in one block,
+                # so the slice holding them is contiguous and supports column access.
+                with instrument.stage("transfer.ref", dataID) as stage:
+                    start = len(catalog)
+                    catalog.extend(refCat, mapper=self.refMapper)
+                    del refCat
+                    subCat = catalog[start:]
+                    subCat[self.tractKey][:] = dataID["tract"]
+                    patchX, patchY = (int(p) for p in dataID["patch"].split(","))
+                    subCat[self.patchXKey][:] = patchX
+                    subCat[self.patchYKey][:] = patchY
+                    stage.add(rows=len(subCat))
+                with instrument.stage("calib", dataID):
+                    engines = dict((b, self.calibs.getEngine(dataID, b)) for b in self.filters)
+                for kind, transfers in (("meas", self.measTransfers), ("forced", self.forcedTransfers)):
+                    datasetType = "deepCoadd_meas" if kind == "meas" else "deepCoadd_forced_src"
+                    for b, transfer in transfers.iteritems():
+                        inCat = self._read(instrument, datasetType, dataID, b, readAhead=readAhead)
+                        with instrument.stage("transfer." + kind, dataID, b) as stage:
+                            transfer(inCat, subCat)
+                            stage.add(rows=len(inCat))
+                        del inCat
+                for mags in (self.measMags, self.forcedMags):
+                    for b, magc in mags.iteritems():
+                        with instrument.stage("magnitudes", dataID, b) as stage:
+                            for m in magc:
+                                m(subCat, engines[b])
+                            stage.add(rows=len(subCat))
+                instrument.progress(n + 1, len(dataIDs), len(catalog))
+                if progress:
+                    if progressBar is not None:
+                        progressBar.value = n + 1
+                    else:
+                        print "Loaded %s (%d of %d)" % (dataID, n + 1, len(dataIDs))
+        finally:
+            if readAhead is not None:
+                readAhead.close()
+        if not catalog.isSorted():
+            with instrument.stage("sort"):
+                catalog.sort()
+        # A deep copy is only needed to make the result contiguous, or to detach it from 'extend'.
+        if copy and (extend is not None or not catalog.isContiguous()):
+            with instrument.stage("copy") as stage:
+                catalog = catalog.copy(deep=True)
+                stage.add(nbytes=len(catalog)*catalog.schema.getRecordSize(), rows=len(catalog))
         return catalog
+
+    def _plannedReads(self, dataID):
+        """Return the reads made for a patch by read(), in order, as (datasetType, tract, patch, filter)."""
+        keys = [("deepCoadd_ref", dataID["tract"], dataID["patch"], None)]
+        for kind, transfers in (("meas", self.measTransfers), ("forced", self.forcedTransfers)):
+            datasetType = "deepCoadd_meas" if kind == "meas" else "deepCoadd_forced_src"
+            keys.extend((datasetType, dataID["tract"], dataID["patch"], b) for b in transfers)
+        return keys
+
+    def _fetch(self, instrument, key):
+        datasetType, tract, patch, b = key
+        dataID = dict(tract=tract, patch=patch)
+        kwds = dict(dataID)
+        if b is not None:
+            kwds["filter"] = "HSC-%s" % b.upper()
+        with instrument.stage("read." + datasetType, dataID, b) as stage:
+            catalog = self.butler.get(datasetType, immediate=True,
+                                      flags=lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS, **kwds)
+            stage.add(nbytes=len(catalog)*catalog.schema.getRecordSize(), rows=len(catalog))
+        return catalog
+
+    def _prefetch(self, instrument, key):
+        datasetType, tract, patch, b = key
+        kwds = dict(filter="HSC-%s" % b.upper()) if b is not None else {}
+        warmFile(self.butler.get(datasetType + "_filename", dict(tract=tract, patch=patch), **kwds)[0])
+        return self._fetch(instrument, key)
+
+    def _read(self, instrument, datasetType, dataID, b=None, readAhead=None):
+        key = (datasetType, dataID["tract"], dataID["patch"], b)
+        if readAhead is None:
+            return self._fetch(instrument, key)
+        with instrument.stage("prefetch.wait", dataID, b):
+            return readAhead.get(key, lambda key: self._fetch(instrument, key))
@@ -1,8 +1,6 @@
 #!/usr/bin/env python
 
 import uuid
-import itertools
-import os
 import re
 
 import numpy
@@ -12,6 +10,10 @@ import matplotlib.cm
 import lsst.afw.geom.ellipses
 import lsst.afw.display
 
+from .catalogs import makeIdIndex
+from .regions import quadrupoleToAxes, rgbaToHex, sendRegions
+from .instrument import NULL_INSTRUMENT
+
 def rgba2hex(rgba):
     return "#{0:02x}{1:02x}{2:02x}".format(int(rgba[0]*255), int(rgba[1]*255), int(rgba[2]*255))
 
@@ -33,8 +35,10 @@ def make_extractor_property(name, allow_none=False, allow_str=False):
                 raise ValueError("Property '{}' cannot be None".format(name))
         if isinstance(value, basestring):
             key = self.catalog.schema.find(value).key
+            self._fields[name] = value
             return lambda r: r.get(key)
         else:
+            self._fields.pop(name, None)
             return value
     return property_setter(setter, name)
 
@@ -49,8 +53,9 @@ def make_bool_property(name):
 class CatalogView(object):
 
 
-    def __init__(self, catalog, frame=0, tag=None, coordsys="wcsa", **kwds):
+    def __init__(self, catalog, frame=0, tag=None, coordsys="wcsa", instrument=None, **kwds):
         self.catalog = catalog
+        self.instrument = instrument if instrument is not None else NULL_INSTRUMENT
         self.frame = frame
         self.tag = tag if tag is not None else uuid.uuid4().hex
         self.coordsys = coordsys
@@ -61,6 +66,8 @@ class CatalogView(object):
         )
         args.update(kwds)
         self._properties = {}
+        self._fields = {}   # field names for extractors defined by name, for columnar access
+        self._idIndex = None   # (catalog, length, IdIndex) for inspect()
         self.configure(**args)
 
     centroid = make_extractor_property("centroid")
@@ -100,51 +107,80 @@ class CatalogView(object):
                 cmap = matplotlib.cm.get_cmap()
             self._color = lambda catalog: cmap(norm(color(catalog)))
 
-    def show(self):
-        fmt1 = ("{s.coordsys}; "
-                    "point {x} {y} # point={s.symbol} width={s.width:d} dash={s.dash:1d} "
-                    "edit={s.can_edit:d} move={s.can_move:d} "
-                    "rotate={s.can_rotate:d} delete={s.can_delete:d} "
-                    "tag={s.tag} {text} color={{{color}}} id={id}"
-                ";\n")
-        fmt2 = ("{s.coordsys}; "
-                    "ellipse({x},{y},{a},{b},{theta}) # width={s.width:d} dash={s.dash:1d} "
-                    "edit={s.can_edit:d} move={s.can_move:d} "
-                    "rotate={s.can_rotate:d} delete={s.can_delete:d} "
-                    "tag={s.tag} {text} color={{{color}}} id={id}"
-                ";\n")
+    def _getColumn(self, field):
+        # afw column access needs a contiguous catalog, which subsets (e.g. boolean-mask
+        # selections) and concatenations aren't; those are read one record at a time.
+        if self.catalog.isContiguous():
+            return self.catalog.get(field)
+        key = self.catalog.schema.find(field).key
+        return numpy.array([record.get(key) for record in self.catalog])
+
+    def _extractColumns(self, name, subfields):
+        """Return arrays for the given subfields of an extractor property.
+
+        Extractors set from field names are read as whole columns (record by
+        record if the catalog isn't contiguous); callables are evaluated once
+        per record and must return a sequence of values.
+        """
+        field = self._fields.get(name)
+        if field is not None:
+            if not subfields:
+                return [self._getColumn(field)]
+            return [self._getColumn("{}.{}".format(field, s)) for s in subfields]
+        extractor = getattr(self, name)
+        values = [extractor(record) for record in self.catalog]
+        if not subfields:
+            return [numpy.array(values)]
+        return list(numpy.array([tuple(v) for v in values], dtype=float).reshape(len(values), -1).T)
+
+    def show(self, chunkSize=1 << 20):
+        """Draw the catalog on the frame as ds9 regions.
+
+        All region lines are formatted in one pass from whole columns and sent
+        with a single xpaset call, in chunks of ``chunkSize`` bytes.
+        """
+        with self.instrument.stage("display.regions") as stage:
+            lines = self._formatRegions()
+            sendRegions(self.frame, lines, chunkSize=chunkSize)
+            stage.add(rows=len(lines))
+
+    def _formatRegions(self):
+        common = ("width={s.width:d} dash={s.dash:1d} "
+                  "edit={s.can_edit:d} move={s.can_move:d} "
+                  "rotate={s.can_rotate:d} delete={s.can_delete:d} "
+                  "tag={s.tag}").format(s=self)
+        fmt1 = self.coordsys + "; point %r %r # point=" + str(self.symbol) + " " + common + " %s color={%s} id=%s;\n"
+        fmt2 = self.coordsys + "; ellipse(%r,%r,%r,%r,%r) # " + common + " %s color={%s} id=%s;\n"
+        x, y = self._extractColumns("centroid", ("x", "y"))
+        good = numpy.isfinite(x) & numpy.isfinite(y)
+        ids, = self._extractColumns("id", ())
+        if self.text is not None:
+            texts, = self._extractColumns("text", ())
+            texts = numpy.array(['text="{}"'.format(t) for t in texts])
+        else:
+            texts = numpy.array([""]*len(x))
         if isinstance(self._color, basestring):
-            colors = itertools.repeat(self._color)
+            colors = numpy.array([self._color]*len(x))
         else:
-            colors = itertools.imap(rgba2hex, self._color(self.catalog))
-        lsst.afw.display.ds9.ds9Cmd(lsst.afw.display.ds9.selectFrame(self.frame))
-        xpa_cmd = "xpaset {0} regions".format(
-            lsst.afw.display.ds9.getXpaAccessPoint(), self.coordsys
-        )
-        pfd = os.popen(xpa_cmd, "w")
-        try:
-            for record, color in itertools.izip(self.catalog, colors):
-                x, y = self.centroid(record)
-                if not numpy.isfinite(x) or not numpy.isfinite(y):
-                    continue
-                id = self.id(record)
-                text = 'text="{}"'.format(self.text(record)) if self.text is not None else ""
-                if self.symbol is not None:
-                    line = fmt1.format(s=self, x=x, y=y, color=color, text=text, id=id)
-                    pfd.write(line)
-                    text = ""   # if we're plotting a symbol and an ellipse, only label one of them
-                if self.ellipse is not None:
-                    axes = lsst.afw.geom.ellipses.Axes(self.ellipse(record))
-                    a = axes.getA()
-                    b = axes.getB()
-                    theta = lsst.afw.geom.radToDeg(axes.getTheta())
-                    if not numpy.isfinite(a) or not numpy.isfinite(b) or not numpy.isfinite(theta):
-                        continue
-                    line = fmt2.format(s=self, x=x, y=y, color=color, text=text, id=id,
-                                       a=axes.getA(), b=axes.getB(), theta=theta)
-                    pfd.write(line)
-        finally:
-            pfd.close()
+            colors = numpy.array(rgbaToHex(self._color(self.catalog)))
+        lines = []
+        if self.symbol is not None:
+            rows = numpy.flatnonzero(good)
+            lines.extend(fmt1 % (x[i], y[i], texts[i], colors[i], ids[i]) for i in rows)
+            texts = numpy.array([""]*len(x))   # if we're plotting a symbol and an ellipse, only label one of them
+        if self.ellipse is not None:
+            if "ellipse" in self._fields:
+                xx, yy, xy = self._extractColumns("ellipse", ("xx", "yy", "xy"))
+            else:
+                quadrupoles = [lsst.afw.geom.ellipses.Quadrupole(self.ellipse(record)) for record in self.catalog]
+                xx = numpy.array([q.getIxx() for q in quadrupoles])
+                yy = numpy.array([q.getIyy() for q in quadrupoles])
+                xy = numpy.array([q.getIxy() for q in quadrupoles])
+            a, b, theta = quadrupoleToAxes(xx, yy, xy)
+            theta = numpy.degrees(theta)
+            rows = numpy.flatnonzero(good & numpy.isfinite(a) & numpy.isfinite(b) & numpy.isfinite(theta))
+            lines.extend(fmt2 % (x[i], y[i], a[i], b[i], theta[i], texts[i], colors[i], ids[i]) for i in rows)
+        return lines
 
     def hide(self):
         lsst.afw.display.ds9Cmd("regions group {} delete".format(self.tag))
@@ -152,16 +188,25 @@ class CatalogView(object):
     def select(self):
         lsst.afw.display.ds9Cmd("regions group {} select".format(self.tag))
 
+    def _getIdIndex(self):
+        # Built on first use and kept, unless the catalog has since been replaced or resized.
+        if (self._idIndex is None or self._idIndex[0] is not self.catalog
+                or self._idIndex[1] != len(self.catalog)):
+            self._idIndex = (self.catalog, len(self.catalog), makeIdIndex(self.catalog))
+        return self._idIndex[2]
+
     def inspect(self):
         regex = re.compile("id=(\d+)")
-        records = []
+        ids = []
         for line in lsst.afw.display.ds9Cmd("regions selected".format(self.tag), get=True).split("\n"):
             m = regex.search(line)
             if m:
                 print "yes: ", line
-                records.append(self.catalog.find(int(m.group(1))))
+                ids.append(int(m.group(1)))
             else:
                 print "no: ", line
+        rows = self._getIdIndex().lookup(ids)
+        records = [self.catalog[int(row)] for row in rows if row >= 0]
         if len(records) == 1:
             return records[0]
         elif len(records) == 0:
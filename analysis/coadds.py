@@ -0,0 +1,161 @@
+import collections
+import threading
+import logging
+
+from .instrument import NULL_INSTRUMENT
+
+log = logging.getLogger(__name__)
+
+# Default byte budget for CoaddCache: a few full-depth HSC patches in five bands.
+DEFAULT_MAX_BYTES = 4*1024**3
+
+
+def exposureBytes(exposure):
+    """Return the number of bytes in the pixel arrays of an Exposure."""
+    mi = exposure.getMaskedImage()
+    return sum(image.getArray().nbytes for image in (mi.getImage(), mi.getMask(), mi.getVariance()))
+
+
+def neighbourPatches(patch, radius=1):
+    """Return the "x,y" names of the patches within ``radius`` of a patch (excluding itself)."""
+    x, y = (int(v) for v in patch.split(","))
+    return ["%d,%d" % (x + dx, y + dy)
+            for dy in xrange(-radius, radius + 1) for dx in xrange(-radius, radius + 1)
+            if (dx or dy) and x + dx >= 0 and y + dy >= 0]
+
+
+class CoaddCache(object):
+    """A lazily-populated LRU cache of deepCoadd_calexp Exposures.
+
+    Exposures are read from the butler the first time get() asks for them,
+    and the least recently used ones are dropped whenever the total size of
+    their pixels exceeds ``maxBytes`` (the most recent one is always kept,
+    and so are any that have been pinned with pin()).
+
+    If ``onLoad`` is not None, it is called as ``onLoad(filter, tract, patch,
+    exposure)`` on every Exposure as it is read, before it is added to the
+    cache.
+
+    prefetch() queues Exposures to be read by a background thread; get() waits
+    for any that are already being read rather than reading them again.
+
+    Reads are timed as stages of ``instrument``, if given.
+    """
+
+    def __init__(self, butler, maxBytes=DEFAULT_MAX_BYTES, onLoad=None, instrument=None):
+        self.butler = butler
+        self.instrument = instrument if instrument is not None else NULL_INSTRUMENT
+        self.maxBytes = maxBytes
+        self.onLoad = onLoad
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._sizes = {}
+        self._pending = {}
+        self._pinned = frozenset()
+        self._queue = collections.deque()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self, key):
+        b, tract, patch = key
+        dataId = dict(tract=tract, patch=patch)
+        log.debug("Reading deepCoadd_calexp for {}, tract={}, patch={}".format(b, tract, patch))
+        with self.instrument.stage("read.deepCoadd_calexp", dataId, b) as stage:
+            exposure = self.butler.get("deepCoadd_calexp", dataId, immediate=True, filter="HSC-" + b.upper())
+            stage.add(nbytes=exposureBytes(exposure))
+        if self.onLoad is not None:
+            self.onLoad(b, tract, patch, exposure)
+        return exposure
+
+    def _fetch(self, key):
+        # The caller must have registered key in self._pending.
+        try:
+            exposure = self._load(key)
+            size = exposureBytes(exposure)
+            with self._lock:
+                self._entries[key] = exposure
+                self._sizes[key] = size
+                self.nbytes += size
+                self._evict(key)
+            return exposure
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+
+    def _evict(self, newKey):
+        # The caller must hold self._lock.
+        if self.maxBytes is None:
+            return
+        for oldKey in list(self._entries):
+            if self.nbytes <= self.maxBytes:
+                break
+            if oldKey == newKey or oldKey in self._pinned:
+                continue
+            del self._entries[oldKey]
+            self.nbytes -= self._sizes.pop(oldKey)
+            log.debug("Dropping deepCoadd_calexp for {} from cache".format(oldKey))
+
+    def pin(self, keys):
+        """Never drop the given (filter, tract, patch) Exposures to make room for others.
+
+        Pins replace those of any previous call; ``pin(())`` removes them all.
+        Pinned Exposures still count towards ``maxBytes``.
+        """
+        with self._lock:
+            self._pinned = frozenset(keys)
+
+    def get(self, filter, tract, patch):
+        """Return the coadd Exposure for a band, tract and patch, reading it if necessary."""
+        key = (filter, tract, patch)
+        with self._lock:
+            exposure = self._entries.pop(key, None)
+            if exposure is not None:
+                self._entries[key] = exposure   # now the most recently used
+                return exposure
+            event = self._pending.get(key)
+            if event is None:
+                self._pending[key] = threading.Event()
+        if event is None:
+            return self._fetch(key)
+        event.wait()
+        # The prefetch may have failed, or the entry been evicted already; if so, just try again.
+        return self.get(filter, tract, patch)
+
+    def prefetch(self, keys):
+        """Start reading the given (filter, tract, patch) Exposures in a background thread."""
+        with self._lock:
+            for key in keys:
+                if key not in self._entries and key not in self._pending:
+                    self._pending[key] = threading.Event()
+                    self._queue.append(key)
+            if self._queue and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._prefetchLoop, name="CoaddCache.prefetch")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _prefetchLoop(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._thread = None
+                    return
+                key = self._queue.popleft()
+            try:
+                self._fetch(key)
+            except Exception as err:
+                log.warning("Failed to prefetch deepCoadd_calexp for {}: {}".format(key, err))
+
+    def clear(self):
+        """Drop all cached Exposures (prefetches already in progress still complete)."""
+        with self._lock:
+            while self._queue:
+                self._pending.pop(self._queue.popleft()).set()
+            self._entries.clear()
+            self._sizes.clear()
+            self.nbytes = 0
@@ -0,0 +1,159 @@
+"""Compact in-memory representations of catalog columns.
+
+With ``ObjectCatalog.read(..., compact=True)``, float64 columns matching
+COMPACT_FLOATS are stored as float32, boolean columns are packed into one
+uint64 bitfield array per band (or other top-level group), and tract and
+patch are stored as small integer codes.  Packed and coded columns are held
+by ColumnAttributeProxy as EncodedColumns, which are decoded (for just the
+selected rows) whenever their value is accessed.
+"""
+
+import abc
+import fnmatch
+import numpy
+
+# Glob patterns for the float columns stored as float32 in compact mode; coordinates and
+# centroids keep full precision.
+COMPACT_FLOATS = ("*flux*", "*mag*", "*.shape.*", "*ellipse*", "*.cmodel.*", "*classification*",
+                  "*blendedness*")
+
+
+class EncodedColumn(object):
+    """Base class for columns that are stored in some encoded form and decoded on access."""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+    @abc.abstractproperty
+    def nbytes(self):
+        """The number of bytes of encoded storage held for this column."""
+        pass
+
+    @abc.abstractmethod
+    def decode(self, index=None):
+        """Return the decoded values of the given rows (all rows if None)."""
+        pass
+
+    @abc.abstractmethod
+    def select(self, index, memo):
+        """Return an EncodedColumn holding only the given rows.
+
+        ``memo`` is a dict shared by all columns of a catalog being copied,
+        so columns sharing storage can keep doing so.
+        """
+        pass
+
+
+class PackedFlag(EncodedColumn):
+    """A boolean column stored as one bit of a 2-d uint64 array shared with other flags."""
+
+    def __init__(self, words, word, bit):
+        self.words = words
+        self.word = word
+        self.bit = bit
+
+    def __len__(self):
+        return len(self.words)
+
+    @property
+    def nbytes(self):
+        return len(self.words)//8
+
+    def decode(self, index=None):
+        column = self.words[:, self.word] if index is None else self.words[index, self.word]
+        return (column >> numpy.uint64(self.bit)) & numpy.uint64(1) != 0
+
+    def select(self, index, memo):
+        words = memo.get(id(self.words))
+        if words is None:
+            words = memo[id(self.words)] = self.words[index].copy()
+        return PackedFlag(words, self.word, self.bit)
+
+
+class Categorical(EncodedColumn):
+    """A column stored as integer codes into an array of distinct values."""
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def decode(self, index=None):
+        return self.categories[self.codes if index is None else self.codes[index]]
+
+    def select(self, index, memo):
+        codes = memo.get(id(self.codes))
+        if codes is None:
+            codes = memo[id(self.codes)] = self.codes[index].copy()
+        return Categorical(codes, self.categories)
+
+
+def codeDtype(n):
+    """Return the smallest unsigned integer dtype that can hold codes for ``n`` categories."""
+    for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+        if n <= numpy.iinfo(dtype).max + 1:
+            return numpy.dtype(dtype)
+    return numpy.dtype(numpy.uint64)
+
+
+class ColumnCompactor(object):
+    """Compact the columns of successive patches for assembly into a single catalog.
+
+    Calling a compactor on a dict of patch columns downcasts the float64
+    columns that match ``floats`` (glob patterns over dotted column names)
+    to float32, and replaces all of the boolean columns with a uint64 array
+    of shape (rows, words) per top-level group, under a placeholder key.
+    Every patch must have the same boolean columns.  Once the patches have
+    been assembled, expand() replaces each placeholder with PackedFlag
+    columns for the individual flags.
+    """
+
+    def __init__(self, floats=COMPACT_FLOATS):
+        self.floats = tuple(floats)
+        self.layouts = None
+
+    def _isCompactFloat(self, key, column):
+        if column.dtype != numpy.float64:
+            return False
+        name = ".".join(key)
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.floats)
+
+    def __call__(self, columns):
+        flags = {}
+        result = {}
+        for key, column in columns.iteritems():
+            if isinstance(column, numpy.ndarray) and column.dtype == bool and column.ndim == 1:
+                flags.setdefault(key[0], []).append(key)
+            elif isinstance(column, numpy.ndarray) and self._isCompactFloat(key, column):
+                result[key] = column.astype(numpy.float32)
+            else:
+                result[key] = column
+        layouts = {group: sorted(keys) for group, keys in flags.iteritems()}
+        if self.layouts is None:
+            self.layouts = layouts
+        elif layouts != self.layouts:
+            raise ValueError("Patches have different flag columns")
+        for group, keys in layouts.iteritems():
+            size = len(columns[keys[0]])
+            words = numpy.zeros((size, (len(keys) + 63)//64), dtype=numpy.uint64)
+            for n, key in enumerate(keys):
+                words[:, n//64] |= columns[key].astype(numpy.uint64) << numpy.uint64(n % 64)
+            result[(group, "__flags__")] = words
+        return result
+
+    def expand(self, columns):
+        """Replace the packed flag arrays of an assembled dict of columns with PackedFlag columns."""
+        for group, keys in (self.layouts or {}).iteritems():
+            words = columns.pop((group, "__flags__"))
+            for n, key in enumerate(keys):
+                columns[key] = PackedFlag(words, n//64, n % 64)
+        return columns
@@ -1,10 +1,13 @@
 import collections
-import lsst.afw.geom.ellipses
+import numpy
 import lsst.afw.display.ds9
 
+from .footprints import FootprintArray
+from .regions import quadrupoleToAxes, ellipseRegions, lineRegions, pointRegions, textRegions, sendRegions
+
 class CoaddDisplay(object):
 
-    def __init__(self, objs, tract=None, patch=None, frames=None, frame0=0):
+    def __init__(self, objs, tract=None, patch=None, frames=None, frame0=0, prefetch=False):
         if frames is None:
             self.frames = collections.OrderedDict([(b, n + frame0) for n, b in enumerate(objs.filters)])
         elif isinstance(frames, collections.Mapping):
@@ -12,7 +15,12 @@ class CoaddDisplay(object):
         elif isinstance(frames, collections.Sequence):
             self.frames = collections.OrderedDict(zip(filters, frames))
         self.objs = objs
+        self.instrument = objs.instrument
         self.coadds = {}
+        if prefetch:
+            # a single background thread reads this patch's bands in turn (pinned in the cache), then
+            # its neighbours'; the loop below waits for each band as it arrives
+            objs.prefetchCoadds(tract, patch)
         for b in objs.filters:
             self.coadds[b] = objs.coadd(b, tract=tract, patch=patch)
             self.xy0 = self.coadds[b].getXY0()
@@ -20,108 +28,101 @@ class CoaddDisplay(object):
     def images(self):
         lsst.afw.display.setMaskTransparency(80.0)
         for b, frame in self.frames.iteritems():
-            lsst.afw.display.ds9.mtv(self.coadds[b], frame=frame)
-            lsst.afw.display.ds9Cmd("scale limits -0.5 5.0")
+            with self.instrument.stage("display.images", band=b):
+                lsst.afw.display.ds9.mtv(self.coadds[b], frame=frame)
+                lsst.afw.display.ds9Cmd("scale limits -0.5 5.0")
         lsst.afw.display.ds9Cmd("lock frame image")
         lsst.afw.display.ds9Cmd("lock scale")
 
+    def _clear(self, frame):
+        lsst.afw.display.ds9Cmd("frame {}".format(frame))
+        lsst.afw.display.ds9Cmd("regions delete all")
+
+    def _draw(self, name, clear, makeRegions):
+        """Send the regions returned by makeRegions(b) to the frame for each band b."""
+        for b, frame in self.frames.iteritems():
+            with self.instrument.stage("display." + name, band=b) as stage:
+                if clear:
+                    self._clear(frame)
+                regions = makeRegions(b)
+                sendRegions(frame, regions)
+                stage.add(rows=len(regions))
+
+    def _position(self, objs, b):
+        """Return the centroids of objs in band b, in ds9's 1-indexed coordinates for the coadd frame."""
+        x = getattr(objs, b).meas.centroid.sdss.x.value - self.xy0.getX() + 1
+        y = getattr(objs, b).meas.centroid.sdss.y.value - self.xy0.getY() + 1
+        return x, y
+
     def cmodel(self, objs=None, clear=True, fitRegions=False):
         if objs is None:
             objs = self.objs
-        for b, frame in self.frames.iteritems():
-            if clear:
-                lsst.afw.display.ds9Cmd("frame {}".format(frame))
-                lsst.afw.display.ds9Cmd("regions delete all")
-            eI = getattr(objs, b).meas.cmodel.initial.ellipse
-            eF = getattr(objs, b).meas.cmodel.ellipse
-            if fitRegions:
-                eRI = getattr(objs, b).meas.cmodel.region.initial.ellipse
-                eRF = getattr(objs, b).meas.cmodel.region.final.ellipse
-            x = getattr(objs, b).meas.centroid.sdss.x.value
-            y = getattr(objs, b).meas.centroid.sdss.y.value
-            with lsst.afw.display.Buffering():
-                for i in xrange(len(objs)):
-                    qI = lsst.afw.geom.ellipses.Quadrupole(eI.xx.value[i], eI.yy.value[i], eI.xy.value[i])
-                    qF = lsst.afw.geom.ellipses.Quadrupole(eF.xx.value[i], eF.yy.value[i], eF.xy.value[i])
-                    lsst.afw.display.ds9.dot(
-                        qI, x[i]-self.xy0.getX(), y[i]-self.xy0.getY(),
-                        ctype='yellow', frame=frame
-                    )
-                    lsst.afw.display.ds9.dot(
-                        qF, x[i]-self.xy0.getX(), y[i]-self.xy0.getY(),
-                        ctype='green', frame=frame
-                    )
-                    if fitRegions:
-                        qRI = lsst.afw.geom.ellipses.Quadrupole(eRI.xx.value[i], eRI.yy.value[i], eRI.xy.value[i])
-                        qRF = lsst.afw.geom.ellipses.Quadrupole(eRF.xx.value[i], eRF.yy.value[i], eRF.xy.value[i])
-                        lsst.afw.display.ds9.dot(
-                            qRI, x[i]-self.xy0.getX(), y[i]-self.xy0.getY(),
-                            ctype='magenta', frame=frame
-                        )
-                        lsst.afw.display.ds9.dot(
-                            qRF, x[i]-self.xy0.getX(), y[i]-self.xy0.getY(),
-                            ctype='blue', frame=frame
-                        )
+        ellipses = [("initial.ellipse", "yellow"), ("ellipse", "green")]
+        if fitRegions:
+            ellipses += [("region.initial.ellipse", "magenta"), ("region.final.ellipse", "blue")]
 
+        def makeRegions(b):
+            x, y = self._position(objs, b)
+            regions = []
+            for path, color in ellipses:
+                e = getattr(objs, b).meas.cmodel
+                for name in path.split("."):
+                    e = getattr(e, name)
+                a, bb, theta = quadrupoleToAxes(e.xx.value, e.yy.value, e.xy.value)
+                regions.extend(ellipseRegions(x, y, a, bb, theta, "color=" + color))
+            return regions
+
+        self._draw("cmodel", clear, makeRegions)
 
     def footprints(self, objs=None, clear=True):
         if objs is None:
             objs = self.objs
-        for b, frame in self.frames.iteritems():
-            if clear:
-                lsst.afw.display.ds9Cmd("frame {}".format(frame))
-                lsst.afw.display.ds9Cmd("regions delete all")
-            fps = getattr(objs, b).footprint
-            with lsst.afw.display.Buffering():
-                for i in xrange(len(objs)):
-                    lsst.afw.display.utils.drawFootprint(fps.value[i], XY0=self.xy0, ctype="cyan",
-                                                         peaks=True, ctypePeak="cyan", frame=frame)
 
+        def makeRegions(b):
+            fps = getattr(objs, b).footprint.value
+            if not isinstance(fps, FootprintArray):
+                fps = FootprintArray.fromFootprints(fps)
+            # spans are drawn as lines covering the full width of their pixels, as in drawFootprint
+            y = fps.spanY - self.xy0.getY() + 1.0
+            regions = lineRegions(fps.spanX0 - self.xy0.getX() + 0.5, y,
+                                  fps.spanX1 - self.xy0.getX() + 1.5, y, "color=cyan")
+            regions.extend(pointRegions(fps.peakX - self.xy0.getX() + 1.0, fps.peakY - self.xy0.getY() + 1.0,
+                                        "point=cross color=cyan"))
+            return regions
+
+        self._draw("footprints", clear, makeRegions)
 
     def kron(self, objs=None, clear=True, radiusForRadius=False):
         if objs is None:
             objs = self.objs
-        for b, frame in self.frames.iteritems():
-            if clear:
-                lsst.afw.display.ds9Cmd("frame {}".format(frame))
-                lsst.afw.display.ds9Cmd("regions delete all")
+
+        def makeRegions(b):
             shape = getattr(objs, b).meas.shape.sdss
             r1 = getattr(objs, b).meas.flux.kron.radius.value
             r2 = getattr(objs, b).meas.flux.kron.radiusForRadius.value
-            x = getattr(objs, b).meas.centroid.sdss.x.value
-            y = getattr(objs, b).meas.centroid.sdss.y.value
-            with lsst.afw.display.Buffering():
-                for i in xrange(len(objs)):
-                    ellipse = lsst.afw.geom.ellipses.Quadrupole(
-                        shape.xx.value[i],
-                        shape.yy.value[i],
-                        shape.xy.value[i]
-                    )
-                    r0 = ellipse.getDeterminantRadius()
-                    ellipse.scale(float(r1[i]/r0))
-                    lsst.afw.display.ds9.dot(
-                        ellipse, x[i]-self.xy0.getX(), y[i]-self.xy0.getY(),
-                        ctype='orange', frame=frame
-                    )
-                    if radiusForRadius:
-                        ellipse.scale(float(r2[i]/r1[i]))
-                        lsst.afw.display.ds9.dot(
-                            ellipse, x[i]-self.xy0.getX(), y[i]-self.xy0.getY(),
-                            ctype='red', frame=frame
-                        )
-
-    def annotate(self, objs):
+            x, y = self._position(objs, b)
+            a, bb, theta = quadrupoleToAxes(shape.xx.value, shape.yy.value, shape.xy.value)
+            # rescale the shape so its determinant radius is the Kron radius
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                scale = r1/numpy.sqrt(a*bb)
+            regions = ellipseRegions(x, y, a*scale, bb*scale, theta, "color=orange")
+            if radiusForRadius:
+                with numpy.errstate(invalid="ignore", divide="ignore"):
+                    scale *= r2/r1
+                regions.extend(ellipseRegions(x, y, a*scale, bb*scale, theta, "color=red"))
+            return regions
+
+        self._draw("kron", clear, makeRegions)
+
+    def annotate(self, objs=None):
         if objs is None:
             objs = self.objs
-        for b, frame in self.frames.iteritems():
+
+        def makeRegions(b):
             psfMag = getattr(objs, b).meas.mag.psf.value
             cmodelMag = getattr(objs, b).meas.cmodel.mag.value
-            x = getattr(objs, b).meas.centroid.sdss.x.value
-            y = getattr(objs, b).meas.centroid.sdss.y.value
-            for i in xrange(len(objs)):
-                with lsst.afw.display.Buffering():
-                    lsst.afw.display.ds9.dot(
-                        "    psf={psf}, cmodel={cmodel}".format(psf=psfMag[i], cmodel=cmodelMag[i]),
-                        x[i] - self.xy0.getX(), y[i] - self.xy0.getY(),
-                        ctype='red', frame=frame
-                    )
\ No newline at end of file
+            x, y = self._position(objs, b)
+            texts = ["    psf={psf}, cmodel={cmodel}".format(psf=p, cmodel=c) for p, c in zip(psfMag, cmodelMag)]
+            return textRegions(x, y, texts, "color=red")
+
+        self._draw("annotate", False, makeRegions)
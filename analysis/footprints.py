@@ -0,0 +1,334 @@
+import numpy
+import lsst.afw.detection
+
+# Names of the arrays that make up a FootprintArray, in the order they're saved.
+SPAN_ARRAYS = ("spanY", "spanX0", "spanX1", "spanOffsets")
+PEAK_ARRAYS = ("peakX", "peakY", "peakValue", "peakOffsets")
+HEAVY_ARRAYS = ("image", "mask", "variance", "pixelOffsets")
+
+# Key suffix used to store FootprintArrays in plain dicts of arrays; see packFootprintColumns.
+PACKED_PREFIX = "__footprint."
+
+
+def _gather(offsets, rows):
+    """Given per-row offsets into a flat array, return the offsets and flat
+    indices for the concatenation of the given rows."""
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    newOffsets = numpy.zeros(len(starts) + 1, dtype=offsets.dtype)
+    numpy.cumsum(counts, out=newOffsets[1:])
+    flat = numpy.arange(newOffsets[-1]) - numpy.repeat(newOffsets[:-1] - starts, counts)
+    return newOffsets, flat
+
+
+class FootprintArray(object):
+    """A columnar store for the Footprints of many objects.
+
+    Spans for all rows are concatenated into flat ``spanY``, ``spanX0`` and
+    ``spanX1`` arrays (with inclusive x ranges, as in afw), and row ``i`` owns
+    spans ``spanOffsets[i]:spanOffsets[i+1]``; peaks are stored the same way.
+    For HeavyFootprints, the image, mask and variance values are stored in
+    flat arrays in span order, indexed by ``pixelOffsets``.  A heavy
+    FootprintArray may also hold plain Footprints (e.g. those of isolated
+    objects and deblend parents): their rows have no pixel values.
+
+    Indexing with an integer returns an afw Footprint (or HeavyFootprint);
+    indexing with a slice, boolean mask or index array returns a new
+    FootprintArray, so this can be used as a column of a ColumnAttributeProxy.
+    """
+
+    def __init__(self, spanY, spanX0, spanX1, spanOffsets, peakX, peakY, peakValue, peakOffsets,
+                 image=None, mask=None, variance=None, pixelOffsets=None):
+        self.spanY = spanY
+        self.spanX0 = spanX0
+        self.spanX1 = spanX1
+        self.spanOffsets = spanOffsets
+        self.peakX = peakX
+        self.peakY = peakY
+        self.peakValue = peakValue
+        self.peakOffsets = peakOffsets
+        self.image = image
+        self.mask = mask
+        self.variance = variance
+        self.pixelOffsets = pixelOffsets
+
+    @property
+    def isHeavy(self):
+        return self.image is not None
+
+    @classmethod
+    def empty(cls, size, heavy=False):
+        """Return a FootprintArray with ``size`` rows, all with empty Footprints."""
+        zi = numpy.zeros(0, dtype=numpy.int32)
+        zf = numpy.zeros(0, dtype=numpy.float32)
+        offsets = numpy.zeros(size + 1, dtype=numpy.int64)
+        if heavy:
+            return cls(zi, zi, zi, offsets, zi, zi, zf, offsets,
+                       zf, numpy.zeros(0, dtype=numpy.uint16), zf, offsets)
+        return cls(zi, zi, zi, offsets, zi, zi, zf, offsets)
+
+    @classmethod
+    def fromFootprints(cls, footprints, heavy=False):
+        """Build from a sequence of afw Footprints.
+
+        If ``heavy`` is True, the pixel values of any HeavyFootprintFs are kept
+        too; other Footprints get empty pixel ranges.
+        """
+        spanY = []
+        spanX0 = []
+        spanX1 = []
+        spanCounts = []
+        peakX = []
+        peakY = []
+        peakValue = []
+        peakCounts = []
+        images = []
+        masks = []
+        variances = []
+        for fp in footprints:
+            spans = fp.getSpans()
+            spanCounts.append(len(spans))
+            for span in spans:
+                spanY.append(span.getY())
+                spanX0.append(span.getX0())
+                spanX1.append(span.getX1())
+            peaks = fp.getPeaks()
+            peakCounts.append(len(peaks))
+            for peak in peaks:
+                peakX.append(peak.getIx())
+                peakY.append(peak.getIy())
+                peakValue.append(peak.getPeakValue())
+            if heavy and fp.isHeavy():
+                fp = lsst.afw.detection.HeavyFootprintF.cast(fp)
+                images.append(numpy.array(fp.getImageArray(), dtype=numpy.float32))
+                masks.append(numpy.array(fp.getMaskArray(), dtype=numpy.uint16))
+                variances.append(numpy.array(fp.getVarianceArray(), dtype=numpy.float32))
+            elif heavy:
+                images.append(numpy.zeros(0, dtype=numpy.float32))
+                masks.append(numpy.zeros(0, dtype=numpy.uint16))
+                variances.append(numpy.zeros(0, dtype=numpy.float32))
+
+        def offsets(counts):
+            result = numpy.zeros(len(counts) + 1, dtype=numpy.int64)
+            numpy.cumsum(counts, out=result[1:])
+            return result
+
+        def concat(arrays, dtype):
+            return numpy.concatenate(arrays).astype(dtype) if arrays else numpy.zeros(0, dtype=dtype)
+
+        result = cls(
+            numpy.array(spanY, dtype=numpy.int32), numpy.array(spanX0, dtype=numpy.int32),
+            numpy.array(spanX1, dtype=numpy.int32), offsets(spanCounts),
+            numpy.array(peakX, dtype=numpy.int32), numpy.array(peakY, dtype=numpy.int32),
+            numpy.array(peakValue, dtype=numpy.float32), offsets(peakCounts),
+        )
+        if heavy:
+            result.image = concat(images, numpy.float32)
+            result.mask = concat(masks, numpy.uint16)
+            result.variance = concat(variances, numpy.float32)
+            result.pixelOffsets = offsets([len(image) for image in images])
+        return result
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Concatenate several FootprintArrays row-wise.
+
+        If any of them are heavy, so is the result; the rows of the others get
+        empty pixel ranges.
+        """
+        parts = list(parts)
+        heavy = any(part.isHeavy for part in parts)
+        if heavy:
+            parts = [part if part.isHeavy else part.withEmptyPixels() for part in parts]
+
+        def offsets(name):
+            result = [numpy.zeros(1, dtype=numpy.int64)]
+            total = 0
+            for part in parts:
+                o = getattr(part, name)
+                result.append(o[1:] - o[0] + total)
+                total += o[-1] - o[0]
+            return numpy.concatenate(result)
+
+        def concat(name):
+            return numpy.concatenate([getattr(part, name) for part in parts])
+
+        result = cls(concat("spanY"), concat("spanX0"), concat("spanX1"), offsets("spanOffsets"),
+                     concat("peakX"), concat("peakY"), concat("peakValue"), offsets("peakOffsets"))
+        if heavy:
+            result.image = concat("image")
+            result.mask = concat("mask")
+            result.variance = concat("variance")
+            result.pixelOffsets = offsets("pixelOffsets")
+        return result
+
+    def withEmptyPixels(self):
+        """Return a heavy FootprintArray sharing these spans and peaks, with no pixel values in any row."""
+        zf = numpy.zeros(0, dtype=numpy.float32)
+        return type(self)(self.spanY, self.spanX0, self.spanX1, self.spanOffsets,
+                          self.peakX, self.peakY, self.peakValue, self.peakOffsets,
+                          zf, numpy.zeros(0, dtype=numpy.uint16), zf,
+                          numpy.zeros(len(self) + 1, dtype=numpy.int64))
+
+    def getArrays(self):
+        """Return a dict of the arrays that make up this FootprintArray."""
+        names = SPAN_ARRAYS + PEAK_ARRAYS + (HEAVY_ARRAYS if self.isHeavy else ())
+        return {name: getattr(self, name) for name in names}
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        return cls(**arrays)
+
+    def __len__(self):
+        return len(self.spanOffsets) - 1
+
+    def __repr__(self):
+        return "FootprintArray({} rows, {} spans{})".format(
+            len(self), len(self.spanY), ", heavy" if self.isHeavy else "")
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.getArrays().itervalues())
+
+    @property
+    def spanWidth(self):
+        return self.spanX1 - self.spanX0 + 1
+
+    def getArea(self):
+        """Return the number of pixels in each Footprint."""
+        cumulative = numpy.zeros(len(self.spanY) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.spanWidth, out=cumulative[1:])
+        return cumulative[self.spanOffsets[1:]] - cumulative[self.spanOffsets[:-1]]
+
+    def getBBox(self):
+        """Return (minX, minY, maxX, maxY) arrays of inclusive bounding box corners.
+
+        Empty Footprints have minX = minY = 0 and maxX = maxY = -1.
+        """
+        counts = numpy.diff(self.spanOffsets)
+        nonEmpty = counts > 0
+        starts = self.spanOffsets[:-1][nonEmpty]
+        result = (numpy.zeros(len(self), dtype=numpy.int32), numpy.zeros(len(self), dtype=numpy.int32),
+                  numpy.full(len(self), -1, dtype=numpy.int32), numpy.full(len(self), -1, dtype=numpy.int32))
+        if len(starts):
+            result[0][nonEmpty] = numpy.minimum.reduceat(self.spanX0, starts)
+            result[1][nonEmpty] = numpy.minimum.reduceat(self.spanY, starts)
+            result[2][nonEmpty] = numpy.maximum.reduceat(self.spanX1, starts)
+            result[3][nonEmpty] = numpy.maximum.reduceat(self.spanY, starts)
+        return result
+
+    def getRowIndices(self):
+        """Return the row index for every span."""
+        return numpy.repeat(numpy.arange(len(self)), numpy.diff(self.spanOffsets))
+
+    def getFootprint(self, i):
+        """Return row ``i`` as an afw Footprint (a HeavyFootprintF if it has pixel values)."""
+        fp = lsst.afw.detection.Footprint()
+        for n in xrange(self.spanOffsets[i], self.spanOffsets[i+1]):
+            fp.addSpan(int(self.spanY[n]), int(self.spanX0[n]), int(self.spanX1[n]))
+        for n in xrange(self.peakOffsets[i], self.peakOffsets[i+1]):
+            fp.addPeak(float(self.peakX[n]), float(self.peakY[n]), float(self.peakValue[n]))
+        if not self.isHeavy or self.pixelOffsets[i] == self.pixelOffsets[i+1]:
+            return fp
+        heavy = lsst.afw.detection.HeavyFootprintF(fp)
+        pixels = slice(self.pixelOffsets[i], self.pixelOffsets[i+1])
+        heavy.getImageArray()[:] = self.image[pixels]
+        heavy.getMaskArray()[:] = self.mask[pixels]
+        heavy.getVarianceArray()[:] = self.variance[pixels]
+        return heavy
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.getFootprint(i)
+
+    def __getitem__(self, k):
+        if isinstance(k, (int, long, numpy.integer)):
+            if k < 0:
+                k += len(self)
+            return self.getFootprint(k)
+        rows = numpy.arange(len(self))[k]
+        spanOffsets, spans = _gather(self.spanOffsets, rows)
+        peakOffsets, peaks = _gather(self.peakOffsets, rows)
+        result = type(self)(self.spanY[spans], self.spanX0[spans], self.spanX1[spans], spanOffsets,
+                            self.peakX[peaks], self.peakY[peaks], self.peakValue[peaks], peakOffsets)
+        if self.isHeavy:
+            pixelOffsets, pixels = _gather(self.pixelOffsets, rows)
+            result.image = self.image[pixels]
+            result.mask = self.mask[pixels]
+            result.variance = self.variance[pixels]
+            result.pixelOffsets = pixelOffsets
+        return result
+
+    def copy(self):
+        return type(self).fromArrays({name: array.copy() for name, array in self.getArrays().iteritems()})
+
+
+def paintSpans(array, spanY, spanX0, spanX1, bits, xy0=(0, 0)):
+    """Bitwise-OR ``bits`` into every pixel of a 2-d integer array covered by a set of spans.
+
+    Span coordinates are in the parent frame of an image whose origin is at
+    ``xy0``; spans are clipped to the array's bounds, as in
+    lsst.afw.detection.setMaskFromFootprint.
+    """
+    height, width = array.shape
+    y = numpy.asarray(spanY, dtype=numpy.int64) - xy0[1]
+    x0 = numpy.maximum(numpy.asarray(spanX0, dtype=numpy.int64) - xy0[0], 0)
+    x1 = numpy.minimum(numpy.asarray(spanX1, dtype=numpy.int64) - xy0[0], width - 1)
+    keep = (y >= 0) & (y < height) & (x0 <= x1)
+    y = y[keep]
+    x0 = x0[keep]
+    widths = x1[keep] - x0 + 1
+    if not len(widths):
+        return
+    starts = numpy.zeros(len(widths), dtype=numpy.int64)
+    numpy.cumsum(widths[:-1], out=starts[1:])
+    xs = numpy.arange(widths.sum()) - numpy.repeat(starts - x0, widths)
+    ys = numpy.repeat(y, widths)
+    array[ys, xs] |= bits
+
+
+def setMaskFromFootprints(mask, footprints, bits, rows=None):
+    """Set ``bits`` in an afw Mask for all pixels in a set of Footprints at once.
+
+    ``footprints`` may be a FootprintArray or a sequence of afw Footprints;
+    ``rows`` optionally selects a subset of them (e.g. deblended children).
+    The result is identical to calling lsst.afw.detection.setMaskFromFootprint
+    for each Footprint in turn.
+    """
+    if not isinstance(footprints, FootprintArray):
+        footprints = FootprintArray.fromFootprints(footprints)
+    if rows is not None:
+        footprints = footprints[rows]
+    xy0 = mask.getXY0()
+    paintSpans(mask.getArray(), footprints.spanY, footprints.spanX0, footprints.spanX1, bits,
+               xy0=(xy0.getX(), xy0.getY()))
+
+
+def packFootprintColumns(columns):
+    """Return a copy of a dict of columns with FootprintArray values replaced by their arrays.
+
+    The result contains only NumPy arrays, so it can be cached or shipped
+    between processes; unpackFootprintColumns reverses this.
+    """
+    result = {}
+    for key, value in columns.iteritems():
+        if isinstance(value, FootprintArray):
+            for name, array in value.getArrays().iteritems():
+                result[key + (PACKED_PREFIX + name,)] = array
+        else:
+            result[key] = value
+    return result
+
+
+def unpackFootprintColumns(columns):
+    """Reverse packFootprintColumns."""
+    result = {}
+    packed = {}
+    for key, value in columns.iteritems():
+        if key and key[-1].startswith(PACKED_PREFIX):
+            packed.setdefault(key[:-1], {})[key[-1][len(PACKED_PREFIX):]] = value
+        else:
+            result[key] = value
+    for key, arrays in packed.iteritems():
+        result[key] = FootprintArray.fromArrays(arrays)
+    return result
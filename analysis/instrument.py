@@ -0,0 +1,199 @@
+"""Per-stage timing and size instrumentation for the loaders and displays.
+
+Code under instrumentation wraps each unit of work in a stage::
+
+    with instrument.stage("extract", dataId=dataId, band=b) as stage:
+        ...
+        stage.add(nbytes=..., rows=...)
+
+The default instrument, NULL_INSTRUMENT, does nothing (and its stages cost a
+method call and an attribute lookup).  A Recorder times every stage and hands
+the resulting events to its sinks: SummarySink (totals in memory),
+JsonLinesSink (one JSON object per event) and ProgressSink (rows/s and ETA
+after each patch).
+"""
+
+import sys
+import json
+import time
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, nbytes=0, rows=0):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Instrument(object):
+    """An instrument that records nothing; also the interface for Recorder."""
+
+    enabled = False
+
+    def stage(self, name, dataId=None, band=None):
+        """Return a context manager that times a stage of work."""
+        return _NULL_STAGE
+
+    def progress(self, done, total, rows):
+        """Report that ``done`` of ``total`` units of work (with ``rows`` rows so far) are complete."""
+        pass
+
+    def replay(self, events):
+        """Pass events recorded elsewhere (e.g. in a worker process) to this instrument's sinks."""
+        pass
+
+
+NULL_INSTRUMENT = Instrument()
+
+
+class _Stage(object):
+
+    def __init__(self, recorder, name, dataId, band):
+        self.recorder = recorder
+        self.event = {"stage": name, "dataId": dataId, "band": band, "bytes": 0, "rows": 0}
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.event["seconds"] = time.time() - self.start
+        self.event["start"] = self.start
+        self.recorder.replay([self.event])
+        return False
+
+    def add(self, nbytes=0, rows=0):
+        """Add to the number of bytes and/or rows processed by this stage."""
+        self.event["bytes"] += int(nbytes)
+        self.event["rows"] += int(rows)
+
+
+class Recorder(Instrument):
+    """An instrument that times stages and sends an event dict for each to its sinks.
+
+    Events have "stage", "dataId", "band", "start" (a Unix time), "seconds",
+    "bytes" and "rows" entries.
+    """
+
+    enabled = True
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    def stage(self, name, dataId=None, band=None):
+        return _Stage(self, name, dataId, band)
+
+    def progress(self, done, total, rows):
+        for sink in self.sinks:
+            sink.progress(done, total, rows)
+
+    def replay(self, events):
+        for event in events:
+            for sink in self.sinks:
+                sink.record(event)
+
+
+class Sink(object):
+    """Base class for Recorder sinks; both methods do nothing by default."""
+
+    def record(self, event):
+        pass
+
+    def progress(self, done, total, rows):
+        pass
+
+
+class BufferSink(Sink):
+    """A sink that just keeps a list of events, e.g. to ship them back from worker processes."""
+
+    def __init__(self):
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+    def flush(self):
+        """Return and forget the buffered events."""
+        events = self.events
+        self.events = []
+        return events
+
+
+class SummarySink(Sink):
+    """Accumulate total time, bytes, rows and call counts in memory.
+
+    Totals are kept per stage name, and per (stage, dataId, band).
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.details = {}
+
+    @staticmethod
+    def _accumulate(totals, key, event):
+        t = totals.setdefault(key, {"calls": 0, "seconds": 0.0, "bytes": 0, "rows": 0})
+        t["calls"] += 1
+        t["seconds"] += event["seconds"]
+        t["bytes"] += event["bytes"]
+        t["rows"] += event["rows"]
+
+    def record(self, event):
+        self._accumulate(self.stages, event["stage"], event)
+        dataId = tuple(sorted(event["dataId"].items())) if event["dataId"] is not None else None
+        self._accumulate(self.details, (event["stage"], dataId, event["band"]), event)
+
+    def report(self, stream=sys.stdout):
+        """Write a table of per-stage totals, slowest first."""
+        stream.write("{:<30} {:>8} {:>10} {:>12} {:>10}\n".format("stage", "calls", "seconds", "MB", "rows"))
+        for name, t in sorted(self.stages.iteritems(), key=lambda item: -item[1]["seconds"]):
+            stream.write("{:<30} {:>8d} {:>10.3f} {:>12.1f} {:>10d}\n".format(
+                name, t["calls"], t["seconds"], t["bytes"]/1024.0**2, t["rows"]))
+
+
+class JsonLinesSink(Sink):
+    """Write each event as a line of JSON to a file (given by name or as an open stream)."""
+
+    def __init__(self, stream):
+        if isinstance(stream, basestring):
+            stream = open(stream, "a")
+        self.stream = stream
+
+    def record(self, event):
+        self.stream.write(json.dumps(event, default=str))
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+class ProgressSink(Sink):
+    """Call ``callback(done, total, rowsPerSecond, eta)`` as work completes.
+
+    ``eta`` is the estimated number of seconds remaining; timing starts with
+    the first (``done == 0``) report.  The default callback writes a line to
+    stderr.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback if callback is not None else self._write
+        self.start = None
+
+    @staticmethod
+    def _write(done, total, rowsPerSecond, eta):
+        sys.stderr.write("{} of {} done, {:.0f} rows/s, {:.0f}s remaining\n".format(
+            done, total, rowsPerSecond, eta))
+
+    def progress(self, done, total, rows):
+        now = time.time()
+        if self.start is None or done == 0:
+            self.start = now
+            return
+        elapsed = now - self.start
+        rowsPerSecond = rows/elapsed if elapsed > 0 else 0.0
+        self.callback(done, total, rowsPerSecond, elapsed*(total - done)/done)
@@ -1,10 +1,29 @@
+import os
+import re
+import copy
+import logging
+import weakref
+import fnmatch
+import collections
+import shutil
+import tempfile
+import multiprocessing
 import numpy
 import operator
 import lsst.afw.table
+import lsst.afw.detection
 from . import display
+from .cache import ColumnCache, PlanCache, fileStamps, schemaDigest
+from .butler_io import countRows, warmFile, CalibProvider
+from .spatial import SkyIndex
+from .source_id import IdIndex, alignIds
+from .footprints import FootprintArray, packFootprintColumns, unpackFootprintColumns, setMaskFromFootprints
+from .coadds import CoaddCache, DEFAULT_MAX_BYTES, neighbourPatches
+from .instrument import NULL_INSTRUMENT, Recorder, BufferSink
+from .pipeline import ReadAhead
+from .compact import EncodedColumn, Categorical, ColumnCompactor, COMPACT_FLOATS, codeDtype
 
-import logging
-logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger(__name__)
 
 # Prefixes for fields to take from the _ref catalog
 REF_PREFIXES = ("id", "coord", "parent", "detect", "merge")
@@ -17,27 +36,94 @@ MAG_FIELDS = ("flux.gaussian", "flux.psf", "flux.kron", "flux.aperture",
               "cmodel.flux", "cmodel.exp.flux", "cmodel.dev.flux", "cmodel.initial.flux",)
 
 
+class DerivedFieldCache(object):
+    """Bookkeeping for memoized calculated fields.
+
+    Every calculated field computed by a ColumnAttributeProxy is recorded here
+    with its size.  If ``maxBytes`` is not None, the least recently used
+    fields are dropped from their proxies whenever the total exceeds it; they
+    will simply be recomputed if accessed again.
+    """
+
+    def __init__(self, maxBytes=None):
+        self.maxBytes = maxBytes
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+
+    def add(self, owner, name, nbytes):
+        key = (id(owner), name)
+        self._discard(key)
+        self._entries[key] = (weakref.ref(owner, lambda r: self._discard(key)), nbytes)
+        self.nbytes += nbytes
+        self.evict()
+
+    def touch(self, owner, name):
+        key = (id(owner), name)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def evict(self):
+        while self.maxBytes is not None and self.nbytes > self.maxBytes and len(self._entries) > 1:
+            (ownerId, name), (ref, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            owner = ref()
+            if owner is not None:
+                owner._cache.pop(name, None)
+                owner._derived.discard(name)
+
+DERIVED_FIELDS = DerivedFieldCache()
+
+
+# Calculated fields, keyed by the name of the node they're attached to, then by field name.
 CALCULATED_FIELDS = {}
 
-def addRadiusFields(proxy):
-    proxy._children["rDet"] = ColumnAttributeProxy(value=(proxy.xx*proxy.yy-proxy.xy*proxy.xy)**0.25)
-    proxy._children["rTr"] = ColumnAttributeProxy(value=(0.5*(proxy.xx + proxy.yy))**0.5)
-CALCULATED_FIELDS["ellipse"] = addRadiusFields
+def registerCalculatedField(node, name, func, requires=()):
+    """Register a field that is computed on demand from its siblings.
+
+    Every ColumnAttributeProxy named ``node`` (e.g. "ellipse") that has all of
+    the dotted paths in ``requires`` gets a lazy attribute ``name``; on first
+    access, ``func`` is called with the proxy and should return an array or a
+    ColumnAttributeProxy.  The result is memoized, subject to DERIVED_FIELDS.
+    """
+    CALCULATED_FIELDS.setdefault(node, {})[name] = (func, tuple(requires))
 
-def addCModelFields(proxy):
-    if not hasattr(proxy.exp, "ellipse"): return
+def calculateDeterminantRadius(proxy):
+    return (proxy.xx*proxy.yy-proxy.xy*proxy.xy)**0.25
+
+def calculateTraceRadius(proxy):
+    return (0.5*(proxy.xx + proxy.yy))**0.5
+
+def calculateCModelEllipse(proxy):
     xx = (1.0-proxy.fracDev)*proxy.exp.ellipse.xx + proxy.fracDev*proxy.dev.ellipse.xx
     yy = (1.0-proxy.fracDev)*proxy.exp.ellipse.yy + proxy.fracDev*proxy.dev.ellipse.yy
     xy = (1.0-proxy.fracDev)*proxy.exp.ellipse.xy + proxy.fracDev*proxy.dev.ellipse.xy
-    proxy._children["ellipse"] = ColumnAttributeProxy(
+    ellipse = ColumnAttributeProxy(
         children=dict(
             xx=ColumnAttributeProxy(value=xx),
             yy=ColumnAttributeProxy(value=yy),
             xy=ColumnAttributeProxy(value=xy),
         )
     )
-    addRadiusFields(proxy._children["ellipse"])
-CALCULATED_FIELDS["cmodel"] = addCModelFields
+    ellipse._attachCalculatedFields("ellipse")
+    return ellipse
+
+registerCalculatedField("ellipse", "rDet", calculateDeterminantRadius, requires=("xx", "yy", "xy"))
+registerCalculatedField("ellipse", "rTr", calculateTraceRadius, requires=("xx", "yy"))
+registerCalculatedField("cmodel", "ellipse", calculateCModelEllipse,
+                        requires=("fracDev", "exp.ellipse", "dev.ellipse"))
+
+
+def _nbytes(value):
+    if isinstance(value, ColumnAttributeProxy):
+        return sum(_nbytes(child) for child in value._children.itervalues()) + _nbytes(value.value)
+    return getattr(value, "nbytes", 0)
+
 
 class ColumnAttributeProxy(object):
 
@@ -53,17 +139,83 @@ class ColumnAttributeProxy(object):
                 parsed.setdefault(k[0].replace("-", "_"), {})[k[1:]] = v
         for parsed_name, parsed_columns in parsed.iteritems():
             children[parsed_name] = ColumnAttributeProxy._build(parsed_columns)
-            calculated = CALCULATED_FIELDS.get(parsed_name, None)
-            if calculated:
-                calculated(children[parsed_name])
+            children[parsed_name]._attachCalculatedFields(parsed_name)
         return cls(children, value)
 
-    def __init__(self, children=None, value=None):
+    def __init__(self, children=None, value=None, lazy=None, index=None):
         if children is None: children = {}
-        self.value = value
+        if lazy is None: lazy = {}
+        self._value = value
         self._children = children
+        self._lazy = lazy
+        self._index = index
+        self._cache = {}
+        self._derived = set()
+        self._gathered = None
         assert isinstance(self._children, dict)
 
+    @property
+    def value(self):
+        """The column's values for this view's rows.
+
+        For a view of selected rows, the values are gathered (and decoded, if
+        encoded) on first access and kept for the life of the view, so
+        repeated access doesn't re-gather the whole column.
+        """
+        if self._value is None:
+            return None
+        if self._index is None:
+            if isinstance(self._value, EncodedColumn):
+                return self._value.decode()
+            return self._value
+        if self._gathered is None:
+            if isinstance(self._value, EncodedColumn):
+                self._gathered = self._value.decode(self._index)
+            else:
+                self._gathered = self._value[self._index]
+        return self._gathered
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._index = None
+        self._gathered = None
+        self._cache.clear()
+
+    def _rawLen(self):
+        if self._value is not None:
+            return len(self._value)
+        return self._children.itervalues().next()._rawLen()
+
+    def _composeIndex(self, k):
+        if isinstance(k, ColumnAttributeProxy):
+            k = k.value
+        if not isinstance(k, (slice, int, long, numpy.integer)):
+            k = numpy.asarray(k)
+            if k.dtype == bool:
+                k = numpy.flatnonzero(k)
+        if self._index is None:
+            return k
+        if isinstance(self._index, slice):
+            base = numpy.arange(*self._index.indices(self._rawLen()))
+        else:
+            base = self._index
+        return base[k]
+
+    def _hasPath(self, path):
+        current = self
+        terms = path.split(".")
+        for term in terms[:-1]:
+            if term not in current._children:
+                return False
+            current = current._children[term]
+        return terms[-1] in current._children or terms[-1] in current._lazy
+
+    def _attachCalculatedFields(self, node):
+        for name, (func, requires) in CALCULATED_FIELDS.get(node, {}).iteritems():
+            if all(self._hasPath(path) for path in requires):
+                self._lazy[name] = func
+
     def __array__(self):
         if self.value is None:
             raise ValueError("No value associated with name")
@@ -90,9 +242,16 @@ class ColumnAttributeProxy(object):
     def __rtruediv__(self, other): return operator.truediv(other, self.value)
     def __floordiv__(self, other): return operator.floordiv(self.value, other)
     def __rfloordiv__(self, other): return operator.floordiv(other, self.value)
+    def __and__(self, other): return operator.and_(self.value, other)
+    def __rand__(self, other): return operator.and_(other, self.value)
+    def __or__(self, other): return operator.or_(self.value, other)
+    def __ror__(self, other): return operator.or_(other, self.value)
+    def __xor__(self, other): return operator.xor(self.value, other)
+    def __rxor__(self, other): return operator.xor(other, self.value)
+    def __invert__(self): return operator.invert(self.value)
 
     def __dir__(self):
-        names = self._children.keys()
+        names = list(set(self._children.keys()) | set(self._lazy.keys()))
         names.sort()
         return names
 
@@ -103,17 +262,44 @@ class ColumnAttributeProxy(object):
         return current.value
     
     def __getattr__(self, name):
-        return self._children[name]
+        if name.startswith("__") or name in ("_children", "_lazy", "_derived", "_cache", "_index", "_value",
+                                             "_gathered"):
+            raise AttributeError(name)
+        child = self._cache.get(name)
+        if child is not None:
+            if name in self._derived:
+                DERIVED_FIELDS.touch(self, name)
+            return child
+        child = self._children.get(name)
+        if child is not None:
+            if self._index is None:
+                return child
+            child = child._select(self._index)
+            self._cache[name] = child
+            return child
+        if name not in self._lazy:
+            raise AttributeError(name)
+        child = self._lazy[name](self)
+        if not isinstance(child, ColumnAttributeProxy):
+            child = ColumnAttributeProxy(value=child)
+        self._cache[name] = child
+        self._derived.add(name)
+        DERIVED_FIELDS.add(self, name, _nbytes(child))
+        return child
 
     def _get_str_lines(self, depth=1, key=(), **kwds):
         lines = []
-        for name, child in sorted(self._children.items()):
+        for name in sorted(self._children):
+            child = getattr(self, name)
             if depth > 0:
                 lines.extend(child._get_str_lines(depth-1, key + (name,), **kwds))
             else:
                 lines.append((".".join(key), "..."))
         if self.value is not None:
-            s = numpy.array_str(self.value, **kwds).replace("\n", " ")
+            if isinstance(self.value, numpy.ndarray):
+                s = numpy.array_str(self.value, **kwds).replace("\n", " ")
+            else:
+                s = repr(self.value)
             if key:
                 lines.append((".".join(key), s))
             else:
@@ -130,200 +316,1091 @@ class ColumnAttributeProxy(object):
         return "\n".join(fmt.format(key + ":", value) for key, value in lines)
 
     def __len__(self):
-        if self.value is None:
-            return len(self._children.itervalues().next())
-        return len(self.value)
+        if self._index is None:
+            return self._rawLen()
+        if isinstance(self._index, slice):
+            return len(xrange(*self._index.indices(self._rawLen())))
+        return len(self._index)
+
+    def _select(self, index):
+        return type(self)(children=self._children, value=self._value, lazy=self._lazy, index=index)
 
     def __getitem__(self, k):
+        """Return a view of the selected rows.
+
+        No columns are copied until their values are accessed, and selections
+        of selections just compose their row indices; use materialize() to
+        create a compact copy.
+        """
+        return self._select(self._composeIndex(k))
+
+    def materialize(self, memo=None):
+        """Return a copy with any row selection applied to every column.
+
+        Encoded (e.g. packed flag) columns stay encoded.
+        """
+        if memo is None:
+            memo = {}
+        if isinstance(self._value, EncodedColumn):
+            value = self._value.select(self._index, memo) if self._index is not None else self._value
+        else:
+            value = self.value
+            if isinstance(self._index, slice) and hasattr(value, "copy"):
+                value = value.copy()
         return type(self)(
-            children={name: child[k] for name, child in self._children.iteritems()},
-            value=(self.value[k] if self.value is not None else None),
+            children={name: getattr(self, name).materialize(memo) for name in self._children},
+            value=value,
+            lazy=self._lazy,
         )
 
     def ravel(self, *args, **kwds):
         return self.value.ravel(*args, **kwds)
 
 
-class ObjectCatalog(ColumnAttributeProxy):
+class DiffTree(ColumnAttributeProxy):
+    """A tree of the differences ``other - base`` between two ColumnAttributeProxies.
+
+    It has the structure the two trees share, but each node (and its
+    difference array) is only computed when first accessed.  Boolean columns
+    give ``other != base``; non-numeric columns have no value.  Selecting
+    rows selects them from both inputs, so differences are only computed for
+    those rows, and materialize() evaluates all of them into an ordinary
+    ColumnAttributeProxy that holds nothing else.
+    """
+
+    def __init__(self, base, other):
+        value = None
+        a, b = base.value, other.value
+        if isinstance(a, numpy.ndarray) and isinstance(b, numpy.ndarray):
+            if a.dtype == bool and b.dtype == bool:
+                value = a != b
+            elif a.dtype.kind in "iuf" and b.dtype.kind in "iuf":
+                if "u" in (a.dtype.kind, b.dtype.kind):
+                    a, b = a.astype(numpy.int64), b.astype(numpy.int64)
+                value = b - a
+        lazy = {}
+        for name in set(dir(base)) & set(dir(other)):
+            lazy[name] = lambda proxy, name=name: DiffTree(getattr(base, name), getattr(other, name))
+        ColumnAttributeProxy.__init__(self, value=value, lazy=lazy)
+        self._base = base
+        self._other = other
+
+    def __len__(self):
+        return len(self._base)
+
+    def _select(self, index):
+        return DiffTree(self._base[index], self._other[index])
+
+    def materialize(self, memo=None):
+        names = set(self._base._children) & set(self._other._children)
+        return ColumnAttributeProxy(children={name: getattr(self, name).materialize(memo) for name in names},
+                                    value=self.value)
+
+
+def _shipColumns(columns, parent):
+    """Write a dict of column arrays to shared memory, returning a picklable handle.
+
+    Arrays are saved as .npy files in a new temporary directory under
+    ``parent`` (which should be on /dev/shm if it exists), so only the file
+    names travel back through the pool's pipe.
+    """
+    directory = tempfile.mkdtemp(dir=parent)
+    files = {}
+    for n, (key, array) in enumerate(columns.iteritems()):
+        filename = os.path.join(directory, "%d.npy" % n)
+        numpy.save(filename, array)
+        files[key] = filename
+    return directory, files
+
+
+def _receiveColumns(handle):
+    """Open columns written by _shipColumns as read-only memory maps.
+
+    The backing directory is unlinked immediately; the maps stay valid until
+    they are garbage-collected.
+    """
+    directory, files = handle
+    try:
+        return unpackFootprintColumns({key: numpy.load(filename, mmap_mode="r")
+                                       for key, filename in files.iteritems()})
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+_workerReader = None
+_workerSink = None
+_workerDirectory = None
+
+def _initWorker(reader, sink, directory):
+    global _workerReader, _workerSink, _workerDirectory
+    _workerReader = reader
+    _workerSink = sink
+    _workerDirectory = directory
+
+def _readPatchInWorker(dataId):
+    """Read a patch, returning a _shipColumns handle and the instrumentation events recorded."""
+    handle = _shipColumns(packFootprintColumns(_workerReader(dataId)), _workerDirectory)
+    if _workerSink is None:
+        return handle, []
+    return handle, _workerSink.flush()
+
+
+# Hyphens between letters in expressions are taken to be part of a field name.
+_EXPRESSION_HYPHEN = re.compile(r"(?<=[A-Za-z_])-(?=[A-Za-z_])")
+_EXPRESSION_NAME = re.compile(r"(?<![\w.])[A-Za-z_][\w-]*(?:\.[A-Za-z_][\w-]*)*")
+
+def _expressionPatterns(expression):
+    """Return include patterns that match the fields an expression string may refer to.
+
+    Calculated fields (see registerCalculatedField) are computed from their
+    siblings, so for those all of the fields of their node are matched.
+    """
+    patterns = []
+    for name in _EXPRESSION_NAME.findall(expression):
+        terms = name.split(".")
+        while len(terms) > 1 and terms[-1] in CALCULATED_FIELDS.get(terms[-2], {}):
+            terms = terms[:-1]
+        pattern = ".".join(terms).replace("_", "?").replace("-", "?")
+        patterns.extend((pattern, pattern + ".*"))
+    return tuple(patterns)
+
+def evaluateExpression(expression, proxy):
+    """Evaluate a column expression over a ColumnAttributeProxy, returning an array.
+
+    ``expression`` may be a callable, which is passed the proxy, or a string
+    over dotted field names, e.g. "i.meas.flux.psf / i.meas.flux.psf.err".
+    Hyphens in field names may be written as is or as underscores (so
+    subtraction must be written with spaces), and numpy is available as
+    "numpy" and "np".
+    """
+    if isinstance(expression, basestring):
+        namespace = {name: getattr(proxy, name) for name in dir(proxy)}
+        namespace.update(numpy=numpy, np=numpy)
+        result = eval(_EXPRESSION_HYPHEN.sub("_", expression), {"__builtins__": {}}, namespace)
+    else:
+        result = expression(proxy)
+    return numpy.asarray(result)
+
+def evaluateWhere(where, columns):
+    """Evaluate a row predicate (see evaluateExpression) over a dict of patch columns.
+
+    For example, "detect.is-primary & ~i.flags.pixel.edge & (parent == 0)".
+    The result must be a boolean array with one element per row.
+    """
+    proxy = ColumnAttributeProxy._build(columns)
+    result = evaluateExpression(where, proxy)
+    if result.dtype != bool or result.shape != (len(proxy),):
+        raise ValueError("where= must give a boolean array with one element per row, not {} {}".format(
+            result.dtype, result.shape))
+    return result
+
+
+def _readPatches(reader, dataIds, prefetch=0):
+    """Yield the columns of each patch in turn, optionally prefetching catalogs.
+
+    Progress is reported to the reader's instrument as each patch is read.
+    """
+    reader.startPrefetch(dataIds, prefetch)
+    rows = 0
+    try:
+        for n, dataId in enumerate(dataIds):
+            columns = reader(dataId)
+            rows += len(columns[("id",)])
+            reader.instrument.progress(n + 1, len(dataIds), rows)
+            yield columns
+    finally:
+        reader.stopPrefetch()
+
+
+def _receivePatches(reader, dataIds, workers, instrument):
+    """Yield the columns of each patch in turn, as read by a pool of worker processes.
+
+    Workers record their events into a BufferSink of their own and send them
+    back with each patch's columns, to be replayed into ``instrument``.
+    Each patch is passed back through its own directory in a scratch
+    directory that is removed when the generator finishes or is closed, so
+    patches that were shipped but not received (e.g. because another worker
+    failed) don't linger in shared memory.  Progress is reported to
+    ``instrument`` as each patch is received.
+    """
+    sink = BufferSink() if instrument.enabled else None
+    workerReader = copy.copy(reader)
+    workerReader.instrument = Recorder([sink]) if sink is not None else NULL_INSTRUMENT
+    parent = tempfile.mkdtemp(prefix="analysis-", dir=("/dev/shm" if os.path.isdir("/dev/shm") else None))
+    pool = multiprocessing.Pool(workers, initializer=_initWorker, initargs=(workerReader, sink, parent))
+    rows = 0
+    try:
+        for n, (handle, events) in enumerate(pool.imap(_readPatchInWorker, dataIds)):
+            instrument.replay(events)
+            with instrument.stage("receive", dataIds[n]):
+                columns = _receiveColumns(handle)
+            rows += len(columns[("id",)])
+            instrument.progress(n + 1, len(dataIds), rows)
+            yield columns
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(parent, ignore_errors=True)
+
+
+def _popEach(items):
+    """Yield and forget the items of a list, in order."""
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
+def _matches(key, include):
+    if include is None:
+        return True
+    name = ".".join(key)
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in include)
+
+
+class ColumnPlan(object):
+    """Routing of the fields of one catalog schema to output column keys.
+
+    Attributes
+    ----------
+    fields : list of str
+        Schema field names to pass to Catalog.extract.
+    columns : list of (str, tuple)
+        Extracted names and the output keys they should be assigned to.
+    mags : list of (str, tuple, bool, bool)
+        Flux field names to convert to magnitudes, the output key for the
+        magnitude, and whether the magnitude and its error are wanted.
+    """
+
+    def __init__(self, fields, columns, mags):
+        self.fields = fields
+        self.columns = columns
+        self.mags = mags
 
     @classmethod
-    def read(cls, butler, dataIds=(), tracts=(), tract=None, patches=(), patch=None,
-             filters=None, filter=None, forced=True, meas=True, images=True, footprints="heavy", progress=True):
+    def make(cls, schema, b, kind, meas=True, include=None):
+        """Compute the plan for a deepCoadd_ref (``kind="ref"``), deepCoadd_meas
+        (``kind="meas"``) or deepCoadd_forced_src (``kind="forced"``) schema.
 
-        dataIds = list(dataIds)
-        if filters is None:
-            if filter is None:
-                filters = ("g", "r", "i", "z", "y")
+        Only output columns whose dotted names match one of the glob patterns
+        in ``include`` (all columns, if None) are planned; the "id" column is
+        always included.
+        """
+        columns = []
+        mags = []
+        needed = set()
+        for name in schema.extract("*"):
+            isRef = any(name.startswith(p) for p in REF_PREFIXES)
+            if kind == "ref":
+                if not isRef:
+                    continue
+                key = tuple(name.split("."))
+            elif isRef:
+                continue
+            elif any(name.startswith(p) for p in SHARED_PREFIXES):
+                if kind == "forced" and meas:
+                    continue
+                key = (b,) + tuple(name.split("."))
             else:
-                filters = (filter,)
-        if tract is not None:
-            tracts = tuple(tracts) + (tract,)
-        if patch is not None:
-            patches = tuple(patches) + (patch,)
-        for t in tracts:
-            for p in patches:
-                if not isinstance(p, basestring):
-                    p = "%s,%s" % p
-                dataIds.append(dict(tract=t, patch=p))
-
-        refCats = []
-        totalSize = 0
-        for dataId in dataIds:
-            logging.debug("Reading deepCoadd_ref for {}".format(dataId))
-            newRefCat = butler.get("deepCoadd_ref", dataId, immediate=True,
-                                   flags=lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS)
-            refCats.append(newRefCat)
-            totalSize += len(newRefCat)
-
-        columns = {
-            ("tract",): numpy.zeros(totalSize, dtype=int),
-            ("patch",): numpy.zeros(totalSize, dtype="S5"),
-            }
-        if footprints:
-            for b in filters:
-                columns[(b, "footprint")] = numpy.zeros(totalSize, dtype=object)
-
-        if images:
-            coadds = {b: {} for b in filters}
-        else:
-            coadds = None
+                key = (b, kind) + tuple(name.split("."))
+            if key == ("id",) or _matches(key, include):
+                columns.append((name, key))
+                needed.add(name)
+            if kind != "ref" and name in MAG_FIELDS:
+                magKey = (b, kind) + tuple(name.replace("flux", "mag").split("."))
+                wantMag = _matches(magKey, include)
+                wantErr = _matches(magKey + ("err",), include)
+                if wantMag or wantErr:
+                    mags.append((name, magKey, wantMag, wantErr))
+                    needed.add(name)
+                if wantErr:
+                    needed.add(name + ".err")
+        # extract() matches patterns against field names, not the names of the
+        # columns compound fields are split into, so map back to the former.
+        fieldNames = schema.getNames()
+        fields = set()
+        for name in needed:
+            field = name
+            while field not in fieldNames and "." in field:
+                field = field.rsplit(".", 1)[0]
+            fields.add(field)
+        return cls(sorted(fields), columns, mags)
 
+
+class PatchReader(object):
+    """Read and extract the columns for a single patch.
+
+    Calling a PatchReader with a data ID returns a dict mapping tuple keys (as
+    consumed by ColumnAttributeProxy._build) to arrays with one row per object
+    in the patch.  Coadd images are never read here: photometric zero points
+    come from their headers via a CalibProvider, and pixels from CoaddCache.
+
+    If ``cache`` is not None, it should be a ColumnCache; the extracted columns
+    for the reference catalog and for each band are then saved there, and
+    served from it on later reads as long as the input files are unchanged.
+    Object-valued footprint columns can't be cached, so the per-band columns
+    bypass the cache when ``footprints`` is set, unless ``compactFootprints``
+    is also True.  In that case each band's footprints are returned as a
+    FootprintArray (a columnar store of spans, peaks and, for heavy
+    footprints, pixel values) instead of an object array of afw Footprints.
+
+    If ``include`` is not None, it should be a glob pattern or sequence of glob
+    patterns over dotted output column names (e.g. "*.meas.cmodel.*"); only
+    matching columns are extracted, converted to magnitudes and returned.
+    That includes the "footprint" column of each band: footprints are only
+    read for the bands where "<band>.footprint" matches.
+
+    Each read, extraction and conversion is timed as a stage of ``instrument``
+    (see analysis.instrument), if one is given.
+
+    If ``where`` is not None, it is a row predicate (see evaluateWhere) that
+    is applied to each patch's columns before they're returned.  Columns an
+    expression string refers to are loaded even if ``include`` doesn't match
+    them, and dropped again afterwards.
+
+    startPrefetch() makes the reader issue the butler reads for a sequence of
+    patches from background threads, a fixed number ahead of the one being
+    processed, so file I/O overlaps with extraction.
+
+    PatchReaders are picklable as long as the butler (and instrument) are,
+    which is how ObjectCatalog.read ships them to worker processes.
+    """
+
+    def __init__(self, butler, filters, forced=True, meas=True, footprints="heavy",
+                 cache=None, include=None, compactFootprints=False, instrument=None, where=None):
+        self.butler = butler
+        self.instrument = instrument if instrument is not None else NULL_INSTRUMENT
+        self.filters = tuple(filters)
+        if isinstance(include, basestring):
+            include = (include,)
+        self.include = tuple(include) if include is not None else None
+        self.where = where
+        self._keep = self.include
+        if isinstance(where, basestring) and self.include is not None:
+            self.include += _expressionPatterns(where)
+        self._plans = {}
+        self.forced = forced
+        self.meas = meas
+        self.footprints = footprints
+        self.compactFootprints = compactFootprints
+        if isinstance(cache, basestring):
+            cache = ColumnCache(cache)
+        self.cache = cache
+        self._readAhead = None
+        self.calibs = CalibProvider(butler, directory=(os.path.join(cache.directory, "calib")
+                                                       if cache is not None else None))
+        self.planCache = PlanCache(os.path.join(cache.directory, "plans") if cache is not None else None)
         if footprints == "heavy":
-            measLoadFlags = 0
+            self.measLoadFlags = 0
         elif footprints:
-            measLoadFlags = lsst.afw.table.SOURCE_IO_NO_HEAVY_FOOTPRINTS
+            self.measLoadFlags = lsst.afw.table.SOURCE_IO_NO_HEAVY_FOOTPRINTS
         else:
-            measLoadFlags = lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS
+            self.measLoadFlags = lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS
 
-        lsst.afw.image.Calib.setThrowOnNegativeFlux(False)
+    def _cached(self, description, compute, dataId, b=None):
+        if self.cache is None:
+            return compute()
+        with self.instrument.stage("cache.load", dataId, b):
+            columns = self.cache.load(description)
+        if columns is None:
+            columns = compute()
+            with self.instrument.stage("cache.save", dataId, b) as stage:
+                packed = packFootprintColumns(columns)
+                self.cache.save(description, packed)
+                stage.add(nbytes=sum(array.nbytes for array in packed.itervalues()))
+        else:
+            columns = unpackFootprintColumns(columns)
+        return columns
 
-        offset = 0
-        for n, dataId in enumerate(dataIds):
-            size = len(refCats[n])
-
-            def assignCol(key, subcol):
-                if key not in columns:
-                    columns[key] = numpy.zeros((totalSize,) + subcol.shape[1:], dtype=subcol.dtype)
-                columns[key][offset:offset+size] = subcol
-
-            columns[("tract",)][:] = dataId["tract"]
-            columns[("patch",)][:]= dataId["patch"]
-
-            d = refCats[n].extract("*")
-            for name, subcol in d.iteritems():
-                if any(name.startswith(p) for p in REF_PREFIXES):
-                    assignCol(tuple(name.split(".")), subcol)
-            refCats[n] = None   # allow garbage collection
-
-            for nb, b in enumerate(filters):
-                
-                if meas or forced or images:
-                    logging.debug("Reading deepCoadd_calexp for {}, {}".format(b, dataId))
-                    coadd = butler.get("deepCoadd_calexp", dataId, immediate=True,
-                                       filter="HSC-"+b.upper())
-                    calib = coadd.getCalib()
-
-                if meas:
-                    logging.debug("Reading deepCoadd_meas for {}, {}".format(b, dataId))
-                    measCat = butler.get("deepCoadd_meas", dataId, immediate=True,
-                                         filter="HSC-"+b.upper(), flags=measLoadFlags)
-                    d = measCat.extract("*")
-                    for name, subcol in d.iteritems():
-                        if any(name.startswith(p) for p in REF_PREFIXES):
-                            continue
-                        if any(name.startswith(p) for p in SHARED_PREFIXES):
-                            key = (b,) + tuple(name.split("."))
+    def _readKwds(self, datasetType, b):
+        kwds = {}
+        if b is not None:
+            kwds["filter"] = "HSC-" + b.upper()
+        if datasetType == "deepCoadd_meas" and self._wantFootprints(b):
+            kwds["flags"] = self.measLoadFlags
+        else:
+            kwds["flags"] = lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS
+        return kwds
+
+    def _wantFootprints(self, b):
+        return bool(self.footprints) and _matches((b, "footprint"), self._keep)
+
+    def _fetch(self, key):
+        datasetType, tract, patch, b = key
+        dataId = dict(tract=tract, patch=patch)
+        log.debug("Reading {} for {}{}".format(datasetType, dataId, ", " + b if b is not None else ""))
+        with self.instrument.stage("read." + datasetType, dataId, b) as stage:
+            catalog = self.butler.get(datasetType, dataId, immediate=True, **self._readKwds(datasetType, b))
+            stage.add(nbytes=len(catalog)*catalog.schema.getRecordSize(), rows=len(catalog))
+        return catalog
+
+    def _prefetch(self, key):
+        datasetType, tract, patch, b = key
+        kwds = {"filter": "HSC-" + b.upper()} if b is not None else {}
+        warmFile(self.butler.get(datasetType + "_filename", dict(tract=tract, patch=patch), **kwds)[0])
+        return self._fetch(key)
+
+    def _read(self, datasetType, dataId, b=None):
+        key = (datasetType, dataId["tract"], dataId["patch"], b)
+        if self._readAhead is None:
+            return self._fetch(key)
+        with self.instrument.stage("prefetch.wait", dataId, b):
+            return self._readAhead.get(key, self._fetch)
+
+    def _refDescription(self, dataId):
+        if self.cache is None:
+            return None
+        return ("ref", self.include, fileStamps(self.butler, "deepCoadd_ref", dataId))
+
+    def _bandDescription(self, dataId, b):
+        if self.cache is None or (self._wantFootprints(b) and not self.compactFootprints):
+            return None
+        filterName = "HSC-" + b.upper()
+        stamps = [fileStamps(self.butler, "deepCoadd_calexp", dataId, filter=filterName)]
+        if self.meas:
+            stamps.append(fileStamps(self.butler, "deepCoadd_meas", dataId, filter=filterName))
+        if self.forced:
+            stamps.append(fileStamps(self.butler, "deepCoadd_forced_src", dataId, filter=filterName))
+        return ("band", b, self.filters, self.meas, self.forced, self.include, self.footprints,
+                self.compactFootprints, stamps)
+
+    def plannedReads(self, dataId, ref=True):
+        """Return the butler reads (as (datasetType, tract, patch, filter) tuples) that calling
+        the reader on a patch will make, in order; reads the cache will serve are left out.
+
+        If ``ref`` is False, the reference catalog read is left out too.
+        """
+        def cached(description):
+            return description is not None and description in self.cache
+        tract, patch = dataId["tract"], dataId["patch"]
+        keys = []
+        if ref and not cached(self._refDescription(dataId)):
+            keys.append(("deepCoadd_ref", tract, patch, None))
+        for b in self.filters:
+            if cached(self._bandDescription(dataId, b)):
+                continue
+            if self.meas:
+                keys.append(("deepCoadd_meas", tract, patch, b))
+            if self.forced:
+                keys.append(("deepCoadd_forced_src", tract, patch, b))
+        return keys
+
+    def startPrefetch(self, dataIds, depth, ref=True):
+        """Start reading the catalogs for the given patches in ``depth`` background threads.
+
+        At most ``depth`` catalogs are read ahead of the one being processed,
+        and they must then be processed in the order of ``dataIds``; reads
+        that weren't planned (e.g. because a cache entry disappeared) are just
+        done directly.  Does nothing if ``depth`` is zero.  Pass ``ref=False``
+        if readRefColumns won't be called, so the reference catalogs aren't
+        read ahead for nothing.
+        """
+        self.stopPrefetch()
+        if depth:
+            keys = [key for dataId in dataIds for key in self.plannedReads(dataId, ref=ref)]
+            self._readAhead = ReadAhead(self._prefetch, keys, depth=depth)
+
+    def stopPrefetch(self):
+        """Cancel any outstanding background reads."""
+        if self._readAhead is not None:
+            self._readAhead.close()
+            self._readAhead = None
+
+    def _plan(self, catalog, b, kind):
+        # All patches in a rerun share the same schemas, so plans are computed once per reader,
+        # and are only recomputed at all for schemas, options and routing rules not seen before.
+        plan = self._plans.get((kind, b))
+        if plan is None:
+            description = ("ColumnPlan", schemaDigest(catalog.schema), b, kind, self.meas, self.include,
+                           REF_PREFIXES, SHARED_PREFIXES, MAG_FIELDS)
+            plan = self.planCache.get(
+                description,
+                lambda: ColumnPlan.make(catalog.schema, b, kind, meas=self.meas, include=self.include)
+            )
+            self._plans[(kind, b)] = plan
+        return plan
+
+    def _extract(self, catalog, b, kind, engine, columns, dataId=None):
+        with self.instrument.stage("extract", dataId, b) as stage:
+            plan = self._plan(catalog, b, kind)
+            d = catalog.extract(*plan.fields) if plan.fields else {}
+            for name, key in plan.columns:
+                columns[key] = d[name]
+            if self.instrument.enabled:
+                stage.add(nbytes=sum(d[name].nbytes for name, _ in plan.columns), rows=len(catalog))
+        if not plan.mags:
+            return
+        for name, magKey, wantMag, wantErr in plan.mags:
+            if d[name].ndim > 2:
+                raise ValueError("Flux field with dimension > 1 not supported")
+        with self.instrument.stage("magnitudes", dataId, b) as stage:
+            results = engine.convertAll((d[name], d.get(name + ".err"), wantMag, wantErr)
+                                        for name, _, wantMag, wantErr in plan.mags)
+            for (name, magKey, wantMag, wantErr), (mag, magErr) in zip(plan.mags, results):
+                if wantMag:
+                    columns[magKey] = mag
+                    stage.add(nbytes=mag.nbytes)
+                if wantErr:
+                    columns[magKey + ("err",)] = magErr
+                    stage.add(nbytes=magErr.nbytes)
+            stage.add(rows=len(catalog))
+
+    def readRefColumns(self, dataId):
+        """Return the columns taken from the deepCoadd_ref catalog for a patch."""
+        def compute():
+            refCat = self._read("deepCoadd_ref", dataId)
+            columns = {}
+            self._extract(refCat, None, "ref", None, columns, dataId)
+            return columns
+        description = self._refDescription(dataId)
+        if description is None:
+            return compute()
+        return self._cached(description, compute, dataId)
+
+    def readBandColumns(self, dataId, b):
+        """Return the columns for one band of a patch."""
+        def compute():
+            columns = {}
+            if self.meas or self.forced:
+                with self.instrument.stage("calib", dataId, b):
+                    engine = self.calibs.getEngine(dataId, b)
+
+            if self.meas:
+                measCat = self._read("deepCoadd_meas", dataId, b)
+                self._extract(measCat, b, "meas", engine, columns, dataId)
+                if self._wantFootprints(b):
+                    with self.instrument.stage("footprints", dataId, b) as stage:
+                        if self.compactFootprints:
+                            fpCol = FootprintArray.fromFootprints(
+                                (record.getFootprint() for record in measCat),
+                                heavy=(self.footprints == "heavy")
+                            )
                         else:
-                            key = (b, "meas") + tuple(name.split("."))
-                        assignCol(key, subcol)
-                        if name in MAG_FIELDS:
-                            if subcol.ndim == 1:
-                                mag, magErr = calib.getMagnitude(subcol, d[name + ".err"])
-                            elif subcol.ndim == 2:
-                                mag = numpy.zeros(subcol.shape, dtype=float)
-                                magErr = numpy.zeros(subcol.shape, dtype=float)
-                                for i in xrange(subcol.shape[1]):
-                                    mag[:,i], magErr[:,i] = calib.getMagnitude(subcol[:,i], d[name + ".err"][:,i])
-                            else:
-                                raise ValueError("Flux field with dimension > 1 not supported")
-                            magKey = (b, "meas") + tuple(name.replace("flux", "mag").split("."))
-                            assignCol(magKey, mag)
-                            assignCol(magKey + ("err",), magErr)
-                    if footprints:
-                        fpCol = columns[(b, "footprint")]
-                        if images:
-                            logging.debug("Fixing DETECTED mask plane for {}, {}".format(b, dataId))
-                            mask = coadd.getMaskedImage().getMask()
-                            detPlane = mask.getMaskPlane("DETECTED")
-                            detBits = mask.getPlaneBitMask("DETECTED")
-                            mask.clearMaskPlane(detPlane)
-                        for i, record in enumerate(measCat):
-                            fpCol[i+offset] = record.getFootprint()
-                            if images:
-                                lsst.afw.detection.setMaskFromFootprint(mask, record.getFootprint(), detBits)
-                    del measCat
-
-                if forced:
-                    logging.debug("Reading deepCoadd_meas for {}, {}".format(b, dataId))
-                    forcedCat = butler.get("deepCoadd_forced_src", dataId, immediate=True,
-                                           filter="HSC-" + b.upper(),
-                                           flags=lsst.afw.table.SOURCE_IO_NO_FOOTPRINTS)
-                    d = forcedCat.extract("*")
-                    for name, subcol in d.iteritems():
-                        if any(name.startswith(p) for p in REF_PREFIXES):
+                            fpCol = numpy.zeros(len(measCat), dtype=object)
+                            for i, record in enumerate(measCat):
+                                fpCol[i] = record.getFootprint()
+                        stage.add(nbytes=fpCol.nbytes, rows=len(fpCol))
+                    columns[(b, "footprint")] = fpCol
+                del measCat
+
+            if self.forced:
+                forcedCat = self._read("deepCoadd_forced_src", dataId, b)
+                self._extract(forcedCat, b, "forced", engine, columns, dataId)
+                del forcedCat
+
+            return columns
+
+        description = self._bandDescription(dataId, b)
+        if description is None:
+            return compute()
+        return self._cached(description, compute, dataId, b)
+
+    def __call__(self, dataId):
+        columns = self.readRefColumns(dataId)
+        for b in self.filters:
+            columns.update(self.readBandColumns(dataId, b))
+            if self._wantFootprints(b) and (b, "footprint") not in columns:
+                size = len(columns[("id",)])
+                if self.compactFootprints:
+                    columns[(b, "footprint")] = FootprintArray.empty(size, heavy=(self.footprints == "heavy"))
+                else:
+                    columns[(b, "footprint")] = numpy.zeros(size, dtype=object)
+        if self.where is not None:
+            with self.instrument.stage("where", dataId) as stage:
+                rows = numpy.flatnonzero(evaluateWhere(self.where, columns))
+                columns = {key: column[rows] for key, column in columns.iteritems()
+                           if key == ("id",) or _matches(key, self._keep)}
+                stage.add(rows=len(rows))
+        return columns
+
+
+def _makeFilters(filters, filter):
+    if filters is None:
+        if filter is None:
+            return ("g", "r", "i", "z", "y")
+        return (filter,)
+    return tuple(filters)
+
+
+def _makeDataIds(dataIds, tracts, tract, patches, patch):
+    dataIds = list(dataIds)
+    if tract is not None:
+        tracts = tuple(tracts) + (tract,)
+    if patch is not None:
+        patches = tuple(patches) + (patch,)
+    for t in tracts:
+        for p in patches:
+            if not isinstance(p, basestring):
+                p = "%s,%s" % p
+            dataIds.append(dict(tract=t, patch=p))
+    return dataIds
+
+
+class ObjectCatalog(ColumnAttributeProxy):
+
+    # Names of the per-rerun subtrees of catalogs loaded by read_many.
+    reruns = ()
+
+    @classmethod
+    def read(cls, butler, dataIds=(), tracts=(), tract=None, patches=(), patch=None,
+             filters=None, filter=None, forced=True, meas=True, images=True, footprints="heavy", progress=True,
+             workers=1, cache=None, include=None, compactFootprints=False, maxCoaddBytes=DEFAULT_MAX_BYTES,
+             instrument=None, prefetch=0, where=None, compact=False):
+        """Load a multi-band catalog of coadd measurements.
+
+        If ``images`` is True, coadd Exposures are read only when coadd() (or a
+        display) first asks for them, and are held in a CoaddCache that keeps at
+        most ``maxCoaddBytes`` of pixels (None for no limit), dropping the least
+        recently used ones first.  Their DETECTED mask planes are reset from the
+        catalog's footprints when they are read.
+
+        With ``workers > 1``, patches are read and extracted in a pool of that
+        many processes; column arrays are passed back through shared memory and
+        copied into the output (and released) as each patch arrives, in the
+        order of ``dataIds``.  (Object-valued) Footprints
+        cannot be passed back from worker processes, so ``footprints`` must be
+        False unless ``compactFootprints`` is True in that mode.
+
+        If ``cache`` is a directory name (or a ColumnCache), extracted columns
+        (including derived magnitudes) are cached there per patch and band, and
+        later reads of unchanged inputs with the same options memory-map them
+        instead of going back to the butler.  When a single patch is read, the
+        cached arrays are used directly, without copying.
+
+        ``include`` restricts the loaded columns to those whose dotted names
+        (e.g. "i.meas.cmodel.mag", "r.flags.pixel.edge", "coord.ra") match one
+        of the given glob patterns.  The "id", "tract" and "patch" columns are
+        always loaded.  This applies to footprints too: a band's footprints
+        are only read (and its "footprint" column only present) if
+        "<band>.footprint" matches, whatever ``footprints`` is.
+
+        If ``compactFootprints`` is True, each band's "footprint" column is a
+        FootprintArray rather than an object array of afw Footprints; it uses
+        far less memory, can be cached and sliced cheaply, and still returns
+        afw Footprints when indexed with an integer.
+
+        If ``instrument`` is not None, it should be an analysis.instrument
+        Recorder; every stage of the read (butler I/O, extraction, magnitudes,
+        footprints, caching, assembly and view creation) is timed and sized
+        per patch and band, and progress is reported after each patch.  The
+        instrument is kept with the catalog, so coadd reads and displays are
+        recorded too.
+
+        If ``prefetch`` is nonzero (and ``workers`` is 1), that many butler
+        reads are kept in flight in background threads ahead of the patch
+        being processed, so reading the next catalogs overlaps with extracting
+        the current ones.  Results are still processed in order, and at most
+        ``prefetch`` catalogs are held beyond the current one.
+
+        If ``where`` is not None, only the rows for which it is True are kept;
+        it may be a callable that takes a per-patch ColumnAttributeProxy and
+        returns a boolean array, or an expression string over dotted field
+        names such as "detect.is-primary & (parent == 0)" (see
+        evaluateWhere).  It's applied to each patch as soon as its columns are
+        extracted, and the output columns are allocated for the selected rows
+        only.  With ``workers > 1`` a callable must be picklable.  The
+        DETECTED mask planes of coadds are left as they were written (not
+        reset from the catalog's footprints) when ``where`` is used, since
+        the footprints of the rejected rows are not loaded.
+
+        If ``compact`` is True (or a sequence of glob patterns to use instead
+        of analysis.compact.COMPACT_FLOATS), matching float columns (fluxes,
+        magnitudes, shapes, ...) are stored as float32, every band's flags are
+        packed into uint64 bitfields, and tract and patch are stored as small
+        integer codes.  This is transparent to attribute access: flags,
+        tracts and patches are decoded for the selected rows whenever their
+        values are accessed.
+        """
+        filters = _makeFilters(filters, filter)
+        dataIds = _makeDataIds(dataIds, tracts, tract, patches, patch)
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+
+        reader = PatchReader(butler, filters, forced=forced, meas=meas, footprints=footprints,
+                             cache=cache, include=include, compactFootprints=compactFootprints,
+                             instrument=instrument, where=where)
+        instrument.progress(0, len(dataIds), 0)
+
+        if workers > 1:
+            if not compactFootprints and any(reader._wantFootprints(b) for b in reader.filters):
+                raise ValueError("non-compact footprints are not supported when workers > 1")
+            patches = _receivePatches(reader, dataIds, workers, instrument)
+        else:
+            patches = _readPatches(reader, dataIds, prefetch)
+        if where is not None:
+            # The number of selected rows isn't known until each patch has been read, so
+            # hold on to the (filtered) patches until the output can be sized exactly.
+            chunks = list(patches)
+            sizes = [len(chunk[("id",)]) for chunk in chunks]
+            patches = _popEach(chunks)
+        else:
+            # Only the FITS headers are read here; each patch's catalogs are read (or
+            # received from the workers), copied into the output and released in turn below.
+            with instrument.stage("countRows"):
+                sizes = [countRows(butler, "deepCoadd_ref", dataId) for dataId in dataIds]
+        totalSize = sum(sizes)
+
+        if compact:
+            compactor = ColumnCompactor(COMPACT_FLOATS if compact is True else compact)
+            codes = numpy.zeros(totalSize, dtype=codeDtype(len(dataIds)))
+            columns = {}
+        else:
+            compactor = None
+            columns = {
+                ("tract",): numpy.zeros(totalSize, dtype=int),
+                ("patch",): numpy.zeros(totalSize, dtype="S5"),
+                }
+        footprintParts = {}
+
+        try:
+            offset = 0
+            for n, (dataId, size) in enumerate(zip(dataIds, sizes)):
+                patchColumns = next(patches)
+                if len(patchColumns[("id",)]) != size:
+                    raise RuntimeError("deepCoadd_ref for {} has {} rows; its header says {}".format(
+                        dataId, len(patchColumns[("id",)]), size))
+
+                if compactor is not None:
+                    with instrument.stage("compact", dataId) as stage:
+                        patchColumns = compactor(patchColumns)
+                        stage.add(rows=size)
+
+                with instrument.stage("assemble", dataId) as stage:
+                    if compactor is not None:
+                        codes[offset:offset+size] = n
+                    else:
+                        columns[("tract",)][offset:offset+size] = dataId["tract"]
+                        columns[("patch",)][offset:offset+size] = dataId["patch"]
+                    for key, subcol in patchColumns.iteritems():
+                        if isinstance(subcol, FootprintArray):
+                            footprintParts.setdefault(key, []).append(subcol)
                             continue
-                        if any(name.startswith(p) for p in SHARED_PREFIXES):
-                            if meas:
-                                continue
-                            else:
-                                key = (b,) + tuple(name.split("."))
-                        else:
-                            key = (b, "forced") + tuple(name.split("."))
-                        assignCol(key, subcol)
-                        if name in MAG_FIELDS:
-                            if subcol.ndim == 1:
-                                mag, magErr = calib.getMagnitude(subcol, d[name + ".err"])
-                            elif subcol.ndim == 2:
-                                mag = numpy.zeros(subcol.shape, dtype=float)
-                                magErr = numpy.zeros(subcol.shape, dtype=float)
-                                for i in xrange(subcol.shape[1]):
-                                    mag[:,i], magErr[:,i] = calib.getMagnitude(subcol[:,i], d[name + ".err"][:,i])
-                            else:
-                                raise ValueError("Flux field with dimension > 1 not supported")
-                            magKey = (b, "forced") + tuple(name.replace("flux", "mag").split("."))
-                            assignCol(magKey, mag)
-                            assignCol(magKey + ("err",), magErr)
-                    del forcedCat
+                        if len(dataIds) == 1:
+                            columns[key] = subcol   # no need to copy (and keeps cached arrays memory-mapped)
+                            continue
+                        if key not in columns:
+                            columns[key] = numpy.zeros((totalSize,) + subcol.shape[1:], dtype=subcol.dtype)
+                        columns[key][offset:offset+size] = subcol
+                        stage.add(nbytes=subcol.nbytes)
+                    stage.add(rows=size)
+                del patchColumns
+                offset += size
+        finally:
+            patches.close()
+
+        with instrument.stage("footprints.concatenate"):
+            for key, parts in footprintParts.iteritems():
+                columns[key] = parts[0] if len(parts) == 1 else FootprintArray.concatenate(parts)
+
+        if compactor is not None:
+            compactor.expand(columns)
+            columns[("tract",)] = Categorical(codes, numpy.array([d["tract"] for d in dataIds], dtype=int))
+            columns[("patch",)] = Categorical(codes, numpy.array([d["patch"] for d in dataIds], dtype="S5"))
+
+        with instrument.stage("build") as stage:
+            self = cls._build(columns)
+            stage.add(rows=totalSize)
+        self.filters = filters
+        self._instrument = instrument
+        # Footprints of rows rejected by 'where' are gone, so they can't be used to rebuild masks.
+        self._coadds = (CoaddCache(butler, maxCoaddBytes, onLoad=(self._fixDetectedMask if where is None else None),
+                                   instrument=instrument)
+                        if images else None)
+        return self
+
+    @classmethod
+    def iter_read(cls, butler, dataIds=(), tracts=(), tract=None, patches=(), patch=None,
+                  filters=None, filter=None, forced=True, meas=True, images=True, footprints="heavy",
+                  cache=None, include=None, compactFootprints=False, chunkSize=None,
+                  maxCoaddBytes=DEFAULT_MAX_BYTES, instrument=None, prefetch=0, where=None, compact=False):
+        """Iterate over a multi-band catalog of coadd measurements one patch at a time.
 
+        Arguments are the same as those of read (except ``workers``), but rather
+        than assembling a single catalog, this yields a separate ObjectCatalog
+        for each patch, in the order of ``dataIds``.  If ``chunkSize`` is not
+        None, each patch is further split into catalogs of at most that many
+        rows.  Only one patch is held in memory at a time (as long as the
+        caller doesn't keep references to previous ones), plus up to
+        ``prefetch`` catalogs read ahead in the background.
+        """
+        filters = _makeFilters(filters, filter)
+        dataIds = _makeDataIds(dataIds, tracts, tract, patches, patch)
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        reader = PatchReader(butler, filters, forced=forced, meas=meas, footprints=footprints,
+                             cache=cache, include=include, compactFootprints=compactFootprints,
+                             instrument=instrument, where=where)
+        instrument.progress(0, len(dataIds), 0)
+        rows = 0
+        reader.startPrefetch(dataIds, prefetch)
+        try:
+            for n, dataId in enumerate(dataIds):
+                columns = reader(dataId)
+                size = len(columns[("id",)])
+                if compact:
+                    with instrument.stage("compact", dataId) as stage:
+                        compactor = ColumnCompactor(COMPACT_FLOATS if compact is True else compact)
+                        columns = compactor.expand(compactor(columns))
+                        stage.add(rows=size)
+                    codes = numpy.zeros(size, dtype=numpy.uint8)
+                    columns[("tract",)] = Categorical(codes, numpy.array([dataId["tract"]], dtype=int))
+                    columns[("patch",)] = Categorical(codes, numpy.array([dataId["patch"]], dtype="S5"))
+                else:
+                    columns[("tract",)] = numpy.zeros(size, dtype=int)
+                    columns[("tract",)][:] = dataId["tract"]
+                    columns[("patch",)] = numpy.zeros(size, dtype="S5")
+                    columns[("patch",)][:] = dataId["patch"]
+                with instrument.stage("build", dataId) as stage:
+                    catalog = cls._build(columns)
+                    stage.add(rows=size)
+                del columns
+                catalog.filters = filters
+                catalog._instrument = instrument
                 if images:
-                    coadds[b].setdefault(dataId["tract"], {}).setdefault(dataId["patch"], coadd)
+                    catalog._coadds = CoaddCache(
+                        butler, maxCoaddBytes, onLoad=(catalog._fixDetectedMask if where is None else None),
+                        instrument=instrument)
+                else:
+                    catalog._coadds = None
+                rows += size
+                instrument.progress(n + 1, len(dataIds), rows)
+                if chunkSize is None:
+                    yield catalog
+                else:
+                    for start in xrange(0, size, chunkSize):
+                        yield catalog[start:start+chunkSize]
+                del catalog
+        finally:
+            reader.stopPrefetch()
+
+    @classmethod
+    def read_many(cls, butlers, names=None, dataIds=(), tracts=(), tract=None, patches=(), patch=None,
+                  filters=None, filter=None, forced=True, meas=True, cache=None, include=None,
+                  instrument=None, prefetch=0):
+        """Load the same patches from several reruns, joined on object ID.
 
-            offset += size
+        Each patch is read from every butler in ``butlers``, and only the
+        objects present in all of them are kept (in ascending ID order within
+        each patch).  The reference columns ("id", "coord", etc., plus "tract"
+        and "patch") are taken from the first rerun and stored once; the
+        per-band columns of each rerun go in a subtree named by the
+        corresponding entry of ``names`` (by default "rerun0", "rerun1", ...),
+        e.g. ``cat.rerun1.i.meas.cmodel.mag``.  diff() returns lazily computed
+        differences between two of them.
 
-        logging.debug("Creating views")
-        self = cls._build(columns)
-        self._coadds = coadds
+        ``include``, ``cache``, ``instrument`` and ``prefetch`` are as for
+        read, and ``include`` applies to every rerun.  Footprints and coadd
+        images are not loaded.
+        """
+        filters = _makeFilters(filters, filter)
+        dataIds = _makeDataIds(dataIds, tracts, tract, patches, patch)
+        butlers = list(butlers)
+        names = tuple(names) if names is not None else tuple("rerun%d" % n for n in xrange(len(butlers)))
+        if len(names) != len(butlers):
+            raise ValueError("Got {} names for {} butlers".format(len(names), len(butlers)))
+        if len(set(names)) != len(names) or set(names) & (set(filters) | {"tract", "patch"}):
+            raise ValueError("Rerun names {} must be unique, and not band names".format(names))
+        if instrument is None:
+            instrument = NULL_INSTRUMENT
+        readers = [PatchReader(butler, filters, forced=forced, meas=meas, footprints=False, cache=cache,
+                               include=include, instrument=instrument)
+                   for butler in butlers]
+        # Only the IDs are extracted from the other reruns' ref catalogs; the rows of their
+        # per-band catalogs are in the same order.
+        idReaders = [readers[0]] + [PatchReader(butler, (), forced=False, meas=False, footprints=False,
+                                                cache=cache, include=("id",), instrument=instrument)
+                                    for butler in butlers[1:]]
+        instrument.progress(0, len(dataIds), 0)
+
+        parts = collections.defaultdict(list)
+        rows = 0
+        readers[0].startPrefetch(dataIds, prefetch)
+        for reader, idReader in zip(readers[1:], idReaders[1:]):
+            idReader.startPrefetch(dataIds, prefetch)
+            reader.startPrefetch(dataIds, prefetch, ref=False)
+        try:
+            for n, dataId in enumerate(dataIds):
+                refColumns = readers[0].readRefColumns(dataId)
+                ids = [refColumns[("id",)]] + [idReader.readRefColumns(dataId)[("id",)]
+                                               for idReader in idReaders[1:]]
+                with instrument.stage("align", dataId) as stage:
+                    indices = alignIds(ids)
+                    size = len(indices[0])
+                    stage.add(rows=size)
+                del ids
+                for key, column in refColumns.iteritems():
+                    if key[0] in names:
+                        raise ValueError("Rerun name {} clashes with a reference column".format(key[0]))
+                    parts[key].append(column[indices[0]])
+                del refColumns
+                parts[("tract",)].append(numpy.full(size, dataId["tract"], dtype=int))
+                parts[("patch",)].append(numpy.full(size, dataId["patch"], dtype="S5"))
+                for name, reader, index in zip(names, readers, indices):
+                    for b in filters:
+                        columns = reader.readBandColumns(dataId, b)
+                        with instrument.stage("assemble", dataId, b) as stage:
+                            for key, column in columns.iteritems():
+                                column = column[index]
+                                parts[(name,) + key].append(column)
+                                stage.add(nbytes=column.nbytes)
+                            stage.add(rows=size)
+                        del columns
+                rows += size
+                instrument.progress(n + 1, len(dataIds), rows)
+        finally:
+            for reader in readers + idReaders[1:]:
+                reader.stopPrefetch()
+
+        with instrument.stage("concatenate") as stage:
+            columns = {}
+            for key in parts.keys():
+                chunks = parts.pop(key)
+                columns[key] = chunks[0] if len(chunks) == 1 else numpy.concatenate(chunks)
+                stage.add(nbytes=columns[key].nbytes)
+        with instrument.stage("build") as stage:
+            self = cls._build(columns)
+            stage.add(rows=rows)
         self.filters = filters
+        self.reruns = names
+        self._instrument = instrument
+        self._coadds = None
         return self
 
-    def coadd(self, filter, tract=None, patch=None):
-        d1 = self._coadds[filter]
+    def diff(self, other=None, base=None):
+        """Return a tree of the differences between two reruns of a catalog loaded with read_many.
+
+        Leaves are ``other - base`` (``other != base`` for flags), computed
+        only when accessed; by default ``base`` is the first rerun and
+        ``other`` the second.  For example, ``cat.diff().i.meas.cmodel.mag``.
+        """
+        if len(self.reruns) < 2:
+            raise ValueError("Catalog does not hold more than one rerun")
+        if base is None:
+            base = self.reruns[0]
+        if other is None:
+            other = self.reruns[1]
+        if base not in self.reruns or other not in self.reruns:
+            raise ValueError("Unknown rerun name; options are {}".format(self.reruns))
+        return DiffTree(getattr(self, base), getattr(self, other))
+
+    def _fixDetectedMask(self, filter, tract, patch, exposure):
+        """Reset the DETECTED mask plane of a coadd from the footprints of its objects in this catalog.
+
+        FootprintArrays are painted in one batch by setMaskFromFootprints.
+        Object arrays of afw Footprints are still painted one Footprint at a
+        time: they would have to be converted to spans first, in a Python
+        loop over every span, which costs more than the painting it saves.
+        """
+        if not self._hasPath("{}.footprint".format(filter)):
+            return
+        rows = numpy.flatnonzero((self.tract.value == tract) & (self.patch.value == patch))
+        if not len(rows):
+            return
+        log.debug("Fixing DETECTED mask plane for {}, tract={}, patch={}".format(filter, tract, patch))
+        dataId = dict(tract=tract, patch=patch)
+        with self.instrument.stage("fixDetectedMask", dataId, filter) as stage:
+            footprints = getattr(self, filter).footprint.value
+            mask = exposure.getMaskedImage().getMask()
+            detBits = mask.getPlaneBitMask("DETECTED")
+            mask.clearMaskPlane(mask.getMaskPlane("DETECTED"))
+            if isinstance(footprints, FootprintArray):
+                setMaskFromFootprints(mask, footprints, detBits, rows=rows)
+            else:
+                for fp in footprints[rows]:
+                    lsst.afw.detection.setMaskFromFootprint(mask, fp, detBits)
+            stage.add(rows=len(rows))
+
+    def _defaultPatch(self, tract, patch):
         if tract is None:
-            d2 = d1.itervalues().next()
-        else:
-            d2 = d1[tract]
+            tract = int(self.tract.value[0])
         if patch is None:
-            return d2.itervalues().next()
-        else:
-            return d2[patch]
+            patch = str(self.patch.value[self.tract.value == tract][0])
+        return tract, patch
+
+    def coadd(self, filter, tract=None, patch=None):
+        """Return the coadd Exposure for a band and patch (by default, the first patch in the catalog)."""
+        if self._coadds is None:
+            raise ValueError("Catalog was read with images=False")
+        tract, patch = self._defaultPatch(tract, patch)
+        return self._coadds.get(filter, tract, patch)
+
+    def prefetchCoadds(self, tract=None, patch=None, radius=1):
+        """Start reading the coadds for a patch and its neighbours in this catalog in the background.
+
+        The patch's own coadds are read first, and are pinned in the cache
+        (until the next call) so reading the neighbours can't push them out.
+        """
+        if self._coadds is None:
+            return
+        tract, patch = self._defaultPatch(tract, patch)
+        patches = set(self.patch.value[self.tract.value == tract])
+        neighbours = [p for p in neighbourPatches(patch, radius) if p in patches]
+        keys = [(b, tract, patch) for b in self.filters]
+        self._coadds.pin(keys)
+        self._coadds.prefetch(keys + [(b, tract, p) for p in neighbours for b in self.filters])
+
+    def display(self, tract=None, patch=None, frames=None, frame0=0, prefetch=False):
+        """Return a CoaddDisplay for a patch; if ``prefetch``, neighbouring coadds are read in the background."""
+        return display.CoaddDisplay(self, tract, patch, frames=None, frame0=frame0, prefetch=prefetch)
+
+    @property
+    def instrument(self):
+        """The analysis.instrument Recorder the catalog was read with (a no-op one by default)."""
+        return getattr(self, "_instrument", NULL_INSTRUMENT)
 
-    def display(self, tract=None, patch=None, frames=None, frame0=0):
-        return display.CoaddDisplay(self, tract, patch, frames=None, frame0=frame0)
+    @property
+    def skyIndex(self):
+        """A SkyIndex over coord.ra/coord.dec, built on first use and cached."""
+        index = getattr(self, "_skyIndex", None)
+        if index is None:
+            index = SkyIndex(self.coord.ra.value, self.coord.dec.value)
+            self._skyIndex = index
+        return index
+
+    def cone_search(self, ra, dec, radius):
+        """Return the row indices of all objects within radius (radians) of (ra, dec).
+
+        For arrays of positions, returns a list of row index arrays, one per position.
+        """
+        return self.skyIndex.cone_search(ra, dec, radius)
+
+    def nearest(self, ra, dec, k=1):
+        """Return the row indices of, and separations to, the k objects nearest each position."""
+        return self.skyIndex.nearest(ra, dec, k=k)
+
+    def crossmatch(self, ra, dec, radius):
+        """Match external positions to their nearest object within radius (radians).
+
+        Returns ``(otherIndices, rowIndices, separations)``; see SkyIndex.crossmatch.
+        """
+        return self.skyIndex.crossmatch(ra, dec, radius)
+
+    @property
+    def idIndex(self):
+        """An IdIndex over the id column, built on first use and cached."""
+        index = getattr(self, "_idIndex", None)
+        if index is None:
+            index = IdIndex(self.id.value)
+            self._idIndex = index
+        return index
+
+    def lookup(self, ids):
+        """Return the row indices of the given object IDs (-1 for IDs not in the catalog)."""
+        return self.idIndex.lookup(ids)
 
     def __getitem__(self, k):
         r = ColumnAttributeProxy.__getitem__(self, k)
         r._coadds = self._coadds
+        r._instrument = self.instrument
+        r.filters = self.filters
+        r.reruns = self.reruns
+        return r
+
+    def materialize(self):
+        r = ColumnAttributeProxy.materialize(self)
+        r._coadds = self._coadds
+        r._instrument = self.instrument
         r.filters = self.filters
+        r.reruns = self.reruns
         return r
 
 
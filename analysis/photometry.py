@@ -0,0 +1,88 @@
+import numpy
+
+MAG_ERR_SCALE = 2.5/numpy.log(10.0)
+
+
+class MagnitudeEngine(object):
+    """Vectorized flux to magnitude conversion for a single photometric zero point.
+
+    This reproduces Calib.getMagnitude with throwOnNegativeFlux disabled
+    (NaN magnitudes and errors for zero or negative fluxes), without
+    touching the global Calib state and without a Python loop over 2-d
+    (e.g. aperture) flux columns.
+    """
+
+    def __init__(self, fluxMag0, fluxMag0Err=0.0):
+        if not fluxMag0 > 0:
+            raise ValueError("Invalid zero point flux {}".format(fluxMag0))
+        self.fluxMag0 = float(fluxMag0)
+        self.fluxMag0Err = float(fluxMag0Err)
+
+    @classmethod
+    def fromCalib(cls, calib):
+        fluxMag0, fluxMag0Err = calib.getFluxMag0()
+        return cls(fluxMag0, fluxMag0Err)
+
+    def magnitude(self, flux, out=None):
+        """Return the magnitudes for a flux array, writing them into ``out`` if it is not None."""
+        if out is None:
+            out = numpy.empty(flux.shape, dtype=float)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            numpy.divide(flux, self.fluxMag0, out=out)
+            numpy.log10(out, out=out)
+            out *= -2.5
+            # flux <= 0 (and NaN flux) gives NaN, in every column of 2-d (aperture) fluxes
+            numpy.copyto(out, numpy.nan, where=~(flux > 0))
+        return out
+
+    def magnitudeErr(self, flux, fluxErr, out=None):
+        """Return the magnitude errors for flux and flux error arrays, writing them into ``out`` if
+        it is not None."""
+        if out is None:
+            out = numpy.empty(flux.shape, dtype=float)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            numpy.divide(fluxErr, flux, out=out)
+            numpy.hypot(out, self.fluxMag0Err/self.fluxMag0, out=out)
+            out *= MAG_ERR_SCALE
+            numpy.copyto(out, numpy.nan, where=~(flux > 0))
+        return out
+
+    def __call__(self, flux, fluxErr, mag=None, magErr=None):
+        """Convert a flux array and its errors to magnitudes.
+
+        If ``mag`` and/or ``magErr`` are provided, the results are written into
+        them (they may be strided views, e.g. afw column views).  Returns
+        ``(mag, magErr)``.
+        """
+        return self.magnitude(flux, out=mag), self.magnitudeErr(flux, fluxErr, out=magErr)
+
+    def convertAll(self, items):
+        """Convert a sequence of flux arrays with the same number of rows.
+
+        Each item is a ``(flux, fluxErr)`` pair, or a ``(flux, fluxErr, wantMag,
+        wantErr)`` tuple to compute only some of the outputs (``fluxErr`` may
+        then be None if ``wantErr`` is False).  All outputs are views into a
+        single preallocated block, so converting every flux column of a
+        catalog costs one allocation.  Returns a list of (mag, magErr) pairs in
+        the same order as the inputs, with None for the outputs not wanted.
+        """
+        items = [tuple(item) + (True, True) if len(item) == 2 else tuple(item) for item in items]
+        if not items:
+            return []
+        size = len(items[0][0])
+        widths = [int(numpy.prod(flux.shape[1:])) for flux, _, _, _ in items]
+        total = sum(width*(wantMag + wantErr) for (_, _, wantMag, wantErr), width in zip(items, widths))
+        block = numpy.empty((total, size), dtype=float)
+        results = []
+        start = 0
+        for (flux, fluxErr, wantMag, wantErr), width in zip(items, widths):
+            mag = magErr = None
+            # outputs are transposed, so each of their columns is contiguous within the block
+            if wantMag:
+                mag = self.magnitude(flux, out=block[start:start+width].T.reshape(flux.shape))
+                start += width
+            if wantErr:
+                magErr = self.magnitudeErr(flux, fluxErr, out=block[start:start+width].T.reshape(flux.shape))
+                start += width
+            results.append((mag, magErr))
+        return results
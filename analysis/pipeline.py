@@ -0,0 +1,60 @@
+import collections
+import itertools
+from multiprocessing.pool import ThreadPool
+
+
+def prefetch(func, items, depth=4, threads=None):
+    """Like itertools.imap, but with up to ``depth`` calls running ahead in a thread pool.
+
+    Results are yielded in the order of ``items``, and at most ``depth`` of
+    them are held (completed or in flight) beyond the one being consumed, so
+    both ordering and memory use are deterministic.  Exceptions are raised
+    when the corresponding result is reached.
+    """
+    pool = ThreadPool(threads if threads is not None else depth)
+    pending = collections.deque()
+    items = iter(items)
+    try:
+        for item in itertools.islice(items, depth):
+            pending.append(pool.apply_async(func, (item,)))
+        while pending:
+            result = pending.popleft().get()
+            for item in itertools.islice(items, 1):
+                pending.append(pool.apply_async(func, (item,)))
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class ReadAhead(object):
+    """Serve a planned sequence of reads from a background prefetch.
+
+    ``keys`` are the (hashable) reads expected, in the order they will be
+    asked for, and ``fetch(key)`` performs one of them; they are run up to
+    ``depth`` ahead with prefetch().  get() returns a prefetched result when
+    the key was planned, and otherwise just calls ``fetch`` directly, so it is
+    always safe to ask for reads that weren't planned (or to skip some).
+    Results for planned keys that get() moves past are dropped as it does, so
+    a skipped read is not held until close(); asking for it later just
+    fetches it again.
+    """
+
+    def __init__(self, fetch, keys, depth=4, threads=None):
+        keys = list(keys)
+        self._planned = collections.Counter(keys)
+        self._results = prefetch(lambda key: (key, fetch(key)), keys, depth=depth, threads=threads)
+
+    def get(self, key, fetch):
+        if not self._planned[key]:
+            return fetch(key)
+        for k, value in self._results:
+            self._planned[k] -= 1
+            if k == key:
+                return value
+        return fetch(key)
+
+    def close(self):
+        """Stop any outstanding reads and drop unused results."""
+        self._results.close()
+        self._planned.clear()
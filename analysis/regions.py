@@ -0,0 +1,86 @@
+import os
+import numpy
+
+import lsst.afw.display.ds9
+
+
+def quadrupoleToAxes(xx, yy, xy):
+    """Convert arrays of second moments to ellipse axes.
+
+    Returns ``(a, b, theta)`` arrays, with theta in radians; this is a
+    vectorized version of lsst.afw.geom.ellipses.Axes(Quadrupole(xx, yy, xy)),
+    and like it produces NaNs for moments that aren't positive definite.
+    """
+    xx = numpy.asarray(xx, dtype=float)
+    yy = numpy.asarray(yy, dtype=float)
+    xy = numpy.asarray(xy, dtype=float)
+    with numpy.errstate(invalid="ignore"):
+        trace = xx + yy
+        diff = xx - yy
+        root = numpy.sqrt(diff**2 + 4.0*xy**2)
+        a = numpy.sqrt(0.5*(trace + root))
+        b = numpy.sqrt(0.5*(trace - root))
+        theta = 0.5*numpy.arctan2(2.0*xy, diff)
+    return a, b, theta
+
+
+def rgbaToHex(rgba):
+    """Convert an (N, 3) or (N, 4) array of RGB[A] values in [0, 1] to a list of "#rrggbb" strings."""
+    rgb = (numpy.asarray(rgba)[:, :3]*255).astype(int)
+    return ["#%02x%02x%02x" % (r, g, b) for r, g, b in rgb]
+
+
+def _finiteRows(*arrays):
+    good = numpy.ones(numpy.shape(arrays[0]), dtype=bool)
+    for array in arrays:
+        good &= numpy.isfinite(array)
+    return numpy.flatnonzero(good)
+
+
+def ellipseRegions(x, y, a, b, theta, attributes=""):
+    """Return ds9 region lines for ellipses, given axes and angles in radians.
+
+    Positions are in ds9's (1-indexed) image coordinates, and rows with
+    non-finite values are skipped; ``attributes`` is appended to each line
+    (e.g. "color=red").
+    """
+    theta = numpy.degrees(theta)
+    fmt = "image; ellipse(%r,%r,%r,%r,%r) # " + attributes + "\n"
+    return [fmt % (x[i], y[i], a[i], b[i], theta[i]) for i in _finiteRows(x, y, a, b, theta)]
+
+
+def lineRegions(x0, y0, x1, y1, attributes=""):
+    """Return ds9 region lines for line segments; see ellipseRegions."""
+    fmt = "image; line(%r,%r,%r,%r) # " + attributes + "\n"
+    return [fmt % (x0[i], y0[i], x1[i], y1[i]) for i in _finiteRows(x0, y0, x1, y1)]
+
+
+def pointRegions(x, y, attributes=""):
+    """Return ds9 region lines for points; see ellipseRegions."""
+    fmt = "image; point(%r,%r) # " + attributes + "\n"
+    return [fmt % (x[i], y[i]) for i in _finiteRows(x, y)]
+
+
+def textRegions(x, y, texts, attributes=""):
+    """Return ds9 region lines for text labels; see ellipseRegions."""
+    fmt = "image; text(%r,%r) # text={%s} " + attributes + "\n"
+    return [fmt % (x[i], y[i], texts[i]) for i in _finiteRows(x, y)]
+
+
+def sendRegions(frame, regions, chunkSize=1 << 20):
+    """Send a ds9 region document to a frame with a single xpaset call.
+
+    ``regions`` may be a string or a sequence of lines; it is written to the
+    xpaset pipe in chunks of ``chunkSize`` bytes.
+    """
+    if not isinstance(regions, basestring):
+        regions = "".join(regions)
+    if not regions:
+        return
+    lsst.afw.display.ds9.ds9Cmd(lsst.afw.display.ds9.selectFrame(frame))
+    pfd = os.popen("xpaset {0} regions".format(lsst.afw.display.ds9.getXpaAccessPoint()), "w")
+    try:
+        for start in xrange(0, len(regions), chunkSize):
+            pfd.write(regions[start:start+chunkSize])
+    finally:
+        pfd.close()
@@ -2,9 +2,34 @@ import numpy as np
 from lsst.obs.hsc import HscMapper
 from lsst.afw.image import Filter
 
-def splitCoaddId(oid, asDict=True, hasFilter=True):
+_filterNames = {}
+
+def getFilterName(filterId):
+    """Return the name the butler uses for a filter ID (e.g. "HSC-I"), caching the result."""
+    name = _filterNames.get(filterId)
+    if name is None:
+        name = Filter(int(filterId)).getName()
+        filesystemName = "HSC-%s" % name.upper() # name mapper needs
+        try:
+            Filter(filesystemName)
+            name = filesystemName
+        except:
+            pass
+        _filterNames[filterId] = name
+    return name
+
+def getFilterId(filterName):
+    """Return the filter ID for a filter name, or pass through an integer ID."""
+    if isinstance(filterName, basestring):
+        return Filter(filterName).getId()
+    return int(filterName)
+
+def splitCoaddId(oid, asDict=True, hasFilter=True, patchStrings=True):
     """Split an ObjectId (maybe an numpy array) into tract, patch, [filter], and objId.
     See obs/subaru/python/lsst/obs/hscSim/hscMapper.py
+
+    If patchStrings is False, patch is returned as a (patchX, patchY) tuple of
+    integer arrays rather than "x,y" strings.
     """
 
     oid = np.array(oid, dtype='int64')
@@ -14,23 +39,9 @@ def splitCoaddId(oid, asDict=True, hasFilter=True):
     if hasFilter:
         filterId = np.bitwise_and(oid, 2**HscMapper._nbit_filter - 1).astype('int32')
         oid >>= HscMapper._nbit_filter
-
-        filterName = np.empty(oid.size, "a6")
-
-        if filterId.size == 1:
-            filterId = [int(filterId)] # as you can't iterate over a length-1 np array
-
-        for fid in set(filterId):
-            name = Filter(int(fid)).getName()
-
-            filesystemName = "HSC-%s" % name.upper() # name mapper needs
-            try:
-                Filter(filesystemName)
-                name = filesystemName
-            except:
-                pass
-
-            filterName[filterId == fid] = name
+        uniqueIds, inverse = np.unique(filterId, return_inverse=True)
+        names = np.array([getFilterName(fid) for fid in uniqueIds], dtype="a6")
+        filterName = names[inverse.reshape(filterId.shape)]
     else:
         filterName = None
 
@@ -38,19 +49,82 @@ def splitCoaddId(oid, asDict=True, hasFilter=True):
     oid >>= HscMapper._nbit_patch
     patchX = np.bitwise_and(oid, 2**HscMapper._nbit_patch - 1).astype('int32')
     oid >>= HscMapper._nbit_patch
-    add = np.core.defchararray.add # why isn't this easier to find?
-    patch = add(add(patchX.astype(str), ","), patchY.astype(str))
-    #patch.shape = filterName.shape # why do I have to do this?
+    if patchStrings:
+        # only format each distinct patch once
+        uniqueCodes, inverse = np.unique((patchX << HscMapper._nbit_patch) | patchY, return_inverse=True)
+        names = np.array(["%d,%d" % (code >> HscMapper._nbit_patch, code & (2**HscMapper._nbit_patch - 1))
+                          for code in uniqueCodes], dtype=str)
+        patch = names[inverse.reshape(patchX.shape)]
+    else:
+        patch = (patchX, patchY)
 
     tract = oid.astype('int32')
 
     if oid.size == 1:     # sqlite doesn't like numpy types
-        filterName = str(filterName[0])
+        if filterName is not None:
+            filterName = str(filterName.ravel()[0])
         tract = int(tract)
-        patch = str(patch[0])
+        if patchStrings:
+            patch = str(patch.ravel()[0])
+        else:
+            patch = (int(patchX), int(patchY))
         objId = int(objId)
 
     if asDict:
         return {"filter" : filterName, "tract" : tract, "patch" : patch, "objId" : objId}
     else:
         return filterName, tract, patch, objId
+
+def makeCoaddId(tract, patchX, patchY, objId, filter=None):
+    """Pack tract, patch, [filter] and objId (scalars or arrays) into ObjectIds.
+
+    This is the inverse of splitCoaddId; ``filter`` may be a filter name or
+    ID, and is omitted from the ID if None (as for merged coadd objects).
+    """
+    oid = np.array(tract, dtype='int64')
+    oid = (oid << HscMapper._nbit_patch) | np.asarray(patchX, dtype='int64')
+    oid = (oid << HscMapper._nbit_patch) | np.asarray(patchY, dtype='int64')
+    if filter is not None:
+        oid = (oid << HscMapper._nbit_filter) | getFilterId(filter)
+    oid = (oid << HscMapper._nbit_id) | np.asarray(objId, dtype='int64')
+    if oid.ndim == 0:
+        return int(oid)
+    return oid
+
+
+class IdIndex(object):
+    """A sorted index of object IDs for vectorized row lookups."""
+
+    def __init__(self, ids):
+        ids = np.asarray(ids)
+        if len(ids) and np.all(ids[1:] >= ids[:-1]):
+            self.order = None   # already sorted, as afw catalogs usually are
+            self.sorted = ids
+        else:
+            self.order = np.argsort(ids, kind="mergesort")
+            self.sorted = ids[self.order]
+
+    def lookup(self, ids):
+        """Return the row indices of the given IDs, with -1 for IDs that aren't present."""
+        ids = np.asarray(ids)
+        if len(self.sorted) == 0:
+            return np.full(ids.shape, -1, dtype=int)
+        pos = np.searchsorted(self.sorted, ids)
+        pos = np.minimum(pos, len(self.sorted) - 1)
+        found = self.sorted[pos] == ids
+        if self.order is not None:
+            pos = self.order[pos]
+        return np.where(found, pos, -1)
+
+
+def alignIds(idArrays):
+    """Return row indices that align several arrays of unique object IDs.
+
+    The result has one integer array per input; indexing each input with its
+    array gives the IDs present in all of them, in ascending order.
+    """
+    indexes = [IdIndex(ids) for ids in idArrays]
+    common = indexes[0].sorted
+    for index in indexes[1:]:
+        common = np.intersect1d(common, index.sorted, assume_unique=True)
+    return [index.lookup(common) for index in indexes]
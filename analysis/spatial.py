@@ -0,0 +1,76 @@
+import numpy
+
+
+def unitVectors(ra, dec):
+    """Return an (N, 3) array of unit vectors for arrays of ra, dec in radians."""
+    ra = numpy.asarray(ra, dtype=float)
+    dec = numpy.asarray(dec, dtype=float)
+    cosDec = numpy.cos(dec)
+    return numpy.column_stack([(cosDec*numpy.cos(ra)).ravel(),
+                               (cosDec*numpy.sin(ra)).ravel(),
+                               numpy.sin(dec).ravel()])
+
+
+def _chord(radius):
+    return 2.0*numpy.sin(0.5*numpy.minimum(radius, numpy.pi))
+
+
+def _angle(chord):
+    return 2.0*numpy.arcsin(numpy.minimum(0.5*chord, 1.0))
+
+
+class SkyIndex(object):
+    """A spatial index for spherical neighbour queries.
+
+    Positions are stored as unit vectors in a KD-tree, so queries are exact
+    everywhere on the sphere (including near the poles and ra=0).  All angles
+    are in radians, matching the coord.ra/coord.dec columns of afw catalogs.
+
+    Requires scipy.
+    """
+
+    def __init__(self, ra, dec):
+        from scipy.spatial import cKDTree
+        self.size = numpy.size(ra)
+        self.tree = cKDTree(unitVectors(ra, dec))
+
+    def cone_search(self, ra, dec, radius):
+        """Return a sorted array of the indices of all points within radius of (ra, dec).
+
+        If ``ra`` and ``dec`` are arrays, return a list of such arrays, one per
+        (flattened) position; ``radius`` may then be an array too.
+        """
+        if numpy.ndim(ra) == 0 and numpy.ndim(dec) == 0:
+            indices = self.tree.query_ball_point(unitVectors(ra, dec)[0], _chord(radius))
+            return numpy.array(sorted(indices), dtype=int)
+        ra, dec = numpy.broadcast_arrays(ra, dec)
+        vectors = unitVectors(ra, dec)
+        if numpy.ndim(radius) == 0:
+            found = self.tree.query_ball_point(vectors, _chord(radius))
+        else:
+            chords = _chord(numpy.broadcast_arrays(radius, ra)[0]).ravel()
+            found = [self.tree.query_ball_point(vector, chord) for vector, chord in zip(vectors, chords)]
+        return [numpy.array(sorted(indices), dtype=int) for indices in found]
+
+    def nearest(self, ra, dec, k=1):
+        """Return the indices of and separations to the k nearest neighbours of each position.
+
+        ``ra`` and ``dec`` may be scalars or arrays; the results have shape
+        ``numpy.shape(ra) + (k,)``, or ``numpy.shape(ra)`` if ``k == 1``.
+        """
+        shape = numpy.shape(ra)
+        chord, indices = self.tree.query(unitVectors(ra, dec), k=k)
+        if k != 1:
+            shape += (k,)
+        return indices.reshape(shape), _angle(chord).reshape(shape)
+
+    def crossmatch(self, ra, dec, radius):
+        """Match each of a set of external positions to its nearest neighbour within radius.
+
+        Returns ``(otherIndices, selfIndices, separations)`` for the matched
+        positions only, in order of ``otherIndices``.  Several external
+        positions may match the same point in this index.
+        """
+        chord, indices = self.tree.query(unitVectors(ra, dec), k=1, distance_upper_bound=_chord(radius))
+        otherIndices = numpy.flatnonzero(indices < self.size)
+        return otherIndices, indices[otherIndices], _angle(chord[otherIndices])
@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from analysis.bench import FakeButler
+from analysis.objects import ObjectCatalog
+from analysis.aggregate import aggregate, BinnedStatistics
+
+
+class BinnedStatisticsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(7)
+        self.x = rng.uniform(-0.5, 10.5, size=5000)
+        self.y = rng.uniform(0.0, 2.0, size=5000)
+        self.values = rng.normal(self.x, 1.0)
+        self.values[::50] = numpy.nan
+        self.edges = numpy.linspace(0.0, 10.0, 6)
+
+    def testMoments(self):
+        stats = BinnedStatistics([self.edges], valueRange=(-5.0, 15.0), valueBins=2000)
+        stats.add([self.x], self.values)
+        for n in xrange(5):
+            inBin = (self.x >= self.edges[n]) & (self.x < self.edges[n + 1]) & numpy.isfinite(self.values)
+            self.assertEqual(stats.count[n], inBin.sum())
+            self.assertAlmostEqual(stats.mean()[n], self.values[inBin].mean())
+            self.assertAlmostEqual(stats.std()[n], self.values[inBin].std())
+            self.assertEqual(stats.min[n], self.values[inBin].min())
+            self.assertEqual(stats.max[n], self.values[inBin].max())
+            for q in (0.1, 0.5, 0.9):
+                # accurate to about one value bin
+                self.assertAlmostEqual(stats.quantile(q)[n], numpy.percentile(self.values[inBin], 100*q),
+                                       delta=0.02)
+
+    def testMerge(self):
+        """Merging the statistics of subsets gives exactly those of the whole set."""
+        whole = BinnedStatistics([self.edges, [0.0, 1.0, 2.0]], valueRange=(-5.0, 15.0))
+        whole.add([self.x, self.y], self.values)
+        merged = BinnedStatistics([self.edges, [0.0, 1.0, 2.0]], valueRange=(-5.0, 15.0))
+        for part in (slice(0, 1000), slice(1000, 4000), slice(4000, None)):
+            partial = BinnedStatistics([self.edges, [0.0, 1.0, 2.0]], valueRange=(-5.0, 15.0))
+            partial.add([self.x[part], self.y[part]], self.values[part])
+            merged.merge(partial)
+        numpy.testing.assert_array_equal(merged.count, whole.count)
+        numpy.testing.assert_array_equal(merged.histogram, whole.histogram)
+        numpy.testing.assert_array_equal(merged.min, whole.min)
+        numpy.testing.assert_array_equal(merged.max, whole.max)
+        numpy.testing.assert_allclose(merged.sum, whole.sum)
+        numpy.testing.assert_array_equal(merged.median(), whole.median())
+        self.assertRaises(ValueError, merged.merge, BinnedStatistics([self.edges]))
+
+    def testEmptyBins(self):
+        stats = BinnedStatistics([self.edges], valueRange=(0.0, 1.0))
+        stats.add([numpy.array([0.5])], numpy.array([0.25]))
+        self.assertEqual(stats.count.tolist(), [1, 0, 0, 0, 0])
+        self.assertTrue(numpy.isnan(stats.quantile(0.5)[1:]).all())
+        self.assertTrue(numpy.isnan(stats.mean()[1:]).all())
+        self.assertEqual(stats.quantile(0.5)[0], 0.25)
+
+    def testCountsOnly(self):
+        stats = BinnedStatistics([self.edges])
+        stats.add([self.x])
+        numpy.testing.assert_array_equal(stats.count, numpy.histogram(self.x, bins=self.edges)[0] -
+                                         [0, 0, 0, 0, (self.x == 10.0).sum()])
+        self.assertRaises(ValueError, stats.quantile, 0.5)
+
+
+class AggregateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.butler = FakeButler(self.root, patches=("1,1", "1,2"), filters=("i",), rows=50, fields=20,
+                                 apertures=2)
+        self.kwds = dict(tract=0, patches=self.butler.patches, filters=("i",))
+        self.objs = ObjectCatalog.read(self.butler, images=False, footprints=False, progress=False,
+                                       **self.kwds)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check(self, where, rows):
+        edges = numpy.linspace(-100.0, 100.0, 5)
+        stats = aggregate(self.butler, "i.meas.cmodel.mag", edges, value="i.meas.cmodel.exp.ellipse.rDet",
+                          where=where, **self.kwds)
+        mag = self.objs.i.meas.cmodel.mag.value[rows]
+        rDet = self.objs.i.meas.cmodel.exp.ellipse.rDet.value[rows]
+        good = numpy.isfinite(mag) & numpy.isfinite(rDet)
+        expected, _ = numpy.histogram(mag[good], bins=edges, weights=rDet[good])
+        numpy.testing.assert_allclose(stats.sum, expected)
+        self.assertEqual(stats.count.sum(), good.sum())
+
+    def testCalculatedValue(self):
+        """Calculated fields in expressions get their inputs loaded."""
+        self.check(None, slice(None))
+
+    def testWhere(self):
+        primary = self.objs.detect.is_primary.value
+        self.check("detect.is-primary", primary)
+        self.check(lambda p: p.detect.is_primary.value, primary)
+
+
+if __name__ == "__main__":
+    unittest.main()
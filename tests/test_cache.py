@@ -0,0 +1,40 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from analysis.bench import FakeButler
+from analysis.objects import ObjectCatalog
+
+
+class ColumnCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.butler = FakeButler(self.root, filters=("i",), rows=50, fields=20, apertures=2)
+        self.cache = tempfile.mkdtemp()
+        self.kwds = dict(tract=0, patch="1,1", filters=("i",), images=False, progress=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.cache)
+
+    def testFootprintSettingsInCacheKey(self):
+        """A cached read without footprints must not be reused by a read that wants them."""
+        first = ObjectCatalog.read(self.butler, footprints=False, cache=self.cache, **self.kwds)
+        self.assertNotIn("footprint", first.i._children)
+        expected = ObjectCatalog.read(self.butler, footprints=True, compactFootprints=True, **self.kwds)
+        for footprints in (True, True, False):
+            objs = ObjectCatalog.read(self.butler, footprints=footprints, compactFootprints=True,
+                                      cache=self.cache, **self.kwds)
+            if footprints:
+                areas = objs.i.footprint.value.getArea()
+                self.assertTrue((areas > 0).all())
+                numpy.testing.assert_array_equal(areas, expected.i.footprint.value.getArea())
+            else:
+                self.assertNotIn("footprint", objs.i._children)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import lsst.afw.table
+
+from analysis.bench import FakeButler
+from analysis.catalogs import ColumnTransfer
+
+
+class ColumnTransferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.butler = FakeButler(self.root, filters=("i",), rows=50, fields=40, apertures=3)
+        self.dataId = dict(tract=0, patch="1,1")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check(self, inCat):
+        """ColumnTransfer must give the same output as assign() with a SchemaMapper, for every field."""
+        inSchema = inCat.schema
+        mapper = lsst.afw.table.SchemaMapper(inSchema)
+        transfer = ColumnTransfer(inSchema)
+        for item in inSchema:
+            outName = "out." + item.field.getName()
+            transfer.add(item, mapper.addMapping(item.key, outName), outName)
+        outSchema = mapper.getOutputSchema()
+        transfer.finish(outSchema)
+        expected = lsst.afw.table.BaseCatalog(outSchema)
+        expected.reserve(len(inCat))
+        for inRecord in inCat:
+            expected.addNew().assign(inRecord, mapper)
+        result = lsst.afw.table.BaseCatalog(outSchema)
+        result.reserve(len(inCat))
+        for n in xrange(len(inCat)):
+            result.addNew()
+        transfer(inCat, result)
+        expectedColumns = expected.extract("*")
+        resultColumns = result.extract("*")
+        self.assertEqual(sorted(resultColumns), sorted(expectedColumns))
+        for name, column in expectedColumns.iteritems():
+            numpy.testing.assert_array_equal(resultColumns[name], column, err_msg=name)
+
+    def testMeas(self):
+        self.check(self.butler.get("deepCoadd_meas", self.dataId, filter="HSC-I"))
+
+    def testRef(self):
+        """The ref catalog has Coord and Flag fields, which must go through the per-record mapper."""
+        self.check(self.butler.get("deepCoadd_ref", self.dataId))
+
+
+if __name__ == "__main__":
+    unittest.main()
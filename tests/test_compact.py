@@ -0,0 +1,84 @@
+import unittest
+
+import numpy
+
+from analysis.compact import EncodedColumn, ColumnCompactor, PackedFlag, Categorical, codeDtype
+
+
+def makePatch(size, seed):
+    rng = numpy.random.RandomState(seed)
+    columns = {("id",): numpy.arange(size), ("coord", "ra"): rng.uniform(size=size),
+               ("i", "meas", "cmodel", "mag"): rng.uniform(18.0, 26.0, size=size)}
+    for n in xrange(70):   # enough flags for two words in one group
+        columns[("i", "flags", "f%d" % n)] = rng.uniform(size=size) < 0.3
+    columns[("detect", "is-primary")] = rng.uniform(size=size) < 0.5
+    return columns
+
+
+class ColumnCompactorTestCase(unittest.TestCase):
+
+    def testRoundTrip(self):
+        """Compacted and expanded columns decode to the original values, with floats downcast."""
+        patches = [makePatch(20, 1), makePatch(15, 2)]
+        compactor = ColumnCompactor()
+        compacted = [compactor(patch) for patch in patches]
+        self.assertEqual(compacted[0][("i", "__flags__")].shape, (20, 2))
+        self.assertEqual(compacted[0][("i", "meas", "cmodel", "mag")].dtype, numpy.float32)
+        self.assertEqual(compacted[0][("coord", "ra")].dtype, numpy.float64)
+        assembled = {key: numpy.concatenate([c[key] for c in compacted]) for key in compacted[0]}
+        columns = compactor.expand(assembled)
+        for key in patches[0]:
+            expected = numpy.concatenate([patch[key] for patch in patches])
+            column = columns[key]
+            if expected.dtype == bool:
+                self.assertIsInstance(column, PackedFlag)
+                numpy.testing.assert_array_equal(column.decode(), expected)
+                rows = numpy.array([3, 30, 7])
+                numpy.testing.assert_array_equal(column.decode(rows), expected[rows])
+            else:
+                numpy.testing.assert_allclose(column, expected, rtol=1E-6)
+
+    def testDifferentFlags(self):
+        compactor = ColumnCompactor()
+        compactor(makePatch(5, 1))
+        patch = makePatch(5, 2)
+        del patch[("i", "flags", "f3")]
+        self.assertRaises(ValueError, compactor, patch)
+
+    def testSelect(self):
+        """Selecting from columns that share storage copies that storage once."""
+        compactor = ColumnCompactor()
+        patch = makePatch(30, 3)
+        columns = compactor.expand(compactor(patch))
+        rows = numpy.array([1, 5, 29, 5])
+        memo = {}
+        selected = {key: columns[key].select(rows, memo) for key in patch if patch[key].dtype == bool}
+        self.assertEqual(len(set(id(flag.words) for flag in selected.itervalues())), 2)
+        for key, flag in selected.iteritems():
+            numpy.testing.assert_array_equal(flag.decode(), patch[key][rows])
+
+    def testCategorical(self):
+        categories = numpy.array(["1,1", "1,2", "2,2"])
+        codes = numpy.array([2, 0, 0, 1], dtype=codeDtype(len(categories)))
+        column = Categorical(codes, categories)
+        self.assertEqual(len(column), 4)
+        numpy.testing.assert_array_equal(column.decode(), categories[[2, 0, 0, 1]])
+        numpy.testing.assert_array_equal(column.decode(numpy.array([3, 0])), ["1,2", "2,2"])
+        numpy.testing.assert_array_equal(column.select(slice(1, 3), {}).decode(), ["1,1", "1,1"])
+
+    def testInterface(self):
+        """EncodedColumn subclasses must provide the whole interface."""
+        class Incomplete(EncodedColumn):
+            def __len__(self):
+                return 0
+        self.assertRaises(TypeError, Incomplete)
+        self.assertIsInstance(Categorical(numpy.zeros(3, dtype=numpy.uint8), ["a"]), EncodedColumn)
+
+    def testCodeDtype(self):
+        self.assertEqual(codeDtype(256), numpy.uint8)
+        self.assertEqual(codeDtype(257), numpy.uint16)
+        self.assertEqual(codeDtype(2**16 + 1), numpy.uint32)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import lsst.afw.detection
+
+from analysis.bench import FakeButler
+from analysis.objects import ObjectCatalog
+from analysis.footprints import FootprintArray, paintSpans, packFootprintColumns, unpackFootprintColumns
+
+
+def makeFootprintArray(areas, heavy, seed=1):
+    """Return a FootprintArray with one single-span row of each given area, and random pixels if heavy."""
+    rng = numpy.random.RandomState(seed)
+    areas = numpy.asarray(areas, dtype=numpy.int64)
+    offsets = numpy.arange(len(areas) + 1, dtype=numpy.int64)
+    x0 = rng.randint(0, 100, size=len(areas)).astype(numpy.int32)
+    result = FootprintArray(numpy.arange(len(areas), dtype=numpy.int32), x0, (x0 + areas - 1).astype(numpy.int32),
+                            offsets, x0, numpy.arange(len(areas), dtype=numpy.int32),
+                            numpy.ones(len(areas), dtype=numpy.float32), offsets)
+    if heavy:
+        pixelOffsets = numpy.zeros(len(areas) + 1, dtype=numpy.int64)
+        numpy.cumsum(areas, out=pixelOffsets[1:])
+        result.image = rng.normal(size=pixelOffsets[-1]).astype(numpy.float32)
+        result.mask = rng.randint(0, 4, size=pixelOffsets[-1]).astype(numpy.uint16)
+        result.variance = rng.uniform(size=pixelOffsets[-1]).astype(numpy.float32)
+        result.pixelOffsets = pixelOffsets
+    return result
+
+
+def rowSpans(footprints, i):
+    spans = slice(footprints.spanOffsets[i], footprints.spanOffsets[i+1])
+    return footprints.spanY[spans], footprints.spanX0[spans], footprints.spanX1[spans]
+
+
+class FootprintArrayTestCase(unittest.TestCase):
+
+    def assertRowsEqual(self, result, original, rows):
+        self.assertEqual(len(result), len(rows))
+        self.assertEqual(result.isHeavy, original.isHeavy)
+        for n, i in enumerate(rows):
+            for a, b in zip(rowSpans(result, n), rowSpans(original, i)):
+                numpy.testing.assert_array_equal(a, b)
+            if original.isHeavy:
+                numpy.testing.assert_array_equal(
+                    result.image[result.pixelOffsets[n]:result.pixelOffsets[n+1]],
+                    original.image[original.pixelOffsets[i]:original.pixelOffsets[i+1]])
+
+    def testIndexing(self):
+        """Slices, boolean masks and index arrays select rows, spans and pixels consistently."""
+        for heavy in (False, True):
+            footprints = makeFootprintArray([3, 0, 5, 2, 7, 1], heavy=heavy)
+            numpy.testing.assert_array_equal(footprints.getArea(), [3, 0, 5, 2, 7, 1])
+            self.assertRowsEqual(footprints[1:4], footprints, [1, 2, 3])
+            self.assertRowsEqual(footprints[::-2], footprints, [5, 3, 1])
+            mask = numpy.array([True, False, True, False, False, True])
+            self.assertRowsEqual(footprints[mask], footprints, [0, 2, 5])
+            self.assertRowsEqual(footprints[numpy.array([4, 4, 0])], footprints, [4, 4, 0])
+            self.assertRowsEqual(footprints[[2, 0]][[1]], footprints, [0])
+
+    def testConcatenate(self):
+        a = makeFootprintArray([3, 4], heavy=True, seed=1)
+        b = makeFootprintArray([5], heavy=True, seed=2)
+        result = FootprintArray.concatenate([a[1:], b, a[:1]])
+        numpy.testing.assert_array_equal(result.getArea(), [4, 5, 3])
+        numpy.testing.assert_array_equal(result.image, numpy.concatenate([a[1:].image, b.image, a[:1].image]))
+        self.assertRowsEqual(result[2:], a, [0])
+
+    def testPacking(self):
+        footprints = makeFootprintArray([3, 4, 5], heavy=True)
+        columns = {("id",): numpy.arange(3), ("i", "footprint"): footprints}
+        packed = packFootprintColumns(columns)
+        self.assertTrue(all(isinstance(v, numpy.ndarray) for v in packed.itervalues()))
+        unpacked = unpackFootprintColumns(packed)
+        self.assertEqual(sorted(unpacked), sorted(columns))
+        self.assertRowsEqual(unpacked[("i", "footprint")], footprints, [0, 1, 2])
+
+    def testConcatenateMixed(self):
+        """Concatenating heavy and plain FootprintArrays keeps the pixels of the heavy rows."""
+        heavy = makeFootprintArray([3, 4, 5], heavy=True)
+        light = makeFootprintArray([2, 6], heavy=False)
+        for parts in ([heavy, light], [light, heavy]):
+            result = FootprintArray.concatenate(parts)
+            self.assertTrue(result.isHeavy)
+            self.assertEqual(len(result), 5)
+            numpy.testing.assert_array_equal(result.getArea(), numpy.concatenate([p.getArea() for p in parts]))
+            numpy.testing.assert_array_equal(result.image, heavy.image)
+            pixels = numpy.diff(result.pixelOffsets)
+            numpy.testing.assert_array_equal(
+                pixels, numpy.concatenate([numpy.diff(p.pixelOffsets) if p.isHeavy else numpy.zeros(len(p))
+                                           for p in parts]))
+
+
+def paintEach(array, footprints, bits, xy0):
+    """Paint each row of a FootprintArray in turn, one span at a time, as setMaskFromFootprint does."""
+    height, width = array.shape
+    for i in xrange(len(footprints)):
+        for n in xrange(footprints.spanOffsets[i], footprints.spanOffsets[i+1]):
+            y = footprints.spanY[n] - xy0[1]
+            if y < 0 or y >= height:
+                continue
+            x0 = max(footprints.spanX0[n] - xy0[0], 0)
+            x1 = min(footprints.spanX1[n] - xy0[0], width - 1)
+            for x in xrange(x0, x1 + 1):
+                array[y, x] |= bits
+
+
+class PaintSpansTestCase(unittest.TestCase):
+
+    def testMatchesPerFootprintPainting(self):
+        """paintSpans gives bit-for-bit the same mask as painting footprints one by one, with clipping."""
+        rng = numpy.random.RandomState(5)
+        size = 200
+        spanCounts = rng.randint(0, 6, size=size)
+        offsets = numpy.zeros(size + 1, dtype=numpy.int64)
+        numpy.cumsum(spanCounts, out=offsets[1:])
+        nSpans = offsets[-1]
+        spanY = rng.randint(90, 160, size=nSpans).astype(numpy.int32)
+        spanX0 = rng.randint(40, 130, size=nSpans).astype(numpy.int32)
+        spanX1 = (spanX0 + rng.randint(-1, 15, size=nSpans)).astype(numpy.int32)  # including empty spans
+        peaks = numpy.zeros(size + 1, dtype=numpy.int64)
+        footprints = FootprintArray(spanY, spanX0, spanX1, offsets, numpy.zeros(0, dtype=numpy.int32),
+                                    numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.float32), peaks)
+        xy0 = (50, 100)
+        initial = rng.randint(0, 16, size=(40, 60)).astype(numpy.uint16)
+        expected = initial.copy()
+        paintEach(expected, footprints, 32, xy0)
+        result = initial.copy()
+        paintSpans(result, footprints.spanY, footprints.spanX0, footprints.spanX1, 32, xy0=xy0)
+        numpy.testing.assert_array_equal(result, expected)
+        rows = numpy.flatnonzero(rng.uniform(size=size) < 0.3)
+        expected = initial.copy()
+        paintEach(expected, footprints[rows], 32, xy0)
+        result = initial.copy()
+        subset = footprints[rows]
+        paintSpans(result, subset.spanY, subset.spanX0, subset.spanX1, 32, xy0=xy0)
+        numpy.testing.assert_array_equal(result, expected)
+
+
+class HeavyFootprintReadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.butler = FakeButler(self.root, filters=("i",), rows=50, fields=20, apertures=2)
+        self.kwds = dict(tract=0, patch="1,1", filters=("i",), images=False, progress=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testMixedHeavyFootprints(self):
+        """Compact heavy footprints match the afw ones, for both heavy and plain rows."""
+        objs = ObjectCatalog.read(self.butler, footprints="heavy", **self.kwds)
+        compact = ObjectCatalog.read(self.butler, footprints="heavy", compactFootprints=True, **self.kwds)
+        footprints = objs.i.footprint.value
+        array = compact.i.footprint.value
+        self.assertTrue(array.isHeavy)
+        heavy = numpy.array([fp.isHeavy() for fp in footprints])
+        self.assertTrue(heavy.any() and not heavy.all())
+        for i, fp in enumerate(footprints):
+            result = array[i]
+            self.assertEqual(result.isHeavy(), fp.isHeavy())
+            self.assertEqual(result.getArea(), fp.getArea())
+            if fp.isHeavy():
+                fp = lsst.afw.detection.HeavyFootprintF.cast(fp)
+                result = lsst.afw.detection.HeavyFootprintF.cast(result)
+                numpy.testing.assert_array_equal(result.getImageArray(), fp.getImageArray())
+                numpy.testing.assert_array_equal(result.getMaskArray(), fp.getMaskArray())
+                numpy.testing.assert_array_equal(result.getVarianceArray(), fp.getVarianceArray())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+import numpy
+
+from analysis.objects import ColumnAttributeProxy, evaluateExpression, _expressionPatterns, _matches
+
+
+def makeColumns(size=10, seed=1):
+    """Return a dict of patch-like columns, including ellipse moments for calculated fields."""
+    rng = numpy.random.RandomState(seed)
+    columns = {("id",): numpy.arange(size), ("detect", "is-primary"): rng.uniform(size=size) < 0.5}
+    for prefix in (("i", "meas", "cmodel", "exp", "ellipse"), ("i", "meas", "cmodel", "dev", "ellipse")):
+        columns[prefix + ("xx",)] = rng.uniform(1.0, 4.0, size=size)
+        columns[prefix + ("yy",)] = rng.uniform(1.0, 4.0, size=size)
+        columns[prefix + ("xy",)] = rng.uniform(-0.5, 0.5, size=size)
+    columns[("i", "meas", "cmodel", "fracDev")] = rng.uniform(size=size)
+    columns[("i", "meas", "cmodel", "mag")] = rng.uniform(18.0, 26.0, size=size)
+    columns[("r", "meas", "cmodel", "mag")] = rng.uniform(18.0, 26.0, size=size)
+    return columns
+
+
+class ExpressionTestCase(unittest.TestCase):
+
+    def check(self, expression, expected):
+        columns = makeColumns()
+        patterns = _expressionPatterns(expression)
+        selected = {key: column for key, column in columns.iteritems()
+                    if key == ("id",) or _matches(key, patterns)}
+        self.assertNotIn(("r", "meas", "cmodel", "mag"), selected)
+        result = evaluateExpression(expression, ColumnAttributeProxy._build(selected))
+        numpy.testing.assert_allclose(result, expected(ColumnAttributeProxy._build(columns)))
+
+    def testPlainFields(self):
+        self.check("i.meas.cmodel.mag - 2*i.meas.cmodel.fracDev",
+                   lambda p: p.i.meas.cmodel.mag.value - 2*p.i.meas.cmodel.fracDev.value)
+
+    def testCalculatedFields(self):
+        """The inputs of calculated fields are matched, even when nested."""
+        e = lambda p: p.i.meas.cmodel.exp.ellipse
+        self.check("i.meas.cmodel.exp.ellipse.rDet",
+                   lambda p: (e(p).xx.value*e(p).yy.value - e(p).xy.value**2)**0.25)
+        self.check("i.meas.cmodel.ellipse.rTr", lambda p: p.i.meas.cmodel.ellipse.rTr.value)
+
+    def testHyphens(self):
+        self.check("detect.is-primary & (i.meas.cmodel.mag < 22)",
+                   lambda p: p.detect.is_primary.value & (p.i.meas.cmodel.mag.value < 22))
+
+
+class ViewTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = makeColumns(size=20)
+        self.objs = ColumnAttributeProxy._build(self.columns)
+
+    def testComposition(self):
+        """Selections of selections compose, for slices, masks and index arrays."""
+        mag = self.columns[("i", "meas", "cmodel", "mag")]
+        mask = self.columns[("detect", "is-primary")]
+        for first, second in ((slice(2, 15), slice(None, None, 3)), (mask, numpy.array([2, 0, 1])),
+                              (numpy.array([5, 1, 7, 3]), numpy.array([True, False, True, True])),
+                              (slice(None, None, -1), 4)):
+            view = self.objs[first][second]
+            expected = mag[first][second]
+            numpy.testing.assert_array_equal(view.i.meas.cmodel.mag.value, expected)
+            if numpy.ndim(expected):
+                self.assertEqual(len(view), len(expected))
+
+    def testSelectByProxy(self):
+        view = self.objs[self.objs.detect.is_primary]
+        numpy.testing.assert_array_equal(view.id.value,
+                                         numpy.flatnonzero(self.columns[("detect", "is-primary")]))
+
+    def testMaterialize(self):
+        """materialize() copies the selected rows, including calculated fields' inputs, into a plain tree."""
+        view = self.objs[3:11][::2]
+        copy = view.materialize()
+        self.assertIsNone(copy._index)
+        self.assertEqual(len(copy), 4)
+        for key, column in self.columns.iteritems():
+            node = copy
+            for term in key:
+                node = getattr(node, term.replace("-", "_"))
+            numpy.testing.assert_array_equal(node.value, column[3:11][::2])
+        numpy.testing.assert_array_equal(copy.i.meas.cmodel.exp.ellipse.rDet.value,
+                                         view.i.meas.cmodel.exp.ellipse.rDet.value)
+        self.assertFalse(numpy.may_share_memory(copy.id.value, self.columns[("id",)]))
+
+    def testGatheredValuesAreKept(self):
+        """A view's values are gathered once, not on every access."""
+        objs = ColumnAttributeProxy._build(makeColumns())
+        view = objs[objs.detect.is_primary]
+        mag = view.i.meas.cmodel.mag
+        self.assertIs(mag.value, mag.value)
+        numpy.testing.assert_array_equal(mag.value, objs.i.meas.cmodel.mag.value[objs.detect.is_primary.value])
+        mag.value = numpy.zeros(3)
+        self.assertEqual(len(mag.value), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
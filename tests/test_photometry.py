@@ -0,0 +1,60 @@
+import unittest
+
+import numpy
+
+from analysis.photometry import MagnitudeEngine
+
+
+class MagnitudeEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = MagnitudeEngine(1E11, 1E9)
+        rng = numpy.random.RandomState(3)
+        self.flux = rng.lognormal(5.0, 2.0, size=(20, 3))
+        self.flux[:4, 0] = (0.0, -1.0, numpy.nan, 1E-3)
+        self.fluxErr = rng.lognormal(2.0, 1.0, size=(20, 3))
+
+    def testValues(self):
+        mag, magErr = self.engine(self.flux, self.fluxErr)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            expected = -2.5*numpy.log10(self.flux/1E11)
+            expectedErr = 2.5/numpy.log(10.0)*numpy.hypot(self.fluxErr/self.flux, 1E-2)
+        bad = ~(self.flux > 0)
+        expected[bad] = numpy.nan
+        expectedErr[bad] = numpy.nan
+        numpy.testing.assert_allclose(mag, expected)
+        numpy.testing.assert_allclose(magErr, expectedErr)
+        self.assertTrue(numpy.isnan(mag[:3, 0]).all() and numpy.isnan(magErr[:3, 0]).all())
+
+    def testConvertAll(self):
+        """convertAll matches converting each flux on its own, for 1-d and 2-d fluxes and subsets of outputs."""
+        items = [(self.flux[:, 0], self.fluxErr[:, 0]), (self.flux, self.fluxErr),
+                 (self.flux[:, 1], None, True, False), (self.flux, self.fluxErr, False, True)]
+        results = self.engine.convertAll(items)
+        self.assertEqual(len(results), len(items))
+        for item, (mag, magErr) in zip(items, results):
+            flux, fluxErr = item[:2]
+            wantMag, wantErr = item[2:] if len(item) == 4 else (True, True)
+            if wantMag:
+                self.assertEqual(mag.shape, flux.shape)
+                numpy.testing.assert_array_equal(mag, self.engine.magnitude(flux))
+            else:
+                self.assertIsNone(mag)
+            if wantErr:
+                numpy.testing.assert_array_equal(magErr, self.engine.magnitudeErr(flux, fluxErr))
+            else:
+                self.assertIsNone(magErr)
+        # all outputs are views of one block
+        blocks = set()
+        for output in (results[0][0], results[0][1], results[1][0], results[2][0], results[3][1]):
+            while output.base is not None:
+                output = output.base
+            blocks.add(id(output))
+        self.assertEqual(len(blocks), 1)
+
+    def testEmpty(self):
+        self.assertEqual(self.engine.convertAll([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+
+from analysis.pipeline import prefetch, ReadAhead
+
+
+class Recorder(object):
+    """A fetch function that records the calls made to it, and how many run at once."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.maxRunning = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, key):
+        with self.lock:
+            self.calls.append(key)
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return key*10
+
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def testOrder(self):
+        """Results come back in order, with no more than ``depth`` calls ahead."""
+        fetch = Recorder(delay=0.001)
+        results = []
+        for result in prefetch(fetch, range(20), depth=3):
+            results.append(result)
+            self.assertLessEqual(len(fetch.calls), len(results) + 3)
+        self.assertEqual(results, [n*10 for n in range(20)])
+        self.assertLessEqual(fetch.maxRunning, 3)
+
+    def testException(self):
+        def fetch(n):
+            if n == 2:
+                raise RuntimeError("bad item")
+            return n
+        results = prefetch(fetch, range(5), depth=2)
+        self.assertEqual([next(results), next(results)], [0, 1])
+        self.assertRaises(RuntimeError, next, results)
+
+
+class ReadAheadTestCase(unittest.TestCase):
+
+    def testOrder(self):
+        fetch = Recorder()
+        readAhead = ReadAhead(fetch, range(10), depth=2)
+        try:
+            self.assertEqual([readAhead.get(n, fetch) for n in range(10)], [n*10 for n in range(10)])
+            self.assertEqual(sorted(fetch.calls), list(range(10)))
+            # unplanned keys are just fetched directly
+            self.assertEqual(readAhead.get(42, fetch), 420)
+        finally:
+            readAhead.close()
+
+    def testSkipped(self):
+        """Keys that are never asked for don't stop later ones from being served."""
+        fetch = Recorder()
+        readAhead = ReadAhead(fetch, range(10), depth=2)
+        try:
+            self.assertEqual([readAhead.get(n, fetch) for n in (0, 3, 4, 9)], [0, 30, 40, 90])
+            self.assertEqual(sorted(fetch.calls), list(range(10)))
+        finally:
+            readAhead.close()
+
+    def testSkippedDropped(self):
+        """Results passed over are not kept; asking for them afterwards fetches them again."""
+        fetch = Recorder()
+        readAhead = ReadAhead(fetch, range(10), depth=2)
+        try:
+            self.assertEqual(readAhead.get(5, fetch), 50)
+            self.assertEqual(sorted(readAhead._planned.elements()), list(range(6, 10)))
+            self.assertEqual(readAhead.get(2, fetch), 20)
+            self.assertLessEqual(set(range(6)), set(fetch.calls))
+            self.assertEqual(fetch.calls.count(2), 2)
+            self.assertEqual(readAhead.get(6, fetch), 60)
+        finally:
+            readAhead.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+import numpy
+
+from analysis.source_id import makeCoaddId, splitCoaddId, IdIndex, alignIds
+
+
+class CoaddIdTestCase(unittest.TestCase):
+
+    def testRoundTrip(self):
+        rng = numpy.random.RandomState(2)
+        tract = rng.randint(0, 20000, size=50)
+        patchX = rng.randint(0, 9, size=50)
+        patchY = rng.randint(0, 9, size=50)
+        objId = rng.randint(1, 100000, size=50)
+        ids = makeCoaddId(tract, patchX, patchY, objId)
+        parts = splitCoaddId(ids, hasFilter=False, patchStrings=False)
+        numpy.testing.assert_array_equal(parts["tract"], tract)
+        numpy.testing.assert_array_equal(parts["patch"][0], patchX)
+        numpy.testing.assert_array_equal(parts["patch"][1], patchY)
+        numpy.testing.assert_array_equal(parts["objId"], objId)
+        parts = splitCoaddId(ids, hasFilter=False)
+        self.assertEqual(parts["patch"].tolist(), ["%d,%d" % p for p in zip(patchX, patchY)])
+
+    def testScalar(self):
+        oid = makeCoaddId(8766, 4, 5, 12)
+        self.assertIsInstance(oid, (int, long))
+        parts = splitCoaddId(oid, hasFilter=False)
+        self.assertEqual((parts["tract"], parts["patch"], parts["objId"]), (8766, "4,5", 12))
+
+
+class IdIndexTestCase(unittest.TestCase):
+
+    def testLookup(self):
+        for ids in (numpy.array([3, 8, 12, 40]), numpy.array([40, 3, 12, 8])):
+            index = IdIndex(ids)
+            rows = index.lookup([12, 5, 40, 3, 100])
+            numpy.testing.assert_array_equal(rows >= 0, [True, False, True, True, False])
+            numpy.testing.assert_array_equal(ids[rows[rows >= 0]], [12, 40, 3])
+        numpy.testing.assert_array_equal(IdIndex(numpy.zeros(0, dtype=int)).lookup([1, 2]), [-1, -1])
+
+    def testAlign(self):
+        a = numpy.array([10, 4, 7, 1, 20])
+        b = numpy.array([1, 7, 8, 10, 15])
+        c = numpy.array([20, 10, 7, 2])
+        indices = alignIds([a, b, c])
+        for ids, index in zip((a, b, c), indices):
+            numpy.testing.assert_array_equal(ids[index], [7, 10])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+
+import numpy
+
+from analysis.spatial import SkyIndex
+
+
+def separation(ra1, dec1, ra2, dec2):
+    """Great-circle distance by the haversine formula."""
+    h = numpy.sin(0.5*(dec2 - dec1))**2 + numpy.cos(dec1)*numpy.cos(dec2)*numpy.sin(0.5*(ra2 - ra1))**2
+    return 2.0*numpy.arcsin(numpy.sqrt(h))
+
+
+class SkyIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(4)
+        # straddle ra=0, where naive planar matching would fail
+        self.ra = numpy.mod(rng.uniform(-0.02, 0.02, size=2000), 2*numpy.pi)
+        self.dec = rng.uniform(-0.02, 0.02, size=2000)
+        self.index = SkyIndex(self.ra, self.dec)
+
+    def testConeSearch(self):
+        radius = 0.003
+        for ra, dec in ((0.0, 0.0), (2*numpy.pi - 0.005, 0.01)):
+            expected = numpy.flatnonzero(separation(ra, dec, self.ra, self.dec) <= radius)
+            numpy.testing.assert_array_equal(self.index.cone_search(ra, dec, radius), expected)
+        results = self.index.cone_search(numpy.array([0.0, 2*numpy.pi - 0.005]), numpy.array([0.0, 0.01]),
+                                         numpy.array([radius, 2*radius]))
+        self.assertEqual(len(results), 2)
+        numpy.testing.assert_array_equal(results[0], self.index.cone_search(0.0, 0.0, radius))
+        numpy.testing.assert_array_equal(results[1], self.index.cone_search(2*numpy.pi - 0.005, 0.01, 2*radius))
+
+    def testCrossmatch(self):
+        rng = numpy.random.RandomState(5)
+        picked = rng.choice(len(self.ra), size=100, replace=False)
+        offset = 1E-6
+        ra = numpy.concatenate([self.ra[picked] + offset, [1.0]])
+        dec = numpy.concatenate([self.dec[picked], [1.0]])
+        other, mine, sep = self.index.crossmatch(ra, dec, 1E-5)
+        numpy.testing.assert_array_equal(other, numpy.arange(100))
+        numpy.testing.assert_array_equal(mine, picked)
+        numpy.testing.assert_allclose(sep, separation(ra[:100], dec[:100], self.ra[picked], self.dec[picked]),
+                                      rtol=1E-6)
+
+    def testNearest(self):
+        indices, sep = self.index.nearest(self.ra[:10], self.dec[:10], k=2)
+        self.assertEqual(indices.shape, (10, 2))
+        numpy.testing.assert_array_equal(indices[:, 0], numpy.arange(10))
+        numpy.testing.assert_allclose(sep[:, 0], 0.0, atol=1E-12)
+
+
+if __name__ == "__main__":
+    unittest.main()